@@ -3,80 +3,206 @@
 
 import csv
 import asyncio
-import smtplib
-import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from azure.identity import ClientSecretCredential
-from msgraph import GraphServiceClient
+import functools
+import json
 import os
+import time
+from urllib.parse import urlencode, quote
 from dotenv import load_dotenv
+from Util import write_run_summary, graph_request, graph_batch, batch_delete_users, batch_remove_users_from_group, batch_failure_reason, odata_string, GRAPH_BATCH_SIZE, USERS_PAGE_SIZE, close_http_session, delete_user_from_tenant, remove_user_from_group, iter_group_members, iterate_async, run_bounded, TenantUserIndex, GroupMemberSnapshot, SkuCatalog, ONBOARDING_LICENSE_SKUS
+from mailer import EmailOutbox, MailMergeTemplate, get_smtp_pool, close_smtp_pools
+from participant_store import ParticipantStore, PARTICIPANT_DB_PATH, PARTICIPANTS_CSV_PATH, PARTICIPANT_UPSERT_BATCH_SIZE
+from journal import discard_journal, ONBOARDING_JOURNAL_PATH
+from tracing import trace_span, finish_trace
 
 
-async def get_group_members(tenant_id, client_id, client_secret, group_id):
+def get_group_members(tenant_id, client_id, client_secret, group_id, snapshot=None, user_index=None):
     """
-    Get members of a specified Microsoft Entra ID group
+    Stream the members of a specified Microsoft Entra ID group
+    
+    Every page of members is fetched by following @odata.nextLink, with only the id,
+    display name, mail and object type of each member. With a delta-synced snapshot the
+    members are listed from it instead, without calling Graph.
     
     Args:
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
         group_id (str): ID of the group to get members from
+        snapshot (GroupMemberSnapshot, optional): Delta-synced membership of the group
+        user_index (TenantUserIndex, optional): Names and emails for the snapshot members
         
     Returns:
-        list: List of members in the group
+        async iterator or list: Members of the group, one page in memory at a time
     """
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
+    if snapshot is not None:
+        return snapshot.list_members(user_index)
+    return iter_group_members(group_id, tenant_id, client_id, client_secret)
+
+# Emails looked up per /users query: their mails and aiskillsfest.net UPNs together stay
+# within the 15 values Graph accepts in the "in" operators of one $filter
+EMAIL_LOOKUP_FILTER_SIZE = 7
+
+# Lookup queries sent at the same time, each $batch envelope carries GRAPH_BATCH_SIZE of them
+EMAIL_LOOKUP_CONCURRENCY = 4
+
+# Resolved participant emails of the event, kept between cleanup passes
+RESOLVED_USERS_CACHE_PATH = "./data/resolved_users.json"
+
+# User fields kept for a resolved email
+RESOLVED_USER_FIELDS = ("id", "displayName", "userPrincipalName", "mail")
+
+class EmailUserResolver:
+    """
+    Map participant emails to their tenant users with batched lookups
+    
+    Emails are looked up EMAIL_LOOKUP_FILTER_SIZE at a time with one
+    "mail in (...) or userPrincipalName in (...)" query, and those queries travel
+    GRAPH_BATCH_SIZE per $batch envelope, instead of one /users request per email. What
+    was resolved is saved for the event, so a later cleanup pass only looks up emails it
+    has not seen. Deleted users are forgotten, their emails then resolve to no users
+    without asking Graph again.
+    """
+    
+    def __init__(self, cache_path=RESOLVED_USERS_CACHE_PATH):
+        """
+        Args:
+            cache_path (str, optional): JSON file of resolved emails, None to keep
+                nothing on disk
+        """
+        self.cache_path = cache_path
+        self.users_by_email = {}
+        self.lookup_failures = {}
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as cache_file:
+                    self.users_by_email = json.load(cache_file)
+            except ValueError:
+                print(f"Ignoring unreadable resolved users cache {cache_path}")
+    
+    @staticmethod
+    def participant_upn(email):
+        # The handle@aiskillsfest.net user principal name the onboarding created
+        email_handle = email.split('@')[0] if '@' in email else email
+        return f"{email_handle}@aiskillsfest.net".lower()
+    
+    async def resolve(self, emails, tenant_id, client_id, client_secret, concurrency=EMAIL_LOOKUP_CONCURRENCY):
+        """
+        Find the tenant users of many participant emails
+        
+        Args:
+            emails (iterable): Participant email addresses
+            tenant_id (str): Microsoft Entra ID tenant ID
+            client_id (str): Application ID for authentication
+            client_secret (str): Application secret for authentication
+            concurrency (int, optional): $batch envelopes in flight at the same time
+        
+        Returns:
+            dict: Lowercased email to the list of users whose mail is the email or whose
+                UPN is handle@aiskillsfest.net, each with RESOLVED_USER_FIELDS. Emails
+                whose lookup failed are left out, with the reason in lookup_failures
+        """
+        wanted = list(dict.fromkeys(email.strip().lower() for email in emails if email and email.strip()))
+        missing = [email for email in wanted if email not in self.users_by_email]
+        self.lookup_failures = {}
+        
+        if missing:
+            queries = [
+                missing[start:start + EMAIL_LOOKUP_FILTER_SIZE]
+                for start in range(0, len(missing), EMAIL_LOOKUP_FILTER_SIZE)
+            ]
+            envelopes = [queries[start:start + GRAPH_BATCH_SIZE] for start in range(0, len(queries), GRAPH_BATCH_SIZE)]
+            
+            async def lookup(envelope):
+                sub_requests = []
+                for index, chunk in enumerate(envelope):
+                    upns = sorted({self.participant_upn(email) for email in chunk})
+                    params = {
+                        "$filter": f"mail in ({','.join(map(odata_string, chunk))}) or "
+                                   f"userPrincipalName in ({','.join(map(odata_string, upns))})",
+                        "$select": ",".join(RESOLVED_USER_FIELDS),
+                        "$top": USERS_PAGE_SIZE
+                    }
+                    sub_requests.append({"id": index, "method": "GET", "url": f"/users?{urlencode(params, quote_via=quote)}"})
+                
+                responses = await graph_batch(sub_requests, tenant_id, client_id, client_secret)
+                for index, chunk in enumerate(envelope):
+                    sub_response = responses[str(index)]
+                    if sub_response.get("status") != 200:
+                        self.lookup_failures.update((email, batch_failure_reason(sub_response)) for email in chunk)
+                        continue
+                    users = sub_response["body"].get("value", [])
+                    for email in chunk:
+                        upn = self.participant_upn(email)
+                        self.users_by_email[email] = [
+                            {field: user.get(field) for field in RESOLVED_USER_FIELDS}
+                            for user in users
+                            if (user.get("mail") or "").lower() == email or (user.get("userPrincipalName") or "").lower() == upn
+                        ]
+            
+            with trace_span("resolve emails", emails=len(missing)):
+                await run_bounded(envelopes, lookup, concurrency)
+            self.save()
+            print(f"Resolved {len(missing) - len(self.lookup_failures)} participant emails in {len(queries)} lookups "
+                  f"({len(wanted) - len(missing)} from the cache, {len(self.lookup_failures)} failed)")
+        
+        return {email: self.users_by_email[email] for email in wanted if email in self.users_by_email}
     
-    # Get members of the group
-    members = await graph_client.groups.by_group_id(group_id).members.get()
-    return members
+    def forget_user(self, user_id):
+        """
+        Drop a deleted user from every email it was resolved for
+        """
+        for email, users in self.users_by_email.items():
+            if any(user["id"] == user_id for user in users):
+                self.users_by_email[email] = [user for user in users if user["id"] != user_id]
+    
+    def save(self):
+        if not self.cache_path:
+            return
+        # Write next to the old file and swap, so an interrupted pass keeps the previous cache
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(self.users_by_email, cache_file)
+        os.replace(temp_path, self.cache_path)
 
-async def save_members_to_csv(members, csv_file_path="./data/Participants.csv"):
+async def save_members_to_csv(members, csv_file_path=PARTICIPANTS_CSV_PATH, store=None):
     """
-    Save group members' information to a CSV file
+    Save group members' information to the participant store and its CSV file
+    
+    Members are added to the store in batches, known emails are skipped with one index
+    lookup each, and the CSV is rewritten from the store at the end.
     
     Args:
-        members (list): List of group members
+        members (iterable): Group members, a list or the stream from get_group_members
         csv_file_path (str): Path to save the CSV file
+        store (ParticipantStore, optional): Store to add the members to, the default
+            store is opened (and closed) otherwise
     """
-    # Check if the CSV file already exists
-    file_exists = os.path.isfile(csv_file_path)
-    
-    # Create a set of existing emails to avoid duplicates
-    existing_emails = set()
-    if file_exists:
-        try:
-            with open(csv_file_path, 'r', newline='') as csv_file:
-                reader = csv.DictReader(csv_file)
-                for row in reader:
-                    if 'Email' in row and row['Email']:
-                        existing_emails.add(row['Email'].lower())
-        except Exception as e:
-            print(f"Error reading existing CSV file: {str(e)}")
+    own_store = store is None
+    if own_store:
+        store = ParticipantStore()
     
-    # Open file in append mode if it exists, otherwise create a new one
-    mode = 'a' if file_exists else 'w'
-    with open(csv_file_path, mode, newline='') as csv_file:
-        fieldnames = ['First Name', 'Email']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        
-        # Write header only if creating a new file
-        if not file_exists:
-            writer.writeheader()
+    try:
+        # Pick up rows written to the CSV outside the store since it was last saved
+        store.import_participant_csvs(csv_file_path)
         
-        # Track count of new entries
         new_entries_count = 0
-        for member in members.value:
+        batch = []
+        
+        def flush(batch):
+            added = {id(member) for member in store.add_many(batch, source="group")}
+            for member in batch:
+                if id(member) in added:
+                    print(f"Added new member: {member['display_name']} ({member['email']})")
+                else:
+                    print(f"Skipping existing member: {member['display_name']} ({member['email']})")
+            return len(added)
+        
+        async for member in iterate_async(members):
             # Use default values if attributes are not available
-            display_name = member.display_name if hasattr(member, 'display_name') and member.display_name else "Unknown User"
-            email = member.mail if hasattr(member, 'mail') and member.mail else ""
+            display_name = member.get('displayName') or "Unknown User"
+            email = member.get('mail') or ""
             
             # Extract first name and last name
             name_parts = display_name.split()
@@ -87,66 +213,72 @@ async def save_members_to_csv(members, csv_file_path="./data/Participants.csv"):
                 print(f"Skipping member with no email: {display_name}")
                 continue
             
-            # Check if this email is already in the CSV (case insensitive)
-            if email.lower() in existing_emails:
-                print(f"Skipping existing member: {display_name} ({email})")
-                continue
-                
-            # Write to CSV
-            writer.writerow({
-                'First Name': first_name, 
-                'Email': email
-            })
-            
-            # Add to tracking
-            new_entries_count += 1
-            existing_emails.add(email.lower())
-            print(f"Added new member: {display_name} ({email})")
+            batch.append({'email': email, 'first_name': first_name, 'display_name': display_name})
+            if len(batch) >= PARTICIPANT_UPSERT_BATCH_SIZE:
+                new_entries_count += flush(batch)
+                batch = []
+        if batch:
+            new_entries_count += flush(batch)
+        
+        store.export_csv(csv_file_path)
+    finally:
+        if own_store:
+            store.close()
     
     print(f"Member information saved to {csv_file_path} ({new_entries_count} new entries added)")
     return csv_file_path
 
 
-async def sendEmail(sender_email, sender_password, smtp_server, smtp_port, email, first_name,results):
+# Body of the thank you email, $first_name is filled in per participant
+THANK_YOU_EMAIL_BODY = """
+<html>
+<body>
+    <p>Dear $first_name,</p>
+    <p>Thank you for registering and attending the AI Skills Fest event! We hope you enjoyed the sessions and found them valuable.</p>
+    <p>We're looking forward to seeing you at future events. If you have any feedback or questions, please don't hesitate to reach out, please contact our <a href="mailto:admins@aiskillsfest.net?subject=Inquiry&body=Hello,%20I%20have%20a%20question%20about..." >support team</a> about upcoming events or just saying hi!</p>
+    <p>Best regards,<br><a href="https://aiskillsfest.com">The AI Skills Fest Team</a></p>
+</body>
+</html>
+"""
+
+@functools.lru_cache(maxsize=None)
+def get_thank_you_template(sender_email):
+    """
+    Thank you email template of a sender, compiled on first use
+    """
+    return MailMergeTemplate(
+        sender_email,
+        "Thank You for Attending AI Skills Fest!",
+        THANK_YOU_EMAIL_BODY,
+        cc=["admins@aiskillsfest.net"]
+    )
+
+async def sendEmail(sender_email, sender_password, smtp_server, smtp_port, email, first_name,results, smtp_pool=None, outbox=None):
     
     try:
-        # Create email message
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = email
-        msg['Cc'] = "admins@aiskillsfest.net"
-        msg['Subject'] = "Thank You for Attending AI Skills Fest!"
-        
-        # Email body
-        body = f"""
-        <html>
-        <body>
-            <p>Dear {first_name},</p>
-            <p>Thank you for registering and attending the AI Skills Fest event! We hope you enjoyed the sessions and found them valuable.</p>
-            <p>We're looking forward to seeing you at future events. If you have any feedback or questions, please don't hesitate to reach out, please contact our <a href="mailto:admins@aiskillsfest.net?subject=Inquiry&body=Hello,%20I%20have%20a%20question%20about..." >support team</a> about upcoming events or just saying hi!</p>                        
-            <p>Best regards,<br><a href="https://aiskillsfest.com">The AI Skills Fest Team</a></p>
-        </body>
-        </html>
-        """
+        # Render the email from the precompiled thank you template
+        msg, recipients = get_thank_you_template(sender_email).render(email, first_name=first_name)
         
-        msg.attach(MIMEText(body, 'html'))
+        # Hand the email to the outbox if one is used, it is counted once sent
+        if outbox is not None:
+            def count_sent(sent):
+                if sent.result():
+                    results['sent_emails'] += 1
+            
+            outbox.enqueue(msg, recipients, label=email).add_done_callback(count_sent)
+            print(f"Thank you email to {email} ({first_name}) queued")
+            return
         
-        # Set up SMTP server and send email
-        cc_emails = ["admins@aiskillsfest.net"]
-        recipients = [email] + cc_emails
+        # Otherwise send email over a pooled SMTP connection if email info provided
+        if smtp_pool is None and all([smtp_server, smtp_port, sender_email, sender_password]):
+            smtp_pool = get_smtp_pool(smtp_server, smtp_port, sender_email, sender_password)
+        if smtp_pool is None:
+            print(f"SMTP settings missing, not sending thank you email to {email}")
+            return
         
-        # Send email
-        # Connect to SMTP server if email info provided
-        if all([smtp_server, smtp_port, sender_email, sender_password]):
-            try:
-                with smtplib.SMTP(smtp_server, smtp_port) as server:
-                    server.starttls()  # Secure the connection
-                    server.login(sender_email, sender_password)
-                    server.sendmail(sender_email, recipients, msg.as_string())
-                    server.quit()
-                    print("Connected to SMTP server for sending thank you emails")
-            except Exception as e:
-                print(f"Failed to connect to SMTP server: {str(e)}")
+        # smtplib is blocking, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, smtp_pool.send, msg, recipients)
         
         results['sent_emails'] += 1
         print(f"Thank you email sent to {email} ({first_name})")
@@ -154,9 +286,18 @@ async def sendEmail(sender_email, sender_password, smtp_server, smtp_port, email
         print(f"Failed to send thank you email to {email}: {str(e)}")
  
 
-async def send_thank_you_emails(csv_file_path, smtp_server, smtp_port, sender_email, sender_password):
+# Thank you emails waiting in the outbox before the mail merge stops reading participants
+THANK_YOU_MAX_IN_FLIGHT = 200
+
+async def send_thank_you_emails(csv_file_path, smtp_server, smtp_port, sender_email, sender_password, outbox=None,
+                                results_path="./data/thank_you_results.csv", max_in_flight=THANK_YOU_MAX_IN_FLIGHT):
     """
-    Send thank you emails to event participants
+    Send a thank you email to every event participant
+    
+    Participants are streamed from the CSV row by row, rendered from the precompiled
+    thank you template and handed to the outbox's concurrent senders. At most
+    max_in_flight emails wait in the outbox at a time, so memory stays flat however
+    many participants there are. An email address gets a single message.
     
     Args:
         csv_file_path (str): Path to the CSV file with participant information
@@ -164,129 +305,259 @@ async def send_thank_you_emails(csv_file_path, smtp_server, smtp_port, sender_em
         smtp_port (int): SMTP server port
         sender_email (str): Email address to send emails from
         sender_password (str): Password for sender email account
+        outbox (EmailOutbox, optional): Send through this outbox, otherwise one is made
+            from the SMTP settings and drained before returning
+        results_path (str, optional): CSV the per-recipient results are written to
+        max_in_flight (int, optional): Emails queued before waiting for the senders
+        
+    Returns:
+        dict: "success" and "failed" lists of recipients, failures with a "reason"
     """
-    # Read participant information from CSV
-    participants = []
-    with open(csv_file_path, 'r') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            participants.append(row)
-    
-    # Send thank you emails
-    for participant in participants:
-        first_name = participant.get('First Name', '')
-        email = participant.get('Email', '')
-        
-        if not email:
-            continue
+    results = {"success": [], "failed": []}
+    own_outbox = outbox is None
+    if own_outbox:
+        if not all([smtp_server, smtp_port, sender_email, sender_password]):
+            print("SMTP settings missing, not sending thank you emails")
+            return results
+        outbox = EmailOutbox(get_smtp_pool(smtp_server, smtp_port, sender_email, sender_password))
+    
+    template = get_thank_you_template(sender_email)
+    
+    def record_result(recipient, sent):
+        (results["success"] if sent.result() else results["failed"]).append(recipient)
+    
+    in_flight = set()
+    seen_emails = set()
+    with open(csv_file_path, 'r', newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            email = (row.get('Email') or '').strip()
+            if not email or email.lower() in seen_emails:
+                continue
+            seen_emails.add(email.lower())
+            
+            first_name = row.get('First Name') or ''
+            try:
+                msg, recipients = template.render(email, first_name=first_name)
+            except Exception as e:
+                print(f"Not sending a thank you email to {email!r}: {str(e)}")
+                results["failed"].append({"email": email, "first_name": first_name, "reason": str(e)})
+                continue
+            sent = outbox.enqueue(msg, recipients, label=email)
+            sent.add_done_callback(functools.partial(record_result, {"email": email, "first_name": first_name}))
+            in_flight.add(sent)
+            
+            # Let the senders catch up before reading more participants
+            if len(in_flight) >= max_in_flight:
+                _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+    
+    if in_flight:
+        await asyncio.wait(in_flight)
+    if own_outbox:
+        await outbox.drain()
+    
+    # The outbox keeps the reason of every failed send
+    reasons = {result["recipient"]: result.get("reason") for result in outbox.results if not result["sent"]}
+    for recipient in results["failed"]:
+        recipient.setdefault("reason", reasons.get(recipient["email"], "Unknown error"))
+    
+    if results_path:
+        with open(results_path, 'w', newline='') as results_file, trace_span("csv write", path=results_path):
+            writer = csv.DictWriter(results_file, fieldnames=["Email", "First Name", "Sent", "Reason"])
+            writer.writeheader()
+            for recipient in results["success"]:
+                writer.writerow({"Email": recipient["email"], "First Name": recipient["first_name"], "Sent": "yes", "Reason": ""})
+            for recipient in results["failed"]:
+                writer.writerow({"Email": recipient["email"], "First Name": recipient["first_name"], "Sent": "no", "Reason": recipient["reason"]})
+        print(f"Thank you email results saved to {results_path}")
+    
+    print(f"Thank you emails: {len(results['success'])} sent, {len(results['failed'])} failed")
+    return results
+
+# Number of $batch envelopes of deletions the teardown steps send at the same time
+TEARDOWN_CONCURRENCY = 10
+
+class TeardownResults:
+    """
+    Consolidated per-user outcome of the teardown steps
+    
+    Every step records into the same table, one row per user (or per participant email
+    when no user was found), with the outcome of each teardown action on that user.
+    """
+    
+    ACTIONS = ("removed_from_group", "deleted_from_tenant")
+    
+    def __init__(self):
+        self.rows = {}
+        self.keys_by_email = {}
+    
+    def record(self, key, action, status, name=None, email=None, reason=None):
+        """
+        Record the outcome of one action on one user
         
-    results = {'sent_emails': 0}
-    await sendEmail(sender_email, sender_password, smtp_server, smtp_port, email, first_name, results)
+        Args:
+            key (str): User ID, or the participant email when no user was found
+            action (str): One of ACTIONS
+            status (str): "done", "failed", "skipped" or "not_found"
+            name (str, optional): Display name of the user
+            email (str, optional): Email of the user
+            reason (str, optional): Why the action failed or was skipped
+        """
+        row = self.rows.setdefault(key, {"user_id": key, "name": "", "email": ""})
+        row["name"] = name or row["name"]
+        row["email"] = email or row["email"]
+        row[action] = status
+        if reason:
+            row["reason"] = reason
+        if email:
+            self.keys_by_email.setdefault(email.lower(), set()).add(key)
+    
+    def is_done(self, email, action):
+        """
+        Check whether an action already succeeded for a user with the given email
+        """
+        keys = self.keys_by_email.get((email or "").lower(), ())
+        return any(self.rows[key].get(action) == "done" for key in keys)
+    
+    def count(self, action, status="done"):
+        return sum(1 for row in self.rows.values() if row.get(action) == status)
+    
+    def print_table(self):
+        print(f"{'User ID':<38} {'Email':<40} {'Group':<10} {'Tenant':<10} Reason")
+        for row in self.rows.values():
+            print(f"{row['user_id']:<38} {row['email']:<40} {row.get('removed_from_group', '-'):<10} "
+                  f"{row.get('deleted_from_tenant', '-'):<10} {row.get('reason', '')}")
+        for action in self.ACTIONS:
+            print(f"{action}: {self.count(action)} done, {self.count(action, 'failed')} failed")
+    
+    def save_csv(self, csv_file_path):
+        with open(csv_file_path, 'w', newline='') as csv_file, trace_span("csv write", path=csv_file_path):
+            fieldnames = ['user_id', 'name', 'email', *self.ACTIONS, 'reason']
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames, restval='')
+            writer.writeheader()
+            writer.writerows(self.rows.values())
+        return csv_file_path
 
-    print("All thank you emails sent successfully!")
+def _in_batches(items):
+    # Consecutive slices of items, one $batch envelope each
+    return [items[start:start + GRAPH_BATCH_SIZE] for start in range(0, len(items), GRAPH_BATCH_SIZE)]
 
-async def remove_exgroup_members_from_tenant(tenant_id, client_id, client_secret, members):
+async def remove_exgroup_members_from_tenant(tenant_id, client_id, client_secret, members, concurrency=TEARDOWN_CONCURRENCY, results=None, user_index=None):
     """
     Remove members from the Microsoft Entra ID tenant
     
+    The user members are deleted through $batch envelopes of GRAPH_BATCH_SIZE users.
+    
     Args:
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
-        members (list): List of members to remove
+        members (iterable): Members to remove, a list or the stream from get_group_members,
+            listed in full before the first removal
+        concurrency (int, optional): Number of $batch envelopes sent at the same time
+        results (TeardownResults, optional): Table to record into, a new one by default
+        user_index (TenantUserIndex, optional): Snapshot to drop the deleted users from
         
     Returns:
-        int: Number of members successfully removed
+        TeardownResults: Per-user results, deleted users have deleted_from_tenant "done"
     """
-
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
+    results = results if results is not None else TeardownResults()
     
-    removed_count = 0
-    
-    # Remove each member from the tenant, but first check if they're actually users
-    for member in members.value:
-        if hasattr(member, 'id') and member.id:
-            try:
-                # Check if the member is a user by getting their odata_type
-                is_user = False
-                if hasattr(member, 'odata_type') and member.odata_type:
-                    is_user = "#microsoft.graph.user" in member.odata_type
-                else:
-                    # Get the full user object to check if it's a user
-                    try:
-                        user_details = await graph_client.users.by_user_id(member.id).get()
-                        is_user = True
-                    except Exception:
-                        is_user = False
-                
-                if not is_user:
-                    print(f"Skipping member {member.id} - not a user object")
-                    continue
-                
-                # Remove user from tenant
-                await graph_client.users.by_user_id(member.id).delete()
-                
-                # Print name and email if available
-                name = member.display_name if hasattr(member, 'display_name') and member.display_name else "Unknown"
-                email = member.mail if hasattr(member, 'mail') and member.mail else "Unknown"
-                print(f"Removed user from tenant: {name} ({email})")
-                
-                removed_count += 1
-            except Exception as e:
-                print(f"Failed to remove user {member.id} from tenant: {str(e)}")
+    # Check if a member is actually a user before removing it
+    async def check_member(member):
+        member_id = member['id']
+        try:
+            # Check if the member is a user by its odata type
+            if member.get('@odata.type'):
+                is_user = "#microsoft.graph.user" in member['@odata.type']
+            else:
+                # Get the user object to check if it's a user
+                response = await graph_request("GET", f"/users/{member_id}", tenant_id, client_id, client_secret)
+                is_user = response.status == 200
+        except Exception as e:
+            print(f"Failed to remove user {member_id} from tenant: {str(e)}")
+            results.record(member_id, "deleted_from_tenant", "failed", member.get('displayName') or "Unknown", member.get('mail') or "", str(e))
+            return False
+        
+        if not is_user:
+            print(f"Skipping member {member_id} - not a user object")
+            results.record(member_id, "deleted_from_tenant", "skipped", member.get('displayName') or "Unknown", member.get('mail') or "", "Not a user object")
+        return is_user
     
-    return removed_count
+    # Remove a batch of users from the tenant
+    async def remove_users(users):
+        try:
+            delete_results = await batch_delete_users([user['id'] for user in users], tenant_id, client_id, client_secret, user_index=user_index)
+            failures = {failure["user_id"]: failure["reason"] for failure in delete_results["failed"]}
+        except Exception as e:
+            failures = {user['id']: str(e) for user in users}
+        
+        for user in users:
+            # Get name and email if available
+            name = user.get('displayName') or "Unknown"
+            # Members without a mail get an empty email, their row stays keyed by user ID
+            email = user.get('mail') or ""
+            if user['id'] in failures:
+                print(f"Failed to remove user {user['id']} from tenant: {failures[user['id']]}")
+                results.record(user['id'], "deleted_from_tenant", "failed", name, email, failures[user['id']])
+            else:
+                print(f"Removed user from tenant: {name} ({email or 'no mail'})")
+                results.record(user['id'], "deleted_from_tenant", "done", name, email)
+    
+    # List every member before deleting any, deletes shift the later pages of the listing
+    members = [member async for member in iterate_async(members) if member.get('id')]
+    is_user = await run_bounded(members, check_member, concurrency)
+    users = [member for member, user in zip(members, is_user) if user]
+    await run_bounded(_in_batches(users), remove_users, concurrency)
+    return results
 
 
-async def remove_members_from_group(tenant_id, client_id, client_secret, group_id, members):
+async def remove_members_from_group(tenant_id, client_id, client_secret, group_id, members, concurrency=TEARDOWN_CONCURRENCY, results=None):
     """
     Remove members from a specified Microsoft Entra ID group
     
+    The members are removed through $batch envelopes of GRAPH_BATCH_SIZE members.
+    
     Args:
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
         group_id (str): ID of the group to remove members from
-        members (list): List of members to remove
+        members (iterable): Members to remove, a list or the stream from get_group_members,
+            listed in full before the first removal
+        concurrency (int, optional): Number of $batch envelopes sent at the same time
+        results (TeardownResults, optional): Table to record into, a new one by default
         
     Returns:
-        int: Number of members successfully removed
+        TeardownResults: Per-user results, removed members have removed_from_group "done"
     """
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
-    
-    removed_count = 0
+    results = results if results is not None else TeardownResults()
     
-    # Remove each member from the group
-    for member in members.value:
-        if hasattr(member, 'id') and member.id:
-            try:
-                # Remove member from group
-                await graph_client.groups.by_group_id(group_id).members.by_directory_object_id(member.id).ref.delete()
-                
-                # Print name and email if available
-                name = member.display_name if hasattr(member, 'display_name') and member.display_name else "Unknown"
-                email = member.mail if hasattr(member, 'mail') and member.mail else "Unknown"
-                print(f"Removed member: {name} ({email})")
-                
-                removed_count += 1
-            except Exception as e:
-                print(f"Failed to remove member {member.id}: {str(e)}")
-    
-    return removed_count
+    # Remove a batch of members from the group
+    async def remove_members(batch):
+        try:
+            remove_results = await batch_remove_users_from_group([member['id'] for member in batch], group_id, tenant_id, client_id, client_secret)
+            failures = {failure["user_id"]: failure["reason"] for failure in remove_results["failed"]}
+        except Exception as e:
+            failures = {member['id']: str(e) for member in batch}
+        
+        for member in batch:
+            # Get name and email if available
+            name = member.get('displayName') or "Unknown"
+            # Members without a mail get an empty email, their row stays keyed by user ID
+            email = member.get('mail') or ""
+            if member['id'] in failures:
+                print(f"Failed to remove member {member['id']}: {failures[member['id']]}")
+                results.record(member['id'], "removed_from_group", "failed", name, email, failures[member['id']])
+            else:
+                print(f"Removed member: {name} ({email or 'no mail'})")
+                results.record(member['id'], "removed_from_group", "done", name, email)
+    
+    # List every member before removing any, removals shift the later pages of the listing
+    members = [member async for member in iterate_async(members) if member.get('id')]
+    await run_bounded(_in_batches(members), remove_members, concurrency)
+    return results
 
-async def remove_participants_from_tenant(tenant_id, client_id, client_secret, csv_file_path="./data/Participants.csv"):
+async def remove_participants_from_tenant(tenant_id, client_id, client_secret, csv_file_path=PARTICIPANTS_CSV_PATH, concurrency=TEARDOWN_CONCURRENCY, results=None, resolver=None, user_index=None):
     """
     Read participant emails from CSV, get their member IDs, and remove them from the tenant
     
@@ -295,78 +566,90 @@ async def remove_participants_from_tenant(tenant_id, client_id, client_secret, c
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
         csv_file_path (str): Path to the CSV file with participant information
+        concurrency (int, optional): Number of $batch envelopes sent at the same time
+        results (TeardownResults, optional): Table to record into, a new one by default
+        resolver (EmailUserResolver, optional): Resolves the emails to users in batches,
+            one with the event's resolved users cache by default
+        user_index (TenantUserIndex, optional): Snapshot to drop the deleted users from
         
     Returns:
-        int: Number of users successfully removed from the tenant
+        TeardownResults: Per-user results, deleted users have deleted_from_tenant "done"
     """
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
+    results = results if results is not None else TeardownResults()
     
     # Read participant emails from CSV
     participant_emails = []
     try:
-        with open(csv_file_path, 'r', newline='') as csv_file:
+        with open(csv_file_path, 'r', newline='') as csv_file, trace_span("csv read", path=csv_file_path):
             reader = csv.DictReader(csv_file)
             for row in reader:
                 if 'Email' in row and row['Email']:
                     participant_emails.append(row['Email'].lower())
     except Exception as e:
         print(f"Error reading CSV file: {str(e)}")
-        return 0
+        return results
     
     print(f"Found {len(participant_emails)} participant emails in the CSV file")
     
-    # Track removal count
-    removed_count = 0
+    # Skip participants an earlier teardown step already deleted, and look up the
+    # users of the others by email or handle@aiskillsfest.net UPN in batches
+    participant_emails = [email for email in participant_emails if not results.is_done(email, "deleted_from_tenant")]
+    resolver = resolver if resolver is not None else EmailUserResolver()
+    try:
+        users_by_email = await resolver.resolve(participant_emails, tenant_id, client_id, client_secret)
+    except Exception as e:
+        print(f"Error looking up participants: {str(e)}")
+        users_by_email = {}
+        resolver.lookup_failures = {email: str(e) for email in participant_emails}
     
-    # Process each participant email
+    # Users of every participant, participants without one are recorded right away
+    to_delete = []
     for email in participant_emails:
-        try:            # Extract email handle (part before the @ symbol)
-            email_handle = email.split('@')[0] if '@' in email else email
-            
-            # Create the expected user principal name in the format "handle@aiskillsfest.net"
-            user_principal_name = f"{email_handle}@aiskillsfest.net"
-            
-            # Find the user by email or user principal name
-            from msgraph.generated.users.users_request_builder import UsersRequestBuilder
-            request_configuration = UsersRequestBuilder.UsersRequestBuilderGetRequestConfiguration(
-                query_parameters=UsersRequestBuilder.UsersRequestBuilderGetQueryParameters(
-                    filter=f"mail eq '{email}' or userPrincipalName eq '{user_principal_name}'"
-                )
-            )
-            users = await graph_client.users.get(request_configuration=request_configuration)
-            
-            if not users.value or len(users.value) == 0:
-                print(f"No user found with email: {email} or UPN: {user_principal_name}")
-                continue
-            
-            # Process each matching user (should typically be just one)
-            for user in users.value:
-                if hasattr(user, 'id') and user.id:
-                    try:
-                        # Remove user from tenant
-                        await graph_client.users.by_user_id(user.id).delete()
-                        
-                        # Get user display name if available
-                        name = user.display_name if hasattr(user, 'display_name') and user.display_name else "Unknown"
-                        upn = user.user_principal_name if hasattr(user, 'user_principal_name') else "Unknown UPN"
-                        print(f"Removed user from tenant: {name} ({email}, UPN: {upn})")
-                        
-                        removed_count += 1
-                    except Exception as e:
-                        print(f"Failed to remove user with email {email}: {str(e)}")
-        except Exception as e:
-            print(f"Error processing email {email}: {str(e)}")
+        if email in resolver.lookup_failures:
+            print(f"Error processing email {email}: {resolver.lookup_failures[email]}")
+            results.record(email, "deleted_from_tenant", "failed", email=email, reason=resolver.lookup_failures[email])
+            continue
+        
+        # Process each matching user (should typically be just one)
+        users = [user for user in users_by_email.get(email, []) if user.get('id')]
+        if not users:
+            print(f"No user found with email: {email} or its aiskillsfest.net UPN")
+            results.record(email, "deleted_from_tenant", "not_found", email=email)
+            continue
+        to_delete.extend((email, user) for user in users)
     
-    return removed_count
+    # Remove a batch of participant users from the tenant
+    async def remove_users(batch):
+        try:
+            delete_results = await batch_delete_users([user['id'] for _, user in batch], tenant_id, client_id, client_secret, user_index=user_index)
+            failures = {failure["user_id"]: failure["reason"] for failure in delete_results["failed"]}
+        except Exception as e:
+            failures = {user['id']: str(e) for _, user in batch}
+        
+        for email, user in batch:
+            # Get user display name if available
+            name = user.get('displayName') or "Unknown"
+            upn = user.get('userPrincipalName') or "Unknown UPN"
+            reason = failures.get(user['id'])
+            if reason is None:
+                resolver.forget_user(user['id'])
+                print(f"Removed user from tenant: {name} ({email}, UPN: {upn})")
+                results.record(user['id'], "deleted_from_tenant", "done", name, email)
+            elif reason.startswith("HTTP 404"):
+                # Resolved by an earlier pass and deleted since
+                resolver.forget_user(user['id'])
+                print(f"User already removed from tenant: {name} ({email}, UPN: {upn})")
+                results.record(user['id'], "deleted_from_tenant", "not_found", name, email)
+            else:
+                print(f"Failed to remove user with email {email}: {reason}")
+                results.record(user['id'], "deleted_from_tenant", "failed", name, email, reason)
+    
+    await run_bounded(_in_batches(to_delete), remove_users, concurrency)
+    resolver.save()
+    return results
            
 
-async def process_additional_subscribers(tenant_id, client_id, client_secret, group_id, csv_file_path="./data/postRegistration.csv", participants_csv="./data/participants.csv", smtp_server=None, smtp_port=None, sender_email=None, sender_password=None):
+async def process_additional_subscribers(tenant_id, client_id, client_secret, group_id, csv_file_path="./data/postRegistration.csv", participants_csv=PARTICIPANTS_CSV_PATH, smtp_server=None, smtp_port=None, sender_email=None, sender_password=None, outbox=None, store=None, resolver=None, user_index=None):
     """
     Process additional subscribers from a separate CSV file:
     1. Check if they exist in the group
@@ -385,95 +668,95 @@ async def process_additional_subscribers(tenant_id, client_id, client_secret, gr
         smtp_port (int): SMTP server port
         sender_email (str): Email address to send emails from
         sender_password (str): Password for sender email account
+        outbox (EmailOutbox, optional): Queue thank you emails here instead of sending them
+            inline, the outbox is drained before the results are reported
+        store (ParticipantStore, optional): Participant store behind participants_csv, the
+            default store is opened (and closed) otherwise
+        resolver (EmailUserResolver, optional): Resolves the subscribers to users in
+            batches, one with the event's resolved users cache by default
+        user_index (TenantUserIndex, optional): Snapshot to drop the deleted users from
         
     Returns:
         dict: Results with counts of processed subscribers
     """
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
-    
-    # Load existing participants to avoid duplicates
-    existing_emails = set()
-    if os.path.isfile(participants_csv):
+    own_store = store is None
+    if own_store:
+        store = ParticipantStore()
+    try:
+        # Pick up rows written to the participants CSV outside the store
+        store.import_participant_csvs(participants_csv)
+        
+        # Read subscribers from CSV
+        subscribers = []
         try:
-            with open(participants_csv, 'r', newline='') as csv_file:
+            with open(csv_file_path, 'r', newline='') as csv_file, trace_span("csv read", path=csv_file_path):
                 reader = csv.DictReader(csv_file)
                 for row in reader:
-                    if 'Email' in row and row['Email']:
-                        existing_emails.add(row['Email'].lower())
+                    if 'Email' in row and row['Email'] and 'First Name' in row:
+                        subscribers.append({
+                            'first_name': row['First Name'],
+                            'email': row['Email'].lower()
+                        })
         except Exception as e:
-            print(f"Error reading existing participants CSV file: {str(e)}")
-    
-    # Read subscribers from CSV
-    subscribers = []
-    try:
-        with open(csv_file_path, 'r', newline='') as csv_file:
-            reader = csv.DictReader(csv_file)
-            for row in reader:
-                if 'Email' in row and row['Email'] and 'First Name' in row:
-                    subscribers.append({
-                        'first_name': row['First Name'],
-                        'email': row['Email'].lower()
-                    })
-    except Exception as e:
-        print(f"Error reading subscribers CSV file: {str(e)}")
-        return {'added_to_participants': 0, 'sent_emails': 0, 'removed_from_group': 0, 'removed_from_tenant': 0}
-    
-    print(f"Found {len(subscribers)} subscribers in {csv_file_path}")
-    
-    # Get current group members
-    members = await graph_client.groups.by_group_id(group_id).members.get()
-    
-    # Create dictionary of member emails for quick lookup
-    member_emails = {}
-    for member in members.value:
-        if hasattr(member, 'mail') and member.mail:
-            member_emails[member.mail.lower()] = member
-    
-    # Track progress
-    results = {
-        'added_to_participants': 0,
-        'sent_emails': 0,
-        'removed_from_group': 0,
-        'removed_from_tenant': 0
-    }
-    
-    # Open participants CSV in append mode
-    with open(participants_csv, 'a', newline='') as csv_file:
-        fieldnames = ['First Name', 'Email']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                
-        # Process each subscriber
+            print(f"Error reading subscribers CSV file: {str(e)}")
+            return {'added_to_participants': 0, 'sent_emails': 0, 'removed_from_group': 0, 'removed_from_tenant': 0}
+        
+        print(f"Found {len(subscribers)} subscribers in {csv_file_path}")
+        
+        # Create dictionary of member emails for quick lookup from the streamed group members
+        member_emails = {}
+        async for member in get_group_members(tenant_id, client_id, client_secret, group_id):
+            if member.get('mail'):
+                member_emails[member['mail'].lower()] = member
+        
+        # Track progress
+        results = {
+            'added_to_participants': 0,
+            'sent_emails': 0,
+            'removed_from_group': 0,
+            'removed_from_tenant': 0
+        }
+        
+        # Add the new subscribers to the store, one transaction per batch
+        new_subscribers = store.add_many(subscribers, source=os.path.basename(csv_file_path))
+        new_emails = {subscriber['email'] for subscriber in new_subscribers}
         for subscriber in subscribers:
+            if subscriber['email'] not in new_emails:
+                print(f"Subscriber {subscriber['email']} already in participants CSV")
+        if new_subscribers:
+            store.export_csv(participants_csv)
+        
+        # Look up the tenant users of the new subscribers together, by email or
+        # handle@aiskillsfest.net user principal name
+        resolver = resolver if resolver is not None else EmailUserResolver()
+        try:
+            users_by_email = await resolver.resolve(
+                [subscriber['email'] for subscriber in new_subscribers], tenant_id, client_id, client_secret
+            )
+        except Exception as e:
+            print(f"Error looking up subscribers: {str(e)}")
+            users_by_email = {}
+            resolver.lookup_failures = {subscriber['email']: str(e) for subscriber in new_subscribers}
+        
+        # Process each new subscriber
+        for subscriber in new_subscribers:
             email = subscriber['email']
             first_name = subscriber['first_name']
-            
-            # Check if already in participants.csv
-            if email in existing_emails:
-                print(f"Subscriber {email} already in participants CSV")
-                continue
-            
-            # Add to participants.csv
-            writer.writerow({'First Name': first_name, 'Email': email})
-            existing_emails.add(email)
             results['added_to_participants'] += 1
             print(f"Added subscriber to participants CSV: {first_name} ({email})")
             
             # Send thank you email if SMTP connection available
-            await sendEmail(sender_email, sender_password, smtp_server, smtp_port, email, first_name, results)
+            await sendEmail(sender_email, sender_password, smtp_server, smtp_port, email, first_name, results, outbox=outbox)
 
             # Remove from group if member exists
             if email in member_emails:
                 member = member_emails[email]
-                if hasattr(member, 'id') and member.id:
+                if member.get('id'):
                     try:
                         # Remove member from group
-                        await graph_client.groups.by_group_id(group_id).members.by_directory_object_id(member.id).ref.delete()
+                        result = await remove_user_from_group(member['id'], group_id, tenant_id, client_id, client_secret)
+                        if not result["success"]:
+                            raise Exception(result.get("reason", "Unknown error"))
                         results['removed_from_group'] += 1
                         print(f"Removed member from group: {first_name} ({email})")
                     except Exception as e:
@@ -481,50 +764,74 @@ async def process_additional_subscribers(tenant_id, client_id, client_secret, gr
             
             # Try to remove from tenant using email and handle@aiskillsfest.net
             try:
-                # Extract email handle (part before the @ symbol)
-                email_handle = email.split('@')[0] if '@' in email else email
-                
-                # Create the expected user principal name in the format "handle@aiskillsfest.net"
-                user_principal_name = f"{email_handle}@aiskillsfest.net"
+                if email in resolver.lookup_failures:
+                    raise Exception(resolver.lookup_failures[email])
+                users = users_by_email.get(email, [])
                 
-                # Find the user by email or user principal name
-                from msgraph.generated.users.users_request_builder import UsersRequestBuilder
-                request_configuration = UsersRequestBuilder.UsersRequestBuilderGetRequestConfiguration(
-                    query_parameters=UsersRequestBuilder.UsersRequestBuilderGetQueryParameters(
-                        filter=f"mail eq '{email}' or userPrincipalName eq '{user_principal_name}'"
-                    )
-                )
-                users = await graph_client.users.get(request_configuration=request_configuration)
-                
-                if users.value and len(users.value) > 0:
+                if users:
                     # Process each matching user (should typically be just one)
-                    for user in users.value:
-                        if hasattr(user, 'id') and user.id:
+                    for user in users:
+                        if user.get('id'):
                             try:
                                 # Remove user from tenant
-                                await graph_client.users.by_user_id(user.id).delete()
+                                result = await delete_user_from_tenant(user['id'], tenant_id, client_id, client_secret, user_index=user_index)
+                                if not result["success"]:
+                                    raise Exception(result.get("reason", "Unknown error"))
+                                resolver.forget_user(user['id'])
                                 
                                 # Get user display name and UPN if available
-                                name = user.display_name if hasattr(user, 'display_name') and user.display_name else "Unknown"
-                                upn = user.user_principal_name if hasattr(user, 'user_principal_name') else "Unknown UPN"
+                                name = user.get('displayName') or "Unknown"
+                                upn = user.get('userPrincipalName') or "Unknown UPN"
                                 print(f"Removed user from tenant: {name} ({email}, UPN: {upn})")
                                 
                                 results['removed_from_tenant'] += 1
                             except Exception as e:
                                 print(f"Failed to remove user with email {email}: {str(e)}")
                 else:
-                    print(f"No user found in tenant with email: {email} or UPN: {user_principal_name}")
+                    print(f"No user found in tenant with email: {email} or its aiskillsfest.net UPN")
             except Exception as e:
                 print(f"Error processing email {email} for tenant removal: {str(e)}")
         
-       
-    print(f"Results of processing {csv_file_path}:")
-    print(f"- Added to participants CSV: {results['added_to_participants']}")
-    print(f"- Thank you emails sent: {results['sent_emails']}")
-    print(f"- Removed from group: {results['removed_from_group']}")
-    print(f"- Removed from tenant: {results['removed_from_tenant']}")
+        resolver.save()
+        
+        # Wait for the queued thank you emails so the sent count is complete
+        if outbox is not None:
+            await outbox.drain()
+           
+        print(f"Results of processing {csv_file_path}:")
+        print(f"- Added to participants CSV: {results['added_to_participants']}")
+        print(f"- Thank you emails sent: {results['sent_emails']}")
+        print(f"- Removed from group: {results['removed_from_group']}")
+        print(f"- Removed from tenant: {results['removed_from_tenant']}")
+        
+        return results
+    finally:
+        if own_store:
+            store.close()
+
+def print_reclaimed_seats(seats_before, seats_after, sku_ids=ONBOARDING_LICENSE_SKUS):
+    """
+    Print how many license seats the teardown gave back
     
-    return results
+    Deleted users and users removed from a group-licensed group release their seats
+    without any assignLicense call, this only compares /subscribedSkus around the run.
+    Entra ID processes group license removals in the background, so a few seats may
+    show up as freed only some minutes later.
+    
+    Args:
+        seats_before (SkuCatalog): Seats read before the teardown
+        seats_after (SkuCatalog): Seats read after the teardown
+        sku_ids (list, optional): SKU IDs to report
+    """
+    print("=== LICENSE SEATS RECLAIMED ===")
+    for sku_id in sku_ids:
+        before = seats_before.skus.get(sku_id)
+        after = seats_after.skus.get(sku_id)
+        if before is None or after is None:
+            print(f"{seats_before.name(sku_id)}: not subscribed")
+            continue
+        print(f"{seats_before.name(sku_id)}: {before['consumed'] - after['consumed']} seats reclaimed, "
+              f"{after['consumed']} still used, {after['remaining']} available")
 
 async def main():
     """
@@ -542,33 +849,85 @@ async def main():
     smtp_port = int(os.getenv("SMTP_PORT", 587))
     sender_email = os.getenv("SMTP_EMAIL")
     sender_password = os.getenv("SMTP_PASSWORD")
+    
+    # Number of Graph deletions run at the same time
+    teardown_concurrency = int(os.getenv("TEARDOWN_CONCURRENCY", TEARDOWN_CONCURRENCY))
+    
+    # Only download what changed since the previous run instead of re-reading the tenant
+    use_delta_sync = os.getenv("GRAPH_DELTA_SYNC", "false").lower() == "true"
+    
+    # Spans of every Graph, SMTP and CSV operation are written here at the end of the run
+    trace_path = os.getenv("TRACE_FILE", f"./data/traces/cleanup-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+    
+    # Thank you emails go through an outbox drained by SMTP_WORKERS at up to SMTP_MAX_PER_SECOND
+    outbox = None
+    if all([smtp_server, smtp_port, sender_email, sender_password]):
+        outbox = EmailOutbox(
+            get_smtp_pool(smtp_server, smtp_port, sender_email, sender_password),
+            workers=int(os.getenv("SMTP_WORKERS", 4)),
+            max_per_second=float(os.getenv("SMTP_MAX_PER_SECOND", 5))
+        )
    
+    # Outcome of the run for orchestrator.py, which runs several events at once
+    summary = {"pipeline": "teardown", "completed": False}
+    
+    # Participants of every step go through one indexed store, exported to participants.csv
+    participant_store = ParticipantStore(os.getenv("PARTICIPANT_DB", PARTICIPANT_DB_PATH))
+    
+    # Emails resolved to users by one pass are not looked up again by the next
+    email_resolver = EmailUserResolver()
+    
     try:
-        # Get members of the AISkillsFestLearners group
-        print(f"Getting members of the AISkillsFestLearners group (ID: {group_id})...")
-        members = await get_group_members(tenant_id, client_id, client_secret, group_id)
-        print(f"Found {len(members.value) if hasattr(members, 'value') else 0} members in the group")
+        user_index = None
+        group_snapshot = None
+        if use_delta_sync:
+            print("Syncing tenant users and group membership...")
+            user_index = await TenantUserIndex.sync(tenant_id, client_id, client_secret)
+            group_snapshot = await GroupMemberSnapshot.sync(group_id, tenant_id, client_id, client_secret)
         
-        # Save member information to CSV
-        print("Saving member information to CSV...")
-        csv_file_path = await save_members_to_csv(members)
+        def list_group_members():
+            return get_group_members(tenant_id, client_id, client_secret, group_id, snapshot=group_snapshot, user_index=user_index)
+        
+        # Stream members of the AISkillsFestLearners group into the CSV
+        print(f"Saving members of the AISkillsFestLearners group (ID: {group_id}) to CSV...")
+        csv_file_path = await save_members_to_csv(list_group_members(), store=participant_store)
         
         # Send thank you emails
         print("Sending thank you emails...")
-        await send_thank_you_emails(csv_file_path, smtp_server, smtp_port, sender_email, sender_password)
+        thank_you_results = await send_thank_you_emails(csv_file_path, smtp_server, smtp_port, sender_email, sender_password, outbox=outbox)
         
-        # Remove members from the group                
-        print("Removing members from the group...")
-        removed_count = await remove_members_from_group(tenant_id, client_id, client_secret, group_id, members)
-        print(f"Successfully removed {removed_count} members from the group")
+        # Seats in use before the teardown, to report what deleting the users gave back
+        try:
+            seats_before = await SkuCatalog.load(tenant_id, client_id, client_secret)
+        except Exception as e:
+            seats_before = None
+            print(f"Could not read license seats, skipping the seat report: {str(e)}")
         
+        # Deleting a user also drops its group membership, so delete the user members
+        # first and then remove whatever non-user members are left in the group
+        teardown_results = TeardownResults()
         print("Removing members from AISkillsFest Tenant...")
-        removed_count = await remove_exgroup_members_from_tenant(tenant_id, client_id, client_secret, members)
-        print(f"Successfully removed {removed_count} members from the tenant")
+        await remove_exgroup_members_from_tenant(
+            tenant_id, client_id, client_secret, list_group_members(),
+            concurrency=teardown_concurrency, results=teardown_results, user_index=user_index
+        )
+        
+        print("Removing remaining members from the group...")
+        await remove_members_from_group(
+            tenant_id, client_id, client_secret, group_id, list_group_members(),
+            concurrency=teardown_concurrency, results=teardown_results
+        )
         
         print("Removing participants from AISkillsFest Tenant using CSV data...")
-        removed_count = await remove_participants_from_tenant(tenant_id, client_id, client_secret, csv_file_path)
-        print(f"Successfully removed {removed_count} participants from the tenant")
+        await remove_participants_from_tenant(
+            tenant_id, client_id, client_secret, csv_file_path,
+            concurrency=teardown_concurrency, results=teardown_results, resolver=email_resolver,
+            user_index=user_index
+        )
+        
+        print("\n=== TEARDOWN RESULTS ===")
+        teardown_results.print_table()
+        print(f"Teardown results saved to {teardown_results.save_csv('./data/teardown_results.csv')}")
         
          # Process additional subscribers from subscriberShorts.csv
         print("\nProcessing additional subscribers from subscriberShorts.csv...")
@@ -582,18 +941,49 @@ async def main():
             smtp_server, 
             smtp_port, 
             sender_email, 
-            sender_password
+            sender_password,
+            outbox=outbox,
+            store=participant_store,
+            resolver=email_resolver,
+            user_index=user_index
         )
         
+        # Wait for the queued thank you emails to go out
+        if outbox is not None:
+            await outbox.drain()
+        
+        if seats_before is not None:
+            print_reclaimed_seats(seats_before, await SkuCatalog.load(tenant_id, client_id, client_secret))
+        
+        summary.update({
+            "completed": True,
+            "users": len(teardown_results.rows),
+            "deleted": teardown_results.count("deleted_from_tenant"),
+            "delete_failures": teardown_results.count("deleted_from_tenant", "failed"),
+            "removed_from_group": teardown_results.count("removed_from_group"),
+            "emails_sent": len(thank_you_results["success"]) + subscriber_results["sent_emails"],
+            "email_failures": len(thank_you_results["failed"])
+        })
+        # The event's accounts are gone, an onboarding journal must not resume them
+        discard_journal(os.getenv("ONBOARDING_JOURNAL", ONBOARDING_JOURNAL_PATH))
         print("Cleanup process completed successfully!")
     
     except Exception as e:
+        summary["error"] = str(e)
         print(f"An error occurred during the cleanup process: {str(e)}")
+    
+    finally:
+        # Close the pooled Graph and SMTP connections
+        await close_http_session()
+        close_smtp_pools()
+        participant_store.close()
+        write_run_summary(os.getenv("RUN_SUMMARY_FILE"), summary)
+        finish_trace(trace_path)
 
 # Run the script
 if __name__ == "__main__":
-    # Load environment variables from .env file
-    load_dotenv()
+    # Load environment variables from .env file, or from ENV_FILE when run for one event
+    load_dotenv(os.getenv("ENV_FILE"))
 
     asyncio.run(main())
 
@@ -1,604 +1,2387 @@
 import csv
 import re
-import smtplib
+import contextlib
+import functools
 import asyncio
 import string
 import secrets
-import requests
 import json
 import os
+import sys
+import time
+import random
+import aiohttp
+import operator
+from collections import namedtuple
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from azure.identity import ClientSecretCredential
-from msgraph import GraphServiceClient
-from msgraph.generated.models.user import User
-from msgraph.generated.models.password_profile import PasswordProfile
 from license_skuids import LICENSE_SKUIDS
+from mailer import EmailOutbox, get_smtp_pool, close_smtp_pools
+from journal import OnboardingJournal, ONBOARDING_JOURNAL_PATH
+from tracing import tracer, trace_span, trace_stage, graph_operation_name, finish_trace
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+# Load environment variables from .env file, or from ENV_FILE when the orchestrator
+# runs this for one event
+load_dotenv(os.getenv("ENV_FILE"))
+
+# Scope requested for every Microsoft Graph token
+GRAPH_SCOPE = "https://graph.microsoft.com/.default"
+
+# Refresh a cached token this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+# Microsoft identity platform endpoint for client credential tokens fetched over plain HTTP
+LOGIN_BASE_URL = os.getenv("LOGIN_BASE_URL", "https://login.microsoftonline.com")
+
+# How tokens are fetched: "azure-identity" with ClientSecretCredential, or "http" with one
+# POST over the shared session, which spares loading the Azure SDK (see HttpTokenProvider)
+GRAPH_TOKEN_CLIENT = os.getenv("GRAPH_TOKEN_CLIENT", "azure-identity")
+
+# Microsoft Graph v1.0 endpoint used for direct HTTP requests, overridable for a local stand-in
+GRAPH_BASE_URL = os.getenv("GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0")
+
+# Connection pool settings of the shared HTTP session
+HTTP_POOL_SIZE = 100
+HTTP_KEEPALIVE_SECONDS = 60
+HTTP_TIMEOUT_SECONDS = 60
+
+# aiohttp.TraceConfig objects attached to the shared session when it is created
+HTTP_TRACE_CONFIGS = []
+
+# Graph calls in flight per app registration: starting point and bounds of the adaptive limit
+GRAPH_INITIAL_CONCURRENCY = 10
+GRAPH_MIN_CONCURRENCY = 1
+GRAPH_MAX_CONCURRENCY = 50
+
+# Seconds after a throttled call before the concurrency limit may grow again
+GRAPH_INCREASE_COOLDOWN_SECONDS = 5
+
+# Retries of a throttled or failed Graph call and the cap of its backoff
+GRAPH_MAX_RETRIES = 5
+GRAPH_MAX_BACKOFF_SECONDS = 30
+
+# Status codes that mean Graph is throttling us, and all status codes worth retrying
+THROTTLED_STATUS_CODES = {429, 503}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class GraphTokenProvider:
+    """
+    Cache a Microsoft Graph bearer token for one app registration
+    
+    The token is fetched once and handed out to every caller until shortly before it
+    expires. When several coroutines need a new token at the same time, the first one
+    refreshes it under a lock and the others reuse the result.
+    """
+    
+    def __init__(self, tenant_id, client_id, client_secret, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        # azure.identity takes a good part of a second to import, only load it when a
+        # token is really needed through it
+        from azure.identity import ClientSecretCredential
+        self.credentials = ClientSecretCredential(
+            tenant_id=tenant_id,
+            client_id=client_id,
+            client_secret=client_secret
+        )
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_on = 0
+        self._lock = None
+        self._lock_loop = None
+    
+    def _is_valid(self):
+        return self._token is not None and time.time() < self._expires_on - self.refresh_margin
+    
+    def _get_lock(self):
+        # asyncio.Lock belongs to the loop it was created on and the scripts here may
+        # run several loops one after another, so create a new lock per loop
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+    
+    async def get_token(self):
+        """
+        Return a valid bearer token, refreshing it once if it is missing or about to expire
+        """
+        if self._is_valid():
+            return self._token
+        
+        async with self._get_lock():
+            # Another coroutine may have refreshed the token while we were waiting
+            if not self._is_valid():
+                with trace_span("token fetch"):
+                    self._token, self._expires_on = await self._fetch_token()
+        
+        return self._token
+    
+    async def _fetch_token(self):
+        """
+        Returns:
+            tuple: (token, expires_on) with expires_on as a Unix timestamp
+        """
+        # ClientSecretCredential.get_token is blocking, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        token_obj = await loop.run_in_executor(None, self.credentials.get_token, GRAPH_SCOPE)
+        return token_obj.token, token_obj.expires_on
+
+class HttpTokenProvider(GraphTokenProvider):
+    """
+    Cache a Microsoft Graph bearer token fetched with a plain client credentials request
+    
+    Same caching as GraphTokenProvider, but the token comes from one POST to the
+    identity platform over the shared HTTP session, so the Azure SDK is never imported.
+    Quick read-only commands use it to start fast.
+    """
+    
+    def __init__(self, tenant_id, client_id, client_secret, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_on = 0
+        self._lock = None
+        self._lock_loop = None
+    
+    async def _fetch_token(self):
+        session = await get_http_session()
+        form = {
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "scope": GRAPH_SCOPE
+        }
+        async with session.post(f"{LOGIN_BASE_URL}/{self.tenant_id}/oauth2/v2.0/token", data=form) as response:
+            body = await response.json(content_type=None)
+            if response.status != 200:
+                raise Exception(f"Failed to get token: HTTP {response.status}: {body.get('error_description', body)}")
+        return body["access_token"], time.time() + int(body["expires_in"])
+
+# Token providers shared by every caller in the process
+_token_providers = {}
+
+class StaticTokenProvider:
+    """
+    Hand out a fixed bearer token, for a local stand-in of Graph that does not check it
+    """
+    
+    def __init__(self, token):
+        self.token = token
+    
+    async def get_token(self):
+        return self.token
+
+def register_token_provider(tenant_id, client_id, client_secret, provider):
+    """
+    Use the given provider (anything with an async get_token) for an app registration
+    """
+    _token_providers[(tenant_id, client_id, client_secret)] = provider
+
+def get_token_provider(tenant_id, client_id, client_secret):
+    """
+    Get the process-wide token provider for the given app registration
+    """
+    key = (tenant_id, client_id, client_secret)
+    provider = _token_providers.get(key)
+    if provider is None:
+        provider_class = HttpTokenProvider if GRAPH_TOKEN_CLIENT == "http" else GraphTokenProvider
+        provider = provider_class(tenant_id, client_id, client_secret)
+        _token_providers[key] = provider
+    return provider
+
+async def get_graph_token(tenant_id, client_id, client_secret):
+    """
+    Get a cached Microsoft Graph bearer token for the given app registration
+    """
+    return await get_token_provider(tenant_id, client_id, client_secret).get_token()
+
+class GraphResponse:
+    """
+    Status, headers and body of a Microsoft Graph HTTP response
+    """
+    
+    def __init__(self, status, headers, text):
+        self.status = status
+        self.headers = headers
+        self.text = text
+    
+    def json(self):
+        return json.loads(self.text) if self.text else {}
+
+def _retry_after_seconds(headers, attempt):
+    """
+    Get the wait time before a retry from a Retry-After header or jittered exponential backoff
+    """
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, TypeError, ValueError):
+        # Full jitter keeps workers that failed together from retrying together
+        return random.uniform(0, min(2 ** attempt, GRAPH_MAX_BACKOFF_SECONDS))
+
+class GraphThrottle:
+    """
+    Throttling controller shared by every Graph call of one app registration
+    
+    Calls take a slot before they are sent. The number of slots adapts with AIMD: it
+    grows by about one per round of successful calls and halves when Graph answers
+    429 or 503, so concurrency settles just under the tenant's throttling limit. A
+    Retry-After from Graph pauses every caller until it has passed.
+    """
+    
+    def __init__(self, initial=GRAPH_INITIAL_CONCURRENCY, minimum=GRAPH_MIN_CONCURRENCY, maximum=GRAPH_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.throttled_count = 0
+        self.retry_count = 0
+        self._last_decrease = 0.0
+        self._condition = None
+        self._condition_loop = None
+    
+    def _get_condition(self):
+        # asyncio primitives belong to the loop they were created on, see GraphTokenProvider
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition = asyncio.Condition()
+            self._condition_loop = loop
+            self.in_flight = 0
+        return self._condition
+    
+    async def acquire(self):
+        """
+        Wait for a free slot and for any Retry-After pause to pass
+        """
+        condition = self._get_condition()
+        async with condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(condition.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < max(int(self.limit), self.minimum):
+                    self.in_flight += 1
+                    return
+                await condition.wait()
+    
+    async def release(self):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight = max(self.in_flight - 1, 0)
+            condition.notify_all()
+    
+    def on_success(self):
+        # Additive increase: one more slot per full window of successful calls,
+        # once the last throttled call is a few seconds behind us
+        if time.monotonic() - self._last_decrease >= GRAPH_INCREASE_COOLDOWN_SECONDS:
+            self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+    
+    def on_throttled(self, retry_after, status=429):
+        """
+        Pause all callers for retry_after seconds and halve the number of slots
+        """
+        now = time.monotonic()
+        self.throttled_count += 1
+        self.paused_until = max(self.paused_until, now + retry_after)
+        
+        # Multiplicative decrease, at most once per second so one burst of 429s
+        # does not collapse the limit to the minimum
+        if now - self._last_decrease >= 1.0:
+            previous = self.limit
+            self.limit = max(self.limit / 2, self.minimum)
+            self._last_decrease = now
+            print(f"Graph throttled (HTTP {status}), pausing {retry_after:.1f}s, "
+                  f"concurrency limit {previous:.0f} -> {self.limit:.0f}")
+
+# Throttling controllers shared by every caller in the process, one per app registration
+_graph_throttles = {}
+
+def get_graph_throttle(tenant_id, client_id):
+    """
+    Get the process-wide throttling controller for the given app registration
+    """
+    key = (tenant_id, client_id)
+    throttle = _graph_throttles.get(key)
+    if throttle is None:
+        throttle = GraphThrottle()
+        _graph_throttles[key] = throttle
+    return throttle
+
+# HTTP session shared by every Graph call in the process
+_http_session = None
+_http_session_loop = None
+
+async def get_http_session():
+    """
+    Get the process-wide aiohttp session used for Microsoft Graph calls
+    
+    The session keeps a pool of keep-alive connections to Graph, so concurrent callers
+    reuse connections instead of opening a new one per request. A new session is
+    created when the previous one was closed or belongs to another event loop.
+    """
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS),
+            trace_configs=list(HTTP_TRACE_CONFIGS)
+        )
+        _http_session_loop = loop
+    return _http_session
+
+async def close_http_session():
+    """
+    Close the shared HTTP session and its pooled connections
+    """
+    global _http_session, _http_session_loop
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+    _http_session_loop = None
+
+async def graph_request(method, url, tenant_id, client_id, client_secret, json_body=None, params=None, max_retries=GRAPH_MAX_RETRIES):
+    """
+    Send a request to Microsoft Graph over the shared HTTP session
+    
+    The call goes through the app registration's GraphThrottle. Throttled (429/503)
+    and failed (5xx, connection error) calls are retried after the Retry-After from
+    Graph or a jittered backoff.
+    
+    Args:
+        method (str): HTTP method
+        url (str): Absolute URL (e.g. an @odata.nextLink) or path relative to /v1.0
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        json_body (dict, optional): JSON request body
+        params (dict, optional): Query string parameters
+        max_retries (int, optional): How many times a throttled or failed call is retried
+        
+    Returns:
+        GraphResponse: Status, headers and body of the last response
+    """
+    if not url.startswith("http"):
+        url = f"{GRAPH_BASE_URL}{url}"
+    
+    # One span per call, covering every retry and the time spent waiting between them
+    with trace_span(graph_operation_name(method, url)) as span:
+        throttle = get_graph_throttle(tenant_id, client_id)
+        attempt = 0
+        while True:
+            await throttle.acquire()
+            try:
+                # Get the shared access token for direct API call
+                token = await get_graph_token(tenant_id, client_id, client_secret)
+                headers = {"Authorization": f"Bearer {token}"}
+                if json_body is not None:
+                    headers["Content-Type"] = "application/json"
+                
+                session = await get_http_session()
+                async with session.request(method, url, headers=headers, json=json_body, params=params) as http_response:
+                    text = await http_response.text()
+                    response = GraphResponse(http_response.status, dict(http_response.headers), text)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= max_retries:
+                    span["retries"] = attempt
+                    raise
+                response = None
+            finally:
+                await throttle.release()
+            
+            if response is not None and response.status not in RETRYABLE_STATUS_CODES:
+                throttle.on_success()
+                span.update(status=response.status, retries=attempt)
+                return response
+            if response is not None and attempt >= max_retries:
+                span.update(status=response.status, retries=attempt)
+                return response
+            
+            wait_seconds = _retry_after_seconds(response.headers if response is not None else None, attempt)
+            if response is not None and response.status in THROTTLED_STATUS_CODES:
+                # Pause every caller, then spread the retries out a little
+                throttle.on_throttled(wait_seconds, response.status)
+                wait_seconds *= random.uniform(1, 1.25)
+            throttle.retry_count += 1
+            attempt += 1
+            await asyncio.sleep(wait_seconds)
 
 def get_email_handle(email):
     """
-    Extract the handle part from an email address (before the @ symbol)
+    Extract the handle part from an email address (before the @ symbol)
+    """
+    if not email:
+        return None
+    match = re.match(r'^([^@]+)@', email.lower())
+    return match.group(1) if match else None
+
+# Largest page sizes Graph allows when listing users and group members
+USERS_PAGE_SIZE = 999
+GROUP_MEMBERS_PAGE_SIZE = 999
+
+# Member fields the membership and cleanup steps need
+GROUP_MEMBER_FIELDS = ("id", "displayName", "mail")
+
+async def iter_graph_pages(url, tenant_id, client_id, client_secret, params=None):
+    """
+    Yield every item of a paged Graph collection, following @odata.nextLink
+    
+    Only one page is held in memory at a time.
+    
+    Args:
+        url (str): Collection URL, absolute or relative to /v1.0
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        params (dict, optional): Query parameters of the first request
+    """
+    while url:
+        response = await graph_request("GET", url, tenant_id, client_id, client_secret, params=params)
+        if response.status != 200:
+            raise Exception(f"Failed to list {url}: HTTP {response.status}: {response.text}")
+        
+        page = response.json()
+        for item in page.get("value", []):
+            yield item
+        
+        # The next link already carries the query parameters
+        url = page.get("@odata.nextLink")
+        params = None
+
+def iter_group_members(group_id, tenant_id, client_id, client_secret, select=GROUP_MEMBER_FIELDS):
+    """
+    Stream all members of a group, requesting the largest page size Graph allows
+    
+    Args:
+        group_id (str): ID of the group to list
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        select (tuple, optional): Member fields to return, @odata.type is always included
+        
+    Returns:
+        async iterator: Member dictionaries
+    """
+    params = {"$top": GROUP_MEMBERS_PAGE_SIZE, "$select": ",".join(select)}
+    return iter_graph_pages(f"/groups/{group_id}/members", tenant_id, client_id, client_secret, params=params)
+
+# Where delta links and the state they apply to are kept between runs
+DELTA_STATE_DIR = "./data/delta_state"
+
+# User fields kept by the delta-synced tenant snapshot
+USER_DELTA_FIELDS = ("id", "userPrincipalName", "mail", "displayName")
+
+def _load_delta_state(state_path):
+    if not os.path.isfile(state_path):
+        return None
+    try:
+        with open(state_path, "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except ValueError:
+        print(f"Ignoring unreadable delta state {state_path}")
+        return None
+
+def _save_delta_state(state_path, state):
+    # Write next to the old file and swap, so an interrupted run keeps the previous state
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_path, state_path)
+
+async def read_graph_delta(url, tenant_id, client_id, client_secret, apply, params=None):
+    """
+    Follow a Graph delta query through all its pages up to the next delta link
+    
+    Args:
+        url (str): Initial delta URL (e.g. /users/delta) or a saved @odata.deltaLink
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        apply (callable): Called with every changed item, removed items carry "@removed"
+        params (dict, optional): Query parameters of the first request
+        
+    Returns:
+        str: The @odata.deltaLink to resume from next time, or None when Graph no longer
+            knows the saved delta link and a full sync is needed
+    """
+    while url:
+        response = await graph_request("GET", url, tenant_id, client_id, client_secret, params=params)
+        
+        # An expired delta link answers 410 Gone (or 400 with a resync error code)
+        if response.status == 410 or (response.status == 400 and "sync" in response.text.lower()):
+            return None
+        if response.status != 200:
+            raise Exception(f"Failed to read delta query: HTTP {response.status}: {response.text}")
+        
+        data = response.json()
+        for item in data.get("value", []):
+            apply(item)
+        
+        if "@odata.deltaLink" in data:
+            return data["@odata.deltaLink"]
+        
+        # The next link already carries the query parameters
+        url = data.get("@odata.nextLink")
+        params = None
+    
+    raise Exception("Delta query ended without a delta link")
+
+class TenantUserIndex:
+    """
+    In-memory snapshot of the tenant's users, indexed by userPrincipalName and mail
+    
+    The snapshot is read once with a paged /users listing (load) or brought up to date
+    from the previous run with a /users delta query (sync), and then answers existence
+    checks locally. Callers keep it current by adding users they create and removing
+    users they delete during the run.
+    """
+    
+    def __init__(self):
+        self.clear()
+    
+    def clear(self):
+        self.users = {}
+        self.by_upn = {}
+        self.by_mail = {}
+    
+    @classmethod
+    async def load(cls, tenant_id, client_id, client_secret):
+        """
+        Page through /users once and build the index
+        
+        Args:
+            tenant_id (str): Microsoft Entra ID tenant ID
+            client_id (str): Application ID for authentication
+            client_secret (str): Application secret for authentication
+            
+        Returns:
+            TenantUserIndex: Index of every user in the tenant
+        """
+        index = cls()
+        params = {"$select": "id,userPrincipalName,mail", "$top": USERS_PAGE_SIZE}
+        async for user in iter_graph_pages("/users", tenant_id, client_id, client_secret, params=params):
+            index.add(user)
+        
+        print(f"Loaded {len(index.users)} tenant users")
+        return index
+    
+    @classmethod
+    async def sync(cls, tenant_id, client_id, client_secret, state_path=None):
+        """
+        Build the index from the snapshot saved by the previous run plus a /users delta query
+        
+        Only users added, changed or deleted since the saved delta link are downloaded.
+        Without saved state, or when the delta link expired, every user is read once
+        through the delta query to start a new chain. The updated snapshot and delta link
+        are saved for the next run.
+        
+        Args:
+            tenant_id (str): Microsoft Entra ID tenant ID
+            client_id (str): Application ID for authentication
+            client_secret (str): Application secret for authentication
+            state_path (str, optional): Snapshot file, defaults to users.json in DELTA_STATE_DIR
+            
+        Returns:
+            TenantUserIndex: Index of every user in the tenant
+        """
+        state_path = state_path or os.path.join(DELTA_STATE_DIR, "users.json")
+        index = cls()
+        changes = 0
+        
+        def apply(item):
+            nonlocal changes
+            changes += 1
+            if "@removed" in item:
+                index.remove(item["id"])
+            else:
+                # Delta pages may only carry the changed fields, merge them into what we have
+                fields = {key: value for key, value in item.items() if not key.startswith("@")}
+                index.add({**index.users.get(item["id"], {}), **fields})
+        
+        delta_link = None
+        state = _load_delta_state(state_path)
+        if state and state.get("delta_link"):
+            for user in state.get("users", []):
+                index.add(user)
+            delta_link = await read_graph_delta(state["delta_link"], tenant_id, client_id, client_secret, apply)
+            if delta_link is None:
+                print("Saved users delta link expired, running a full sync")
+                index.clear()
+                changes = 0
+        
+        if delta_link is None:
+            params = {"$select": ",".join(USER_DELTA_FIELDS)}
+            delta_link = await read_graph_delta("/users/delta", tenant_id, client_id, client_secret, apply, params=params)
+        
+        _save_delta_state(state_path, {"delta_link": delta_link, "users": list(index.users.values())})
+        print(f"Synced {len(index.users)} tenant users ({changes} changes downloaded)")
+        return index
+    
+    def add(self, user):
+        """
+        Add or update a user given as a Graph user dict with id, userPrincipalName and mail
+        """
+        user_id = user.get("id")
+        if not user_id:
+            return
+        self.remove(user_id)
+        self.users[user_id] = user
+        if user.get("userPrincipalName"):
+            self.by_upn[user["userPrincipalName"].lower()] = user_id
+        if user.get("mail"):
+            self.by_mail[user["mail"].lower()] = user_id
+    
+    def remove(self, user_id):
+        """
+        Remove a user from the index by ID
+        """
+        user = self.users.pop(user_id, None)
+        if user is None:
+            return
+        if user.get("userPrincipalName") and self.by_upn.get(user["userPrincipalName"].lower()) == user_id:
+            del self.by_upn[user["userPrincipalName"].lower()]
+        if user.get("mail") and self.by_mail.get(user["mail"].lower()) == user_id:
+            del self.by_mail[user["mail"].lower()]
+    
+    def find_by_upn(self, user_principal_name):
+        return self.by_upn.get((user_principal_name or "").lower())
+    
+    def find_by_mail(self, mail):
+        return self.by_mail.get((mail or "").lower())
+
+class GroupMemberSnapshot:
+    """
+    Membership of one group kept current between runs with a /groups delta query
+    
+    Graph has no delta query on /groups/{id}/members, so the snapshot runs /groups/delta
+    filtered to the one group and applies its members@delta changes. Those changes only
+    carry member IDs and types; names and emails come from a TenantUserIndex.
+    """
+    
+    def __init__(self, group_id):
+        self.group_id = group_id
+        self.members = {}
+    
+    @classmethod
+    async def sync(cls, group_id, tenant_id, client_id, client_secret, state_path=None):
+        """
+        Build the snapshot from the previous run's state plus the membership changes since
+        
+        Args:
+            group_id (str): ID of the group to follow
+            tenant_id (str): Microsoft Entra ID tenant ID
+            client_id (str): Application ID for authentication
+            client_secret (str): Application secret for authentication
+            state_path (str, optional): Snapshot file, defaults to group-<ID>.json in DELTA_STATE_DIR
+            
+        Returns:
+            GroupMemberSnapshot: Current members of the group
+        """
+        state_path = state_path or os.path.join(DELTA_STATE_DIR, f"group-{group_id}.json")
+        snapshot = cls(group_id)
+        changes = 0
+        
+        def apply(group):
+            nonlocal changes
+            if group.get("id") != group_id:
+                return
+            if "@removed" in group:
+                snapshot.members.clear()
+                return
+            for member in group.get("members@delta", []):
+                changes += 1
+                if "@removed" in member:
+                    snapshot.members.pop(member["id"], None)
+                else:
+                    snapshot.members[member["id"]] = member.get("@odata.type")
+        
+        delta_link = None
+        state = _load_delta_state(state_path)
+        if state and state.get("delta_link"):
+            snapshot.members = dict(state.get("members", {}))
+            delta_link = await read_graph_delta(state["delta_link"], tenant_id, client_id, client_secret, apply)
+            if delta_link is None:
+                print(f"Saved delta link of group {group_id} expired, running a full sync")
+                snapshot.members = {}
+                changes = 0
+        
+        if delta_link is None:
+            params = {"$filter": f"id eq '{group_id}'", "$select": "members"}
+            delta_link = await read_graph_delta("/groups/delta", tenant_id, client_id, client_secret, apply, params=params)
+        
+        _save_delta_state(state_path, {"delta_link": delta_link, "members": snapshot.members})
+        print(f"Synced {len(snapshot.members)} members of group {group_id} ({changes} changes downloaded)")
+        return snapshot
+    
+    def list_members(self, user_index=None):
+        """
+        List the members in the same shape as iter_group_members
+        
+        Args:
+            user_index (TenantUserIndex, optional): Source of displayName and mail; user
+                members it no longer holds (deleted during this run) are left out
+            
+        Returns:
+            list: Member dictionaries with id, @odata.type, displayName and mail
+        """
+        members = []
+        for member_id, odata_type in self.members.items():
+            member = {"id": member_id, "@odata.type": odata_type}
+            if user_index is not None and odata_type == "#microsoft.graph.user":
+                user = user_index.users.get(member_id)
+                if user is None:
+                    continue
+                member["displayName"] = user.get("displayName")
+                member["mail"] = user.get("mail")
+            members.append(member)
+        return members
+
+async def check_user_exists(user_principal_name, tenant_id, client_id, client_secret, user_index=None):
+    """
+    Check if a user with the given principal name already exists in the Entra ID tenant
+    
+    Args:
+        user_principal_name (str): The user principal name to check
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        user_index (TenantUserIndex, optional): Tenant snapshot to answer from instead of Graph
+        
+    Returns:
+        tuple: (exists, user_id) where exists is a boolean and user_id is the ID if the user exists
+    """
+    if user_index is not None:
+        user_id = user_index.find_by_upn(user_principal_name)
+        return user_id is not None, user_id
+    
+    try:
+        # Check if user exists using direct HTTP request
+        # Use filter to search by userPrincipalName
+        response = await graph_request(
+            "GET",
+            "/users",
+            tenant_id,
+            client_id,
+            client_secret,
+            params={"$filter": f"userPrincipalName eq '{user_principal_name}'"}
+        )
+        
+        if response.status == 200:
+            users = response.json().get('value', [])
+            
+            if users and len(users) > 0:
+                # User exists
+                return True, users[0].get('id')
+            else:
+                # User doesn't exist
+                return False, None
+        else:
+            print(f"Failed to check if user exists: HTTP {response.status}")
+            return False, None
+                
+    except Exception as e:
+        print(f"Error checking if user exists: {str(e)}")
+        return False, None
+
+class StageStats:
+    """
+    Collect per-stage timings of a pipeline run and report their throughput
+    """
+    
+    def __init__(self):
+        self.stages = {}
+    
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """
+        Time one execution of a pipeline stage
+        
+        Args:
+            stage (str): Name of the stage being timed
+        """
+        started = time.perf_counter()
+        try:
+            # Spans recorded while the stage runs are attributed to it
+            with trace_stage(stage):
+                yield
+        finally:
+            self.record(stage, started, time.perf_counter())
+    
+    def record(self, stage, started, finished):
+        stats = self.stages.setdefault(stage, {
+            "count": 0,
+            "busy_seconds": 0.0,
+            "first_start": started,
+            "last_end": finished
+        })
+        stats["count"] += 1
+        stats["busy_seconds"] += finished - started
+        stats["first_start"] = min(stats["first_start"], started)
+        stats["last_end"] = max(stats["last_end"], finished)
+    
+    def summary(self):
+        """
+        Returns:
+            dict: Per-stage count, wall time, throughput and average latency
+        """
+        summary = {}
+        for stage, stats in self.stages.items():
+            wall_seconds = max(stats["last_end"] - stats["first_start"], 1e-9)
+            summary[stage] = {
+                "count": stats["count"],
+                "wall_seconds": wall_seconds,
+                "per_second": stats["count"] / wall_seconds,
+                "avg_ms": stats["busy_seconds"] / stats["count"] * 1000
+            }
+        return summary
+    
+    def report(self):
+        print("=== STAGE THROUGHPUT ===")
+        for stage, stats in self.summary().items():
+            print(f"{stage}: {stats['count']} ops in {stats['wall_seconds']:.1f}s "
+                  f"({stats['per_second']:.1f}/s, avg {stats['avg_ms']:.0f} ms)")
+
+async def iterate_async(items):
+    """
+    Iterate over a regular or an async iterable
+    """
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+async def run_bounded(items, worker, concurrency):
+    """
+    Await worker(item) for every item with at most `concurrency` calls in flight
+    
+    Items are consumed lazily, so a large CSV reader or a paged Graph listing is never
+    loaded into memory as a whole.
+    
+    Args:
+        items (iterable): Regular or async iterable of work items
+        worker (callable): Coroutine function called with each item
+        concurrency (int): Maximum number of worker calls running at once
+        
+    Returns:
+        list: Worker results in the same order as the items
+    """
+    concurrency = max(1, int(concurrency or 1))
+    results = {}
+    pending = set()
+    count = 0
+    
+    async def run(index, item):
+        results[index] = await worker(item)
+    
+    try:
+        async for item in iterate_async(items):
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            pending.add(asyncio.create_task(run(count, item)))
+            count += 1
+        
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            for task in done:
+                task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    
+    return [results[index] for index in range(count)]
+
+# Licenses every onboarded user gets
+ONBOARDING_LICENSE_SKUS = [
+    LICENSE_SKUIDS["MICROSOFT_COPILOT_STUDIO_VIRAL_TRIAL"],
+    LICENSE_SKUIDS["MICROSOFT_POWER_APPS_DEV"]
+]
+
+# Mailchimp export columns the onboarding reads, every other column is never materialized
+REGISTRATION_EMAIL_COLUMN = "Email Address"
+REGISTRATION_FIRST_NAME_COLUMN = "First Name"
+REGISTRATION_LAST_NAME_COLUMN = "Last Name"
+
+# One registration row reduced to what onboarding needs
+Registration = namedtuple("Registration", ["email", "first_name", "last_name", "handle"])
+
+def iter_registrations(csv_file_path, stats=None):
+    """
+    Stream the registrations of a Mailchimp export as compact, deduplicated records
+    
+    Only the email and name columns are picked out of each row, so memory stays flat no
+    matter how many rows or columns the export has. Emails are trimmed and lowercased;
+    rows without an email or first name, and rows whose email or handle was already seen,
+    are skipped (two emails with the same handle would map to the same user principal name).
+    
+    Args:
+        csv_file_path (str): Path to the Mailchimp registration export
+        stats (dict, optional): Filled with rows, registrations, incomplete,
+            duplicate_emails and duplicate_handles counts as the file is read
+        
+    Yields:
+        Registration: email, first_name, last_name and handle of one registration
+    """
+    if stats is None:
+        stats = {}
+    stats.update({"rows": 0, "registrations": 0, "incomplete": 0, "duplicate_emails": 0, "duplicate_handles": 0})
+    seen_emails = set()
+    seen_handles = set()
+    
+    # Only the time spent reading is traced, not the time the consumer holds each record
+    read_seconds = 0.0
+    resumed_at = time.perf_counter()
+    
+    # utf-8-sig drops the byte order mark some exports start with
+    with open(csv_file_path, "r", encoding="utf-8-sig", newline="") as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        try:
+            email_index = header.index(REGISTRATION_EMAIL_COLUMN)
+            first_name_index = header.index(REGISTRATION_FIRST_NAME_COLUMN)
+        except ValueError as e:
+            raise Exception(f"{csv_file_path} is missing a required column: {str(e)}")
+        columns = [email_index, first_name_index]
+        if REGISTRATION_LAST_NAME_COLUMN in header:
+            columns.append(header.index(REGISTRATION_LAST_NAME_COLUMN))
+        
+        # Pick the needed fields out of each row in one C-level call
+        project = operator.itemgetter(*columns)
+        min_length = max(columns) + 1
+        
+        for row in csv_reader:
+            stats["rows"] += 1
+            if len(row) < min_length:
+                stats["incomplete"] += 1
+                continue
+            fields = project(row)
+            email = fields[0].strip().lower()
+            first_name = fields[1].strip()
+            last_name = fields[2].strip() if len(fields) > 2 else ""
+            
+            # Skip empty rows or rows with missing essential data
+            handle, at, _ = email.partition("@")
+            if not first_name or not handle or not at:
+                stats["incomplete"] += 1
+                continue
+            
+            if email in seen_emails:
+                stats["duplicate_emails"] += 1
+                continue
+            seen_emails.add(email)
+            
+            if handle in seen_handles:
+                stats["duplicate_handles"] += 1
+                print(f"Skipping {email}: handle {handle} is already used by another registration")
+                continue
+            seen_handles.add(handle)
+            
+            stats["registrations"] += 1
+            read_seconds += time.perf_counter() - resumed_at
+            yield Registration(email, first_name, last_name, handle)
+            resumed_at = time.perf_counter()
+    
+    read_seconds += time.perf_counter() - resumed_at
+    tracer.record("csv read", read_seconds * 1000, path=csv_file_path, rows=stats["rows"])
+
+async def create_entra_users_from_csv(csv_file_path, tenant_id, client_id, client_secret, smtp_server=None, smtp_port=None, sender_email=None, sender_password=None, concurrency=1, user_index=None, outbox=None, journal=None, sku_catalog=None, license_mode="user"):
+    """
+    Load CSV file with subscriber data and create Microsoft Entra ID users
+    
+    Rows are streamed through iter_registrations in chunks of GRAPH_BATCH_SIZE and every
+    chunk is processed as a pipeline: existence checks, one $batch envelope creating the
+    new users, one assigning their licenses, then the welcome emails. Up to `concurrency`
+    chunks are in flight at once, the default of 1 handles them one after another.
+    
+    Args:
+        csv_file_path (str): Path to the CSV file with subscriber data
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        smtp_server (str, optional): SMTP server for sending welcome emails
+        smtp_port (int, optional): SMTP server port
+        sender_email (str, optional): Email address to send welcome emails from
+        sender_password (str, optional): Password for sender email account
+        concurrency (int, optional): Maximum number of chunks of rows processed at the same time
+        user_index (TenantUserIndex, optional): Tenant snapshot used for existence checks,
+            updated with every user created here
+        outbox (EmailOutbox, optional): Queue welcome emails here instead of sending them
+            inline, so provisioning does not wait for the SMTP server
+        journal (OnboardingJournal, optional): Checkpoint journal; stages it already holds
+            for a row are skipped and new stages are recorded in it
+        sku_catalog (SkuCatalog, optional): License seats to check before every assignment,
+            once a SKU runs out the remaining users are not sent to Graph
+        license_mode (str, optional): "user" assigns licenses to every user, "group" leaves
+            it to group-based licensing on the learners group (see ensure_group_licenses)
+        
+    Returns:
+        list: List of dictionaries with results of user creation operations
+    """
+    stage_stats = StageStats()
+    
+    # Welcome emails still in the outbox, as (user_info, future) pairs
+    queued_emails = []
+    
+    async def onboard_chunk(registrations):
+        rows = [journal_row(registration) for registration in registrations]
+        
+        # Only resume journaled users that are still in the tenant under the same ID
+        journaled_rows = [row for row in rows if "created" in row["completed"]]
+        if journaled_rows:
+            await resume_rows(journaled_rows)
+        
+        await asyncio.gather(*(check_row(row) for row in rows if row["user_info"] is None))
+        
+        # Rows still without a result are new users, created together
+        new_rows = [row for row in rows if row["user_info"] is None]
+        if new_rows:
+            await create_users(new_rows)
+        
+        created_rows = [row for row in rows if row["user_info"]["status"] == "created"]
+        if created_rows:
+            await license_users(created_rows)
+            await asyncio.gather(*(send_welcome(row) for row in created_rows))
+        
+        return [row["user_info"] for row in rows]
+    
+    def journal_row(registration):
+        # Create new user ID with the handle and aiskillsfest.net domain
+        new_user_principal_name = f"{registration[3]}@aiskillsfest.net"
+        
+        # Stages a previous run already completed for this row
+        entry = journal.get(new_user_principal_name) if journal is not None else None
+        return {
+            "registration": registration,
+            "user_principal_name": new_user_principal_name,
+            "entry": entry,
+            "completed": entry["stages"] if entry else set(),
+            "user_info": None
+        }
+    
+    async def resume_rows(rows):
+        # The snapshot answers without Graph, otherwise the journaled user IDs are read in one $batch
+        if user_index is not None:
+            in_tenant = [user_index.find_by_upn(row["user_principal_name"]) == row["entry"].get("user_id") for row in rows]
+        else:
+            try:
+                responses = await graph_batch(
+                    [
+                        {"id": index, "method": "GET", "url": f"/users/{row['entry'].get('user_id')}?$select=id,userPrincipalName"}
+                        for index, row in enumerate(rows)
+                    ],
+                    tenant_id, client_id, client_secret
+                )
+            except Exception as e:
+                print(f"Error checking {len(rows)} journaled users: {str(e)}")
+                responses = {}
+            in_tenant = []
+            for index, row in enumerate(rows):
+                sub_response = responses.get(str(index), {})
+                found_user_principal_name = sub_response.get("body", {}).get("userPrincipalName") if sub_response.get("status") == 200 else None
+                in_tenant.append((found_user_principal_name or "").lower() == row["user_principal_name"].lower())
+        
+        for row, user_in_tenant in zip(rows, in_tenant):
+            new_user_principal_name = row["user_principal_name"]
+            if not user_in_tenant:
+                print(f"Journaled user {new_user_principal_name} is no longer in the tenant, onboarding it again...")
+                row["completed"] = set()
+                continue
+            
+            print(f"Resuming user {new_user_principal_name} from journal...")
+            row["user_info"] = {
+                "email": row["registration"][0],
+                "new_user_id": new_user_principal_name,
+                "status": "created",
+                "user_id": row["entry"].get("user_id"),
+                "temp_password": row["entry"].get("temp_password"),
+                "resumed": True
+            }
+    
+    async def check_row(row):
+        email = row["registration"][0]
+        new_user_principal_name = row["user_principal_name"]
+        
+        # Check if user already exists
+        print(f"Checking if user {new_user_principal_name} exists...")
+        try:
+            with stage_stats.measure("existence_check"):
+                user_exists, existing_user_id = await check_user_exists(
+                    new_user_principal_name,
+                    tenant_id,
+                    client_id,
+                    client_secret,
+                    user_index=user_index
+                )
+            
+            print(f"Received check response for {new_user_principal_name}: exists={user_exists}")
+            
+            # Make sure we got a valid response
+            if user_exists is None:
+                raise Exception("Failed to determine if user exists")
+            
+            if user_exists:
+                print(f"User {new_user_principal_name} already exists with ID: {existing_user_id}")
+                row["user_info"] = {
+                    "email": email,
+                    "new_user_id": new_user_principal_name,
+                    "status": "skipped",
+                    "reason": "User already exists",
+                    "user_id": existing_user_id
+                }
+            else:
+                print(f"User {new_user_principal_name} does not exist. Will create new user.")
+        except Exception as e:
+            print(f"Error checking if user exists: {str(e)}")
+            row["user_info"] = {
+                "email": email,
+                "new_user_id": new_user_principal_name,
+                "status": "error",
+                "message": f"Error checking if user exists: {str(e)}"
+            }
+    
+    async def create_users(rows):
+        # Generate temporary passwords and the user data of every new user
+        payloads = []
+        temp_passwords = {}
+        for row in rows:
+            email, first_name, last_name, handle = row["registration"]
+            temp_password = generate_temporary_password()
+            temp_passwords[row["user_principal_name"]] = temp_password
+            payloads.append(build_user_payload(email, first_name, last_name, handle, temp_password))
+        
+        # Call Microsoft Graph API to create the users
+        print(f"Creating {len(rows)} users...")
+        try:
+            with stage_stats.measure("create_user"):
+                create_results = await batch_create_users(payloads, tenant_id, client_id, client_secret, user_index=user_index)
+        except Exception as e:
+            print(f"Error creating {len(rows)} users: {str(e)}")
+            create_results = {
+                "success": [],
+                "failed": [{"user_principal_name": row["user_principal_name"], "reason": str(e)} for row in rows]
+            }
+        
+        created_ids = {result["user_principal_name"]: result["user_id"] for result in create_results["success"]}
+        failures = {result["user_principal_name"]: result["reason"] for result in create_results["failed"]}
+        for row in rows:
+            email = row["registration"][0]
+            new_user_principal_name = row["user_principal_name"]
+            if new_user_principal_name not in created_ids:
+                reason = failures.get(new_user_principal_name, "Unknown error")
+                print(f"Failed to create user {new_user_principal_name}: {reason}")
+                row["user_info"] = {
+                    "email": email,
+                    "new_user_id": new_user_principal_name,
+                    "status": "error",
+                    "message": f"Failed to create user: {reason}"
+                }
+                continue
+            
+            user_id = created_ids[new_user_principal_name]
+            temp_password = temp_passwords[new_user_principal_name]
+            print(f"User {new_user_principal_name} created successfully with ID: {user_id}")
+            if journal is not None:
+                # Written before anything else so the temporary password survives a crash
+                journal.record(new_user_principal_name, "created", user_id=user_id, temp_password=temp_password, email=email)
+            row["user_info"] = {
+                "email": email,
+                "new_user_id": new_user_principal_name,
+                "status": "created",
+                "user_id": user_id,
+                "temp_password": temp_password
+            }
+    
+    async def license_users(rows):
+        unlicensed = []
+        for row in rows:
+            user_info = row["user_info"]
+            if "licensed" in row["completed"]:
+                user_info["licenses_assigned"] = True
+            elif license_mode == "group":
+                # Licensed once added to the learners group, only keep count of the seats
+                user_info["licensed_via_group"] = True
+                if sku_catalog is not None:
+                    shortage = sku_catalog.reserve(ONBOARDING_LICENSE_SKUS)
+                    if shortage:
+                        user_info["license_warning"] = shortage
+                        print(f"Warning for {row['user_principal_name']}: {shortage}")
+            else:
+                unlicensed.append(row)
+        
+        if not unlicensed:
+            return
+        
+        # Assign licenses to the new users
+        print(f"Assigning licenses to {len(unlicensed)} users...")
+        try:
+            with stage_stats.measure("assign_licenses"):
+                license_results = await batch_assign_licenses(
+                    [row["user_info"]["user_id"] for row in unlicensed],
+                    ONBOARDING_LICENSE_SKUS,
+                    tenant_id,
+                    client_id,
+                    client_secret,
+                    sku_catalog=sku_catalog
+                )
+        except Exception as e:
+            print(f"Error assigning licenses to {len(unlicensed)} users: {str(e)}")
+            for row in unlicensed:
+                row["user_info"]["licenses_assigned"] = False
+                row["user_info"]["message"] = str(e)
+            return
+        
+        licensed_ids = set(license_results["success"])
+        failures = {failure["user_id"]: failure["reason"] for failure in license_results["failed"]}
+        for row in unlicensed:
+            new_user_principal_name = row["user_principal_name"]
+            user_id = row["user_info"]["user_id"]
+            row["user_info"]["licenses_assigned"] = user_id in licensed_ids
+            if user_id in licensed_ids:
+                print(f"Successfully assigned licenses to {new_user_principal_name}")
+                if journal is not None:
+                    journal.record(new_user_principal_name, "licensed")
+            else:
+                print(f"Failed to assign licenses to {new_user_principal_name}: {failures.get(user_id, 'Unknown error')}")
+    
+    async def send_welcome(row):
+        email, first_name, last_name, handle = row["registration"]
+        new_user_principal_name = row["user_principal_name"]
+        user_info = row["user_info"]
+        temp_password = user_info["temp_password"]
+        try:
+            if "emailed" in row["completed"]:
+                user_info["email_sent"] = True
+            
+            # Queue the welcome email if an outbox is used
+            elif outbox is not None:
+                msg, recipients = build_welcome_email(email, first_name, last_name, new_user_principal_name, temp_password, sender_email)
+                email_sent = outbox.enqueue(msg, recipients, label=email)
+                if journal is not None:
+                    email_sent.add_done_callback(
+                        lambda sent: journal.record(new_user_principal_name, "emailed") if sent.result() else None
+                    )
+                queued_emails.append((user_info, email_sent))
+                print(f"Welcome email to {email} queued")
+            
+            # Otherwise send welcome email if SMTP details are provided
+            elif all([smtp_server, smtp_port, sender_email, sender_password]):
+                print(f"Sending welcome email to {email}...")
+                # smtplib is blocking, run it in a worker thread so other rows keep going
+                loop = asyncio.get_running_loop()
+                with stage_stats.measure("welcome_email"):
+                    email_sent = await loop.run_in_executor(None, functools.partial(
+                        send_welcome_email,
+                        to_email=email,
+                        first_name=first_name,
+                        last_name=last_name,
+                        new_username=new_user_principal_name,
+                        temp_password=temp_password,
+                        smtp_server=smtp_server,
+                        smtp_port=smtp_port,
+                        sender_email=sender_email,
+                        sender_password=sender_password
+                    ))
+                user_info["email_sent"] = email_sent
+                if email_sent and journal is not None:
+                    journal.record(new_user_principal_name, "emailed")
+                print(f"Email {'sent successfully' if email_sent else 'failed to send'}")
+            
+            print(f"User processing complete for {new_user_principal_name}.")
+        except Exception as e:
+            print(f"Error finishing user {new_user_principal_name}: {str(e)}")
+            user_info["message"] = str(e)
+    
+    read_stats = {}
+    try:
+        chunk_results = await run_bounded(
+            _chunks(iter_registrations(csv_file_path, read_stats), GRAPH_BATCH_SIZE), onboard_chunk, concurrency
+        )
+    
+    except Exception as e:
+        print(f"Error processing CSV file: {str(e)}")
+        return []
+    
+    print(f"Read {read_stats['rows']} rows: {read_stats['registrations']} registrations, "
+          f"{read_stats['incomplete']} incomplete, {read_stats['duplicate_emails']} duplicate emails, "
+          f"{read_stats['duplicate_handles']} duplicate handles")
+    
+    # Wait for the queued welcome emails to record whether they were sent
+    for user_info, email_sent in queued_emails:
+        user_info["email_sent"] = await email_sent
+    
+    stage_stats.report()
+    if sku_catalog is not None:
+        sku_catalog.report(ONBOARDING_LICENSE_SKUS)
+    
+    return [user_info for chunk in chunk_results for user_info in chunk]
+
+def generate_temporary_password(length=12):
+    """
+    Generate a secure temporary password for new users
+    """
+    alphabet = string.ascii_letters + string.digits + string.punctuation
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+async def add_users_to_group(users, group_id, tenant_id, client_id, client_secret):
+    """
+    Add multiple users to an Entra ID group
+    
+    Args:
+        users (list): List of user IDs to add to the group
+        group_id (str): ID of the group to add users to
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        
+    Returns:
+        dict: Results of group addition operations
+    """
+    results = {"success": [], "failed": []}
+    for user_id in users:
+        try:
+            print(f"Adding user {user_id} to group...")
+            
+            # Create the request body to add a user to a group
+            request_body = {
+                "@odata.id": f"{GRAPH_BASE_URL}/directoryObjects/{user_id}"
+            }
+            
+            # Add member to group using direct HTTP request
+            response = await graph_request(
+                "POST",
+                f"/groups/{group_id}/members/$ref",
+                tenant_id,
+                client_id,
+                client_secret,
+                json_body=request_body
+            )
+            
+            # 204 No Content is success for this operation
+            if response.status == 204:
+                results["success"].append(user_id)
+            else:
+                results["failed"].append({
+                    "user_id": user_id,
+                    "reason": f"HTTP {response.status}: {response.text}"
+                })
+                
+        except Exception as e:
+            results["failed"].append({
+                "user_id": user_id,
+                "reason": str(e)
+            })
+    
+    return results
+
+async def remove_user_from_group(user_id, group_id, tenant_id, client_id, client_secret):
+    """
+    Remove a user from an Entra ID group
+    
+    Args:
+        user_id (str): ID of the user to remove from the group
+        group_id (str): ID of the group to remove the user from
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        
+    Returns:
+        dict: Result of the operation
+    """
+    result = {"success": False}
+    
+    try:
+        # Remove member from group using direct HTTP request
+        response = await graph_request(
+            "DELETE",
+            f"/groups/{group_id}/members/{user_id}/$ref",
+            tenant_id,
+            client_id,
+            client_secret
+        )
+        
+        # 204 No Content is success for this operation
+        if response.status == 204:
+            result["success"] = True
+            print(f"User {user_id} removed from group {group_id} successfully")
+        else:
+            result["success"] = False
+            result["reason"] = f"HTTP {response.status}: {response.text}"
+            print(f"Failed to remove user from group: HTTP {response.status}")
+                
+    except Exception as e:
+        result["success"] = False
+        result["reason"] = str(e)
+        print(f"Error removing user from group: {str(e)}")
+    
+    return result
+
+async def remove_users_from_group(users, group_id, tenant_id, client_id, client_secret):
+    """
+    Remove multiple users from an Entra ID group
+    
+    Args:
+        users (list): List of user IDs to remove from the group
+        group_id (str): ID of the group to remove users from
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        
+    Returns:
+        dict: Results of group removal operations
+    """
+    results = {"success": [], "failed": []}
+    
+    for user_id in users:
+        result = await remove_user_from_group(
+            user_id, 
+            group_id, 
+            tenant_id, 
+            client_id, 
+            client_secret
+        )
+        
+        if result["success"]:
+            results["success"].append(user_id)
+        else:
+            results["failed"].append({
+                "user_id": user_id,
+                "reason": result.get("reason", "Unknown error")
+            })
+    
+    return results
+
+async def delete_user_from_tenant(user_id, tenant_id, client_id, client_secret, user_index=None):
+    """
+    Delete a user from the Microsoft Entra ID tenant
+    
+    Args:
+        user_id (str): ID of the user to delete
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        user_index (TenantUserIndex, optional): Tenant snapshot to remove the user from
+        
+    Returns:
+        dict: Result of the operation
     """
-    if not email:
+    result = {"success": False}
+    
+    try:
+        # Delete user using direct HTTP request
+        response = await graph_request("DELETE", f"/users/{user_id}", tenant_id, client_id, client_secret)
+        
+        # 204 No Content is success for this operation
+        if response.status == 204:
+            result["success"] = True
+            if user_index is not None:
+                user_index.remove(user_id)
+            print(f"User {user_id} deleted successfully from the tenant")
+        else:
+            result["success"] = False
+            result["reason"] = f"HTTP {response.status}: {response.text}"
+            print(f"Failed to delete user: HTTP {response.status}")
+                
+    except Exception as e:
+        result["success"] = False
+        result["reason"] = str(e)
+        print(f"Error deleting user: {str(e)}")
+    
+    return result
+
+async def delete_users_from_tenant(users, tenant_id, client_id, client_secret, user_index=None):
+    """
+    Delete multiple users from the Microsoft Entra ID tenant
+    
+    Args:
+        users (list): List of user IDs to delete
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        user_index (TenantUserIndex, optional): Tenant snapshot to remove deleted users from
+        
+    Returns:
+        dict: Results of user deletion operations
+    """
+    results = {"success": [], "failed": []}
+    
+    for user_id in users:
+        result = await delete_user_from_tenant(
+            user_id, 
+            tenant_id, 
+            client_id, 
+            client_secret,
+            user_index=user_index
+        )
+        
+        if result["success"]:
+            results["success"].append(user_id)
+        else:
+            results["failed"].append({
+                "user_id": user_id,
+                "reason": result.get("reason", "Unknown error")
+            })
+    
+    return results
+
+# Text of the Graph error returned when a SKU has no units left
+NO_LICENSES_ERROR_TEXT = "does not have any available licenses"
+
+class SkuCatalog:
+    """
+    The tenant's subscribed SKUs and their free seats, loaded once per run
+    
+    Seats are counted down locally as licenses are handed out, so once a SKU runs out
+    the remaining assignments are skipped with a clear reason instead of being sent to
+    Graph only to fail. SKUs can be named by their license_skuids.py name, their
+    skuPartNumber or their ID.
+    """
+    
+    def __init__(self, subscribed_skus):
+        """
+        Args:
+            subscribed_skus (list): Items of GET /subscribedSkus
+        """
+        self.skus = {}
+        self.by_name = {name.upper(): sku_id for name, sku_id in LICENSE_SKUIDS.items()}
+        for sku in subscribed_skus:
+            sku_id = sku["skuId"]
+            enabled = (sku.get("prepaidUnits") or {}).get("enabled", 0)
+            self.skus[sku_id] = {
+                "part_number": sku.get("skuPartNumber"),
+                "enabled": enabled,
+                "consumed": sku.get("consumedUnits", 0),
+                "remaining": max(enabled - sku.get("consumedUnits", 0), 0),
+                "assigned": 0,
+                "skipped": 0
+            }
+            if sku.get("skuPartNumber"):
+                self.by_name[sku["skuPartNumber"].upper()] = sku_id
+    
+    @classmethod
+    async def load(cls, tenant_id, client_id, client_secret):
+        """
+        Read /subscribedSkus and build the catalog
+        
+        Args:
+            tenant_id (str): Microsoft Entra ID tenant ID
+            client_id (str): Application ID for authentication
+            client_secret (str): Application secret for authentication
+            
+        Returns:
+            SkuCatalog: Catalog of the tenant's SKUs
+        """
+        response = await graph_request("GET", "/subscribedSkus", tenant_id, client_id, client_secret)
+        if response.status != 200:
+            raise Exception(f"Failed to read subscribed SKUs: HTTP {response.status}: {response.text}")
+        catalog = cls(response.json().get("value", []))
+        print(f"Loaded {len(catalog.skus)} subscribed SKUs")
+        return catalog
+    
+    def resolve(self, sku):
+        """
+        Get the SKU ID for a license_skuids.py name, a skuPartNumber or an ID
+        """
+        if sku in self.skus:
+            return sku
+        sku_id = self.by_name.get(sku.upper())
+        if sku_id is None:
+            # Not a known name, take it as an ID the tenant may simply not subscribe to
+            return sku
+        return sku_id
+    
+    def name(self, sku_id):
+        sku = self.skus.get(sku_id)
+        return sku["part_number"] if sku and sku["part_number"] else sku_id
+    
+    def remaining(self, sku_id):
+        sku = self.skus.get(self.resolve(sku_id))
+        return sku["remaining"] if sku else 0
+    
+    def reserve(self, sku_ids, count=1):
+        """
+        Take `count` seats of every given SKU, or none if any of them is short
+        
+        Args:
+            sku_ids (list): SKU IDs or names that are assigned together
+            count (int): Number of users the seats are for
+            
+        Returns:
+            str: None when the seats were taken, otherwise why not
+        """
+        sku_ids = [self.resolve(sku_id) for sku_id in sku_ids]
+        for sku_id in sku_ids:
+            sku = self.skus.get(sku_id)
+            if sku is None:
+                return f"License {sku_id} is not subscribed in this tenant"
+            if sku["remaining"] < count:
+                sku["skipped"] += count
+                return f"No seats left for license {self.name(sku_id)} ({sku['remaining']} remaining, {count} needed)"
+        for sku_id in sku_ids:
+            self.skus[sku_id]["remaining"] -= count
+            self.skus[sku_id]["assigned"] += count
         return None
-    match = re.match(r'^([^@]+)@', email.lower())
-    return match.group(1) if match else None
+    
+    def release(self, sku_ids, count=1):
+        """
+        Give back seats taken by reserve for assignments that failed
+        """
+        for sku_id in (self.resolve(sku_id) for sku_id in sku_ids):
+            sku = self.skus.get(sku_id)
+            if sku is not None:
+                sku["remaining"] += count
+                sku["assigned"] -= count
+    
+    def mark_exhausted(self, failure_text, sku_ids):
+        """
+        Drop the local seat count to zero when Graph reports that a SKU ran out
+        """
+        if NO_LICENSES_ERROR_TEXT not in (failure_text or ""):
+            return
+        for sku_id in (self.resolve(sku_id) for sku_id in sku_ids):
+            sku = self.skus.get(sku_id)
+            if sku is not None and sku_id in failure_text:
+                sku["remaining"] = 0
+    
+    def report(self, sku_ids=None):
+        """
+        Print the seats of the given SKUs (all by default) and what this run did with them
+        """
+        sku_ids = [self.resolve(sku_id) for sku_id in sku_ids] if sku_ids else list(self.skus)
+        print("=== LICENSE SEATS ===")
+        for sku_id in sku_ids:
+            sku = self.skus.get(sku_id)
+            if sku is None:
+                print(f"{sku_id}: not subscribed")
+                continue
+            print(f"{self.name(sku_id)}: {sku['enabled']} enabled, {sku['consumed']} used before this run, "
+                  f"{sku['assigned']} assigned now, {sku['remaining']} remaining, {sku['skipped']} users skipped")
+
+# How onboarded users get their licenses: one assignLicense call per user, or through
+# group-based licensing on the learners group, where membership alone grants them
+LICENSE_MODES = ("user", "group")
 
-async def check_user_exists(user_principal_name, tenant_id, client_id, client_secret):
+async def get_group_licenses(group_id, tenant_id, client_id, client_secret):
     """
-    Check if a user with the given principal name already exists in the Entra ID tenant
+    Read the SKU IDs a group assigns to its members through group-based licensing
     
     Args:
-        user_principal_name (str): The user principal name to check
+        group_id (str): ID of the group
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
         
     Returns:
-        tuple: (exists, user_id) where exists is a boolean and user_id is the ID if the user exists
+        set: SKU IDs assigned to the group
     """
-    # Initialize credentials
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
+    response = await graph_request(
+        "GET", f"/groups/{group_id}", tenant_id, client_id, client_secret,
+        params={"$select": "id,assignedLicenses"}
     )
+    if response.status != 200:
+        raise Exception(f"Failed to read group licenses: HTTP {response.status}: {response.text}")
+    return {license["skuId"] for license in response.json().get("assignedLicenses", [])}
+
+async def ensure_group_licenses(group_id, license_skus, tenant_id, client_id, client_secret):
+    """
+    Make sure a group carries the given licenses through group-based licensing
+    
+    Members of the group then hold the licenses without per-user assignments, and Entra
+    ID frees their seats as soon as they leave the group or are deleted.
     
+    Args:
+        group_id (str): ID of the group to license
+        license_skus (list): SKU IDs the group should assign to its members
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        
+    Returns:
+        dict: "success", the SKU IDs "assigned" now and "already_assigned", and a
+            "reason" when it failed
+    """
+    result = {"success": False, "assigned": [], "already_assigned": []}
     try:
-        # Get access token from credentials for direct API call
-        # Use asyncio to ensure we're properly handling async operations
-        token_obj = await asyncio.create_task(credentials.get_token("https://graph.microsoft.com/.default"))
-        token = token_obj.token
+        current_skus = await get_group_licenses(group_id, tenant_id, client_id, client_secret)
+        result["already_assigned"] = [sku_id for sku_id in license_skus if sku_id in current_skus]
+        missing_skus = [sku_id for sku_id in license_skus if sku_id not in current_skus]
+        if missing_skus:
+            license_payload = {
+                "addLicenses": [{"skuId": sku_id, "disabledPlans": []} for sku_id in missing_skus],
+                "removeLicenses": []
+            }
+            response = await graph_request(
+                "POST", f"/groups/{group_id}/assignLicense", tenant_id, client_id, client_secret,
+                json_body=license_payload
+            )
+            # Group license changes are processed in the background and answer 202
+            if response.status not in (200, 202):
+                raise Exception(f"Failed to assign licenses to group: HTTP {response.status}: {response.text}")
+            result["assigned"] = missing_skus
+            print(f"Assigned {len(missing_skus)} licenses to group {group_id}")
+        result["success"] = True
+    except Exception as e:
+        result["reason"] = str(e)
+        print(f"Error assigning licenses to group {group_id}: {str(e)}")
+    
+    return result
+
+async def assign_licenses_to_user(user_id, license_skus, tenant_id, client_id, client_secret, sku_catalog=None):
+    """
+    Assign multiple licenses to a user in Microsoft Entra ID
+    
+    Args:
+        user_id (str): ID of the user to assign licenses to
+        license_skus (list): List of license SKU IDs to assign
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        sku_catalog (SkuCatalog, optional): Seat counts to check first; without free seats
+            nothing is sent and the result has "capacity_exhausted"
         
-        # Check if user exists using direct HTTP request
-        # Use filter to search by userPrincipalName
-        url = f"https://graph.microsoft.com/v1.0/users?$filter=userPrincipalName eq '{user_principal_name}'"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
+    Returns:
+        dict: Result of the license assignment operation
+    """
+    result = {"success": False, "assigned_licenses": []}
+    
+    if sku_catalog is not None:
+        license_skus = [sku_catalog.resolve(sku) for sku in license_skus]
+        reason = sku_catalog.reserve(license_skus)
+        if reason:
+            result["reason"] = reason
+            result["capacity_exhausted"] = True
+            return result
+    
+    try:
+        # Prepare license payload
+        license_payload = {
+            "addLicenses": [
+                {"skuId": sku_id} for sku_id in license_skus
+            ],
+            "removeLicenses": []
         }
         
-        # Use aiohttp for async HTTP requests but fall back to requests for compatibility
-        try:
-            import aiohttp
-            # Use aiohttp for proper async HTTP handling
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    status_code = response.status
-                    response_json = await response.json()
-                    
-                    if status_code == 200:
-                        users = response_json.get('value', [])
-                        
-                        if users and len(users) > 0:
-                            # User exists
-                            return True, users[0].get('id')
-                        else:
-                            # User doesn't exist
-                            return False, None
-                    else:
-                        print(f"Failed to check if user exists: HTTP {status_code}")
-                        return False, None
-        except ImportError:
-            # Fall back to requests if aiohttp is not available
-            print("Using synchronous requests. Consider installing aiohttp for better performance.")
-            # Wrap the synchronous call in an async task to avoid blocking
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, lambda: requests.get(url, headers=headers))
-            
-            if response.status_code == 200:
-                users = response.json().get('value', [])
-                
-                if users and len(users) > 0:
-                    # User exists
-                    return True, users[0].get('id')
-                else:
-                    # User doesn't exist
-                    return False, None
-            else:
-                print(f"Failed to check if user exists: HTTP {response.status_code}")
-                return False, None
+        # Assign licenses using direct HTTP request
+        response = await graph_request(
+            "POST",
+            f"/users/{user_id}/assignLicense",
+            tenant_id,
+            client_id,
+            client_secret,
+            json_body=license_payload
+        )
+        
+        if response.status in [200, 201]:
+            result["success"] = True
+            result["assigned_licenses"] = license_skus
+            print(f"Successfully assigned licenses to user {user_id}")
+        else:
+            result["success"] = False
+            result["reason"] = f"HTTP {response.status}: {response.text}"
+            print(f"Failed to assign licenses to user: HTTP {response.status}")
                 
     except Exception as e:
-        print(f"Error checking if user exists: {str(e)}")
-        return False, None
+        result["success"] = False
+        result["reason"] = str(e)
+        print(f"Error assigning licenses to user: {str(e)}")
+    
+    if sku_catalog is not None and not result["success"]:
+        sku_catalog.release(license_skus)
+        sku_catalog.mark_exhausted(result.get("reason"), license_skus)
+    
+    return result
 
-async def create_entra_users_from_csv(csv_file_path, tenant_id, client_id, client_secret, smtp_server=None, smtp_port=None, sender_email=None, sender_password=None):
+# Graph accepts at most 20 sub-requests per JSON $batch envelope
+GRAPH_BATCH_SIZE = 20
+
+async def graph_batch(sub_requests, tenant_id, client_id, client_secret, max_retries=3):
     """
-    Load CSV file with subscriber data and create Microsoft Entra ID users
+    Send Microsoft Graph requests grouped into JSON $batch envelopes
+    
+    Up to 20 sub-requests are sent per envelope. Sub-requests that come back throttled
+    or with a server error are collected and only those are sent again, after waiting
+    for the longest Retry-After among them.
     
     Args:
-        csv_file_path (str): Path to the CSV file with subscriber data
+        sub_requests (list): Dictionaries with "id", "method", "url" (relative to /v1.0)
+            and an optional JSON "body"
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
-        smtp_server (str, optional): SMTP server for sending welcome emails
-        smtp_port (int, optional): SMTP server port
-        sender_email (str, optional): Email address to send welcome emails from
-        sender_password (str, optional): Password for sender email account
+        max_retries (int, optional): How many times failed sub-requests are retried
         
     Returns:
-        list: List of dictionaries with results of user creation operations
+        dict: Map of sub-request ID to its response ({"status", "headers", "body"})
     """
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
+    responses = {}
+    remaining = []
+    for sub_request in sub_requests:
+        sub_request = dict(sub_request, id=str(sub_request["id"]))
+        if "body" in sub_request:
+            sub_request.setdefault("headers", {"Content-Type": "application/json"})
+        remaining.append(sub_request)
     
-    results = []
-    
-    try:
-        with open(csv_file_path, 'r') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-            
-            for row in csv_reader:
-                email = row.get('Email Address', '')
-                first_name = row.get('First Name', '')
-                last_name = row.get('Last Name', '')
-                
-                # Skip empty rows or rows with missing essential data
-                if not email or not first_name:
-                    continue
-                
-                # Extract the handle from the email address
-                handle = get_email_handle(email)
-                if not handle:
-                    continue
-                
-                # Create new user ID with the handle and aiskillsfest.net domain
-                new_user_principal_name = f"{handle}@aiskillsfest.net"
-                  
-                # Check if user already exists
-                print(f"Checking if user {new_user_principal_name} exists...")
-                try:
-                    # Add explicit await and wait for response before continuing
-                    print(f"Waiting for existence check response...")
-                    # Explicitly await the result to ensure we have it before proceeding
-                    user_exists, existing_user_id = await check_user_exists(
-                        new_user_principal_name,
-                        tenant_id,
-                        client_id,
-                        client_secret
-                    )
-                    
-                    print(f"Received check response: exists={user_exists}")
-                    
-                    # Make sure we got a valid response
-                    if user_exists is None:
-                        raise Exception("Failed to determine if user exists")
-                    
-                    if user_exists:
-                        print(f"User {new_user_principal_name} already exists with ID: {existing_user_id}")
-                        user_info = {
-                            "email": email,
-                            "new_user_id": new_user_principal_name,
-                            "status": "skipped",
-                            "reason": "User already exists",
-                            "user_id": existing_user_id
-                        }
-                        results.append(user_info)
-                        print(f"Skipping to next user...")
-                        continue  # Skip to next user in CSV
-                    else:
-                        print(f"User {new_user_principal_name} does not exist. Will create new user.")
-                except Exception as e:
-                    print(f"Error checking if user exists: {str(e)}")
-                    results.append({
-                        "email": email,
-                        "new_user_id": new_user_principal_name,
-                        "status": "error",
-                        "message": f"Error checking if user exists: {str(e)}"
-                    })
-                    continue  # Skip to next user if we can't check existence
+    attempt = 0
+    while remaining:
+        retry = []
+        throttled = False
+        wait_seconds = 0
+        for start in range(0, len(remaining), GRAPH_BATCH_SIZE):
+            chunk = remaining[start:start + GRAPH_BATCH_SIZE]
+            try:
+                response = await graph_request(
+                    "POST",
+                    "/$batch",
+                    tenant_id,
+                    client_id,
+                    client_secret,
+                    json_body={"requests": chunk}
+                )
                 
-                # Generate temporary password for the new user
-                temp_password = generate_temporary_password()
-                  
-                # Create user in Entra ID
-                try:
-                    # Prepare user data
-                    password_profile = PasswordProfile(
-                        force_change_password_next_sign_in=True,
-                        password=temp_password
-                    )
-                    
-                    user = User(
-                        account_enabled=True,
-                        display_name=f"{first_name} {last_name or 'Student'}".strip(),
-                        mail_nickname=handle,
-                        user_principal_name=new_user_principal_name,
-                        password_profile=password_profile,
-                        given_name=first_name,
-                        surname=last_name or "Student",
-                        mail=email
-                    )
-                    
-                    # Call Microsoft Graph API to create the user using GraphServiceClient
-                    print(f"Creating user: {new_user_principal_name}...")
-                    response = await graph_client.users.post(body=user)
-                    
-                    if response:
-                        user_id = response.id
-                        print(f"User created successfully with ID: {user_id}")
-                        user_info = {
-                            "email": email,
-                            "new_user_id": new_user_principal_name,
-                            "status": "created",
-                            "user_id": user_id,
-                            "temp_password": temp_password
+                if response.status == 200:
+                    chunk_responses = {item["id"]: item for item in response.json().get("responses", [])}
+                else:
+                    # The whole envelope failed, report its status for every sub-request
+                    chunk_responses = {
+                        sub_request["id"]: {
+                            "status": response.status,
+                            "headers": response.headers,
+                            "body": response.text
                         }
-                        results.append(user_info)
-                        
-                        # Assign licenses to the new user
-                        print(f"Assigning licenses to user {new_user_principal_name}...")
-                        licenses_to_assign = [
-                            LICENSE_SKUIDS["MICROSOFT_COPILOT_STUDIO_VIRAL_TRIAL"],
-                            LICENSE_SKUIDS["MICROSOFT_POWER_APPS_DEV"]
-                        ]
-                        license_result = await assign_licenses_to_user(
-                            user_id,
-                            licenses_to_assign,
-                            tenant_id,
-                            client_id,
-                            client_secret
-                        )
-                        user_info["licenses_assigned"] = license_result["success"]
-                        if license_result["success"]:
-                            print(f"Successfully assigned licenses to {new_user_principal_name}")
-                        else:
-                            print(f"Failed to assign licenses to {new_user_principal_name}: {license_result.get('reason', 'Unknown error')}")
-                        
-                        # Send welcome email if SMTP details are provided
-                        if all([smtp_server, smtp_port, sender_email, sender_password]):
-                            print(f"Sending welcome email to {email}...")
-                            email_sent = send_welcome_email(
-                                to_email=email,
-                                first_name=first_name,
-                                last_name=last_name,
-                                new_username=new_user_principal_name,
-                                temp_password=temp_password,
-                                smtp_server=smtp_server,
-                                smtp_port=smtp_port,
-                                sender_email=sender_email,
-                                sender_password=sender_password
-                            )
-                            user_info["email_sent"] = email_sent
-                            print(f"Email {'sent successfully' if email_sent else 'failed to send'}")
-                        
-                        print(f"User processing complete.")
-                    else:
-                        print(f"Failed to create user: No response received")
-                        results.append({
-                            "email": email,
-                            "new_user_id": new_user_principal_name,
-                            "status": "error",
-                            "message": "Failed to create user: No response received"
-                        })
-                except Exception as e:
-                    error_msg = str(e)
-                    print(f"Error creating user {new_user_principal_name}: {error_msg}")
-                    results.append({
-                        "email": email,
-                        "new_user_id": new_user_principal_name,
-                        "status": "error",
-                        "message": error_msg
-                    })
+                        for sub_request in chunk
+                    }
+            except Exception as e:
+                chunk_responses = {
+                    sub_request["id"]: {"status": 0, "headers": {}, "body": str(e)}
+                    for sub_request in chunk
+                }
+            
+            for sub_request in chunk:
+                sub_response = chunk_responses.get(
+                    sub_request["id"],
+                    {"status": 0, "headers": {}, "body": "Missing from $batch response"}
+                )
+                responses[sub_request["id"]] = sub_response
+                status = sub_response.get("status")
+                if (status == 0 or status in RETRYABLE_STATUS_CODES) and attempt < max_retries:
+                    retry.append(sub_request)
+                    throttled = throttled or status in THROTTLED_STATUS_CODES
+                    wait_seconds = max(wait_seconds, _retry_after_seconds(sub_response.get("headers"), attempt))
+        
+        if retry:
+            print(f"Retrying {len(retry)} failed $batch sub-requests in {wait_seconds:.0f}s...")
+            if throttled:
+                # Throttled sub-requests pause every Graph caller, not just this batch
+                get_graph_throttle(tenant_id, client_id).on_throttled(wait_seconds)
+            await asyncio.sleep(wait_seconds * random.uniform(1, 1.25))
+        remaining = retry
+        attempt += 1
     
-    except Exception as e:
-        print(f"Error processing CSV file: {str(e)}")
-        return []
+    return responses
+
+def odata_string(value):
+    """
+    Quote a value as an OData string literal for a $filter
     
-    return results
+    Returns:
+        str: The value in single quotes, with its own single quotes doubled
+    """
+    return "'" + value.replace("'", "''") + "'"
 
-def generate_temporary_password(length=12):
+def batch_failure_reason(sub_response):
     """
-    Generate a secure temporary password for new users
+    Describe a failed $batch sub-response
+    
+    Returns:
+        str: "HTTP <status>: <error>" in the form graph_request failures are reported
     """
-    alphabet = string.ascii_letters + string.digits + string.punctuation
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+    body = sub_response.get("body")
+    if isinstance(body, dict):
+        body = json.dumps(body.get("error", body))
+    return f"HTTP {sub_response.get('status')}: {body}"
 
-async def add_users_to_group(users, group_id, tenant_id, client_id, client_secret):
+def build_user_payload(email, first_name, last_name, handle, temp_password):
     """
-    Add multiple users to an Entra ID group
+    Build the Graph JSON body that creates an aiskillsfest.net user
+    
+    Returns:
+        dict: Request body for POST /users
+    """
+    return {
+        "accountEnabled": True,
+        "displayName": f"{first_name} {last_name or 'Student'}".strip(),
+        "mailNickname": handle,
+        "userPrincipalName": f"{handle}@aiskillsfest.net",
+        "passwordProfile": {
+            "forceChangePasswordNextSignIn": True,
+            "password": temp_password
+        },
+        "givenName": first_name,
+        "surname": last_name or "Student",
+        "mail": email
+    }
+
+async def batch_create_users(user_payloads, tenant_id, client_id, client_secret, user_index=None):
+    """
+    Create many users through $batch envelopes
     
     Args:
-        users (list): List of user IDs to add to the group
-        group_id (str): ID of the group to add users to
+        user_payloads (list): User bodies as built by build_user_payload
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
+        user_index (TenantUserIndex, optional): Tenant snapshot to add created users to
         
     Returns:
-        dict: Results of group addition operations
+        dict: {"success": [{"user_principal_name", "user_id"}], "failed": [{"user_principal_name", "reason"}]}
     """
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
+    sub_requests = [
+        {"id": index, "method": "POST", "url": "/users", "body": payload}
+        for index, payload in enumerate(user_payloads)
+    ]
+    responses = await graph_batch(sub_requests, tenant_id, client_id, client_secret)
     
     results = {"success": [], "failed": []}
-    for user_id in users:
-        try:
-            print(f"Adding user {user_id} to group...")
-            
-            # Get access token from credentials for direct API call
-            token = credentials.get_token("https://graph.microsoft.com/.default").token
-            
-            # Create the request body to add a user to a group
-            request_body = {
-                "@odata.id": f"https://graph.microsoft.com/v1.0/directoryObjects/{user_id}"
-            }
-            
-            # Add member to group using direct HTTP request
-            url = f"https://graph.microsoft.com/v1.0/groups/{group_id}/members/$ref"
-            headers = {
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(url, headers=headers, json=request_body)
-            
-            # 204 No Content is success for this operation
-            if response.status_code == 204:
-                results["success"].append(user_id)
-            else:
-                results["failed"].append({
-                    "user_id": user_id,
-                    "reason": f"HTTP {response.status_code}: {response.text}"
-                })
-                
-        except Exception as e:
+    for index, payload in enumerate(user_payloads):
+        sub_response = responses[str(index)]
+        user_principal_name = payload["userPrincipalName"]
+        if sub_response.get("status") == 201:
+            user_id = sub_response["body"].get("id")
+            results["success"].append({
+                "user_principal_name": user_principal_name,
+                "user_id": user_id
+            })
+            if user_index is not None:
+                user_index.add({"id": user_id, "userPrincipalName": user_principal_name, "mail": payload.get("mail")})
+        else:
+            results["failed"].append({
+                "user_principal_name": user_principal_name,
+                "reason": batch_failure_reason(sub_response)
+            })
+    
+    return results
+
+async def _batch_user_operation(user_ids, build_sub_request, success_statuses, tenant_id, client_id, client_secret):
+    """
+    Run one Graph operation per user through $batch and map the results back to the users
+    """
+    user_ids = list(user_ids)
+    sub_requests = [
+        dict(build_sub_request(user_id), id=index)
+        for index, user_id in enumerate(user_ids)
+    ]
+    responses = await graph_batch(sub_requests, tenant_id, client_id, client_secret)
+    
+    results = {"success": [], "failed": []}
+    for index, user_id in enumerate(user_ids):
+        sub_response = responses[str(index)]
+        if sub_response.get("status") in success_statuses:
+            results["success"].append(user_id)
+        else:
             results["failed"].append({
                 "user_id": user_id,
-                "reason": str(e)
+                "reason": batch_failure_reason(sub_response)
             })
     
     return results
 
-async def remove_user_from_group(user_id, group_id, tenant_id, client_id, client_secret):
+async def batch_assign_licenses(user_ids, license_skus, tenant_id, client_id, client_secret, sku_catalog=None):
     """
-    Remove a user from an Entra ID group
+    Assign the same licenses to many users through $batch envelopes
     
     Args:
-        user_id (str): ID of the user to remove from the group
-        group_id (str): ID of the group to remove the user from
+        user_ids (list): IDs of the users to assign licenses to
+        license_skus (list): List of license SKU IDs to assign
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
+        sku_catalog (SkuCatalog, optional): Seat counts to check first; users beyond the
+            free seats are reported as failed without calling Graph
         
     Returns:
-        dict: Result of the operation
+        dict: Results in the same shape as add_users_to_group
     """
-    # Initialize credentials
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
+    user_ids = list(user_ids)
+    skipped = []
+    if sku_catalog is not None:
+        license_skus = [sku_catalog.resolve(sku) for sku in license_skus]
+        
+        # Only send as many users as every SKU still has seats for
+        seats = min(sku_catalog.remaining(sku) for sku in license_skus) if license_skus else len(user_ids)
+        user_ids, over_capacity = user_ids[:seats], user_ids[seats:]
+        if user_ids:
+            sku_catalog.reserve(license_skus, len(user_ids))
+        if over_capacity:
+            # Fails now that the seats are taken, and counts the skipped users
+            reason = sku_catalog.reserve(license_skus, len(over_capacity))
+            skipped = [{"user_id": user_id, "reason": reason, "capacity_exhausted": True} for user_id in over_capacity]
     
-    result = {"success": False}
+    license_payload = {
+        "addLicenses": [
+            {"skuId": sku_id} for sku_id in license_skus
+        ],
+        "removeLicenses": []
+    }
+    results = await _batch_user_operation(
+        user_ids,
+        lambda user_id: {"method": "POST", "url": f"/users/{user_id}/assignLicense", "body": license_payload},
+        {200, 201},
+        tenant_id,
+        client_id,
+        client_secret
+    )
     
-    try:
-        # Get access token from credentials for direct API call
-        token = credentials.get_token("https://graph.microsoft.com/.default").token
-        
-        # Remove member from group using direct HTTP request
-        url = f"https://graph.microsoft.com/v1.0/groups/{group_id}/members/{user_id}/$ref"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.delete(url, headers=headers)
-        
-        # 204 No Content is success for this operation
-        if response.status_code == 204:
-            result["success"] = True
-            print(f"User {user_id} removed from group {group_id} successfully")
-        else:
-            result["success"] = False
-            result["reason"] = f"HTTP {response.status_code}: {response.text}"
-            print(f"Failed to remove user from group: HTTP {response.status_code}")
-                
-    except Exception as e:
-        result["success"] = False
-        result["reason"] = str(e)
-        print(f"Error removing user from group: {str(e)}")
+    if sku_catalog is not None:
+        if results["failed"]:
+            sku_catalog.release(license_skus, len(results["failed"]))
+            for failure in results["failed"]:
+                sku_catalog.mark_exhausted(failure["reason"], license_skus)
+        results["failed"].extend(skipped)
     
-    return result
+    return results
 
-async def remove_users_from_group(users, group_id, tenant_id, client_id, client_secret):
+async def batch_add_users_to_group(user_ids, group_id, tenant_id, client_id, client_secret):
     """
-    Remove multiple users from an Entra ID group
+    Add many users to an Entra ID group through $batch envelopes
     
     Args:
-        users (list): List of user IDs to remove from the group
-        group_id (str): ID of the group to remove users from
+        user_ids (list): IDs of the users to add to the group
+        group_id (str): ID of the group to add users to
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
         
     Returns:
-        dict: Results of group removal operations
+        dict: Results in the same shape as add_users_to_group
     """
-    results = {"success": [], "failed": []}
-    
-    for user_id in users:
-        result = await remove_user_from_group(
-            user_id, 
-            group_id, 
-            tenant_id, 
-            client_id, 
-            client_secret
-        )
-        
-        if result["success"]:
-            results["success"].append(user_id)
-        else:
-            results["failed"].append({
-                "user_id": user_id,
-                "reason": result.get("reason", "Unknown error")
-            })
-    
-    return results
+    return await _batch_user_operation(
+        user_ids,
+        lambda user_id: {
+            "method": "POST",
+            "url": f"/groups/{group_id}/members/$ref",
+            "body": {"@odata.id": f"{GRAPH_BASE_URL}/directoryObjects/{user_id}"}
+        },
+        {204},
+        tenant_id,
+        client_id,
+        client_secret
+    )
 
-async def delete_user_from_tenant(user_id, tenant_id, client_id, client_secret):
+async def batch_remove_users_from_group(user_ids, group_id, tenant_id, client_id, client_secret):
     """
-    Delete a user from the Microsoft Entra ID tenant
+    Remove many members from an Entra ID group through $batch envelopes
     
     Args:
-        user_id (str): ID of the user to delete
+        user_ids (list): IDs of the members to remove from the group
+        group_id (str): ID of the group to remove them from
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
         
     Returns:
-        dict: Result of the operation
+        dict: Results in the same shape as remove_users_from_group
     """
-    # Initialize credentials
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
+    return await _batch_user_operation(
+        user_ids,
+        lambda user_id: {"method": "DELETE", "url": f"/groups/{group_id}/members/{user_id}/$ref"},
+        {204},
+        tenant_id,
+        client_id,
+        client_secret
     )
+
+# Most members one PATCH with members@odata.bind may add
+MEMBERS_BIND_BATCH_SIZE = 20
+
+async def add_users_to_groups(user_ids, group_ids, tenant_id, client_id, client_secret):
+    """
+    Add a set of users to several Entra ID groups at once
     
-    result = {"success": False}
+    Every group is handled concurrently: its current members are read once, users that
+    already belong to it are skipped, and the rest are added 20 at a time with a single
+    PATCH of members@odata.bind. Graph applies such a PATCH all or nothing, so when one
+    fails its users are added again one by one through $batch to find the failing ones.
     
-    try:
-        # Get access token from credentials for direct API call
-        token = credentials.get_token("https://graph.microsoft.com/.default").token
+    Args:
+        user_ids (list): IDs of the users to add
+        group_ids (list): IDs of the groups to add them to
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
         
-        # Delete user using direct HTTP request
-        url = f"https://graph.microsoft.com/v1.0/users/{user_id}"
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
+    Returns:
+        dict: Per group ID, results in the same shape as add_users_to_group plus
+            "already_member" with the IDs that were skipped
+    """
+    # Keep the order but drop repeated IDs
+    user_ids = list(dict.fromkeys(user_ids))
+    
+    async def add_to_group(group_id):
+        results = {"success": [], "failed": [], "already_member": []}
+        if not user_ids:
+            return results
         
-        response = requests.delete(url, headers=headers)
+        try:
+            current_members = {member["id"] async for member in iter_group_members(group_id, tenant_id, client_id, client_secret, select=("id",))}
+        except Exception as e:
+            reason = f"Failed to read members of group {group_id}: {str(e)}"
+            results["failed"] = [{"user_id": user_id, "reason": reason} for user_id in user_ids]
+            return results
         
-        # 204 No Content is success for this operation
-        if response.status_code == 204:
-            result["success"] = True
-            print(f"User {user_id} deleted successfully from the tenant")
-        else:
-            result["success"] = False
-            result["reason"] = f"HTTP {response.status_code}: {response.text}"
-            print(f"Failed to delete user: HTTP {response.status_code}")
-                
-    except Exception as e:
-        result["success"] = False
-        result["reason"] = str(e)
-        print(f"Error deleting user: {str(e)}")
+        pending = []
+        for user_id in user_ids:
+            if user_id in current_members:
+                results["already_member"].append(user_id)
+            else:
+                pending.append(user_id)
+        print(f"Adding {len(pending)} users to group {group_id} ({len(results['already_member'])} already members)...")
+        
+        for start in range(0, len(pending), MEMBERS_BIND_BATCH_SIZE):
+            chunk = pending[start:start + MEMBERS_BIND_BATCH_SIZE]
+            request_body = {
+                "members@odata.bind": [f"{GRAPH_BASE_URL}/directoryObjects/{user_id}" for user_id in chunk]
+            }
+            try:
+                response = await graph_request("PATCH", f"/groups/{group_id}", tenant_id, client_id, client_secret, json_body=request_body)
+                if response.status == 204:
+                    results["success"].extend(chunk)
+                    continue
+                print(f"Bulk add to group {group_id} failed with HTTP {response.status}, adding {len(chunk)} users one by one")
+            except Exception as e:
+                print(f"Bulk add to group {group_id} failed: {str(e)}, adding {len(chunk)} users one by one")
+            
+            fallback = await batch_add_users_to_group(chunk, group_id, tenant_id, client_id, client_secret)
+            results["success"].extend(fallback["success"])
+            results["failed"].extend(fallback["failed"])
+        
+        return results
     
-    return result
+    group_results = await asyncio.gather(*(add_to_group(group_id) for group_id in group_ids))
+    return dict(zip(group_ids, group_results))
 
-async def delete_users_from_tenant(users, tenant_id, client_id, client_secret):
+async def batch_delete_users(user_ids, tenant_id, client_id, client_secret, user_index=None):
     """
-    Delete multiple users from the Microsoft Entra ID tenant
+    Delete many users from the tenant through $batch envelopes
     
     Args:
-        users (list): List of user IDs to delete
+        user_ids (list): IDs of the users to delete
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
+        user_index (TenantUserIndex, optional): Tenant snapshot to remove deleted users from
         
     Returns:
-        dict: Results of user deletion operations
+        dict: Results in the same shape as delete_users_from_tenant
     """
-    results = {"success": [], "failed": []}
+    results = await _batch_user_operation(
+        user_ids,
+        lambda user_id: {"method": "DELETE", "url": f"/users/{user_id}"},
+        {204},
+        tenant_id,
+        client_id,
+        client_secret
+    )
+    if user_index is not None:
+        for user_id in results["success"]:
+            user_index.remove(user_id)
+    return results
+
+# User IDs read, checked and assigned together by assign_licenses_to_users
+LICENSE_ASSIGNMENT_CHUNK_SIZE = 500
+
+# Chunks of assign_licenses_to_users in flight at the same time
+LICENSE_ASSIGNMENT_CONCURRENCY = 4
+
+def iter_user_ids(source):
+    """
+    Stream user IDs, one per line, skipping blank lines and lines starting with #
     
-    for user_id in users:
-        result = await delete_user_from_tenant(
-            user_id, 
-            tenant_id, 
-            client_id, 
-            client_secret
-        )
+    Args:
+        source (str or iterable): Path of a text file, "-" for standard input, or an
+            iterable of IDs
         
-        if result["success"]:
-            results["success"].append(user_id)
-        else:
-            results["failed"].append({
-                "user_id": user_id,
-                "reason": result.get("reason", "Unknown error")
-            })
+    Yields:
+        str: User IDs
+    """
+    if isinstance(source, str):
+        id_file = sys.stdin if source == "-" else open(source, "r", encoding="utf-8-sig")
+        try:
+            yield from iter_user_ids(id_file)
+        finally:
+            if id_file is not sys.stdin:
+                id_file.close()
+        return
     
-    return results
+    for line in source:
+        user_id = line.strip()
+        if user_id and not user_id.startswith("#"):
+            yield user_id
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-async def assign_licenses_to_user(user_id, license_skus, tenant_id, client_id, client_secret):
+async def assign_licenses_to_users(user_ids, license_skus, tenant_id, client_id, client_secret,
+                                   chunk_size=LICENSE_ASSIGNMENT_CHUNK_SIZE, concurrency=LICENSE_ASSIGNMENT_CONCURRENCY,
+                                   sku_catalog=None):
     """
-    Assign multiple licenses to a user in Microsoft Entra ID
+    Assign licenses to a long list of users without prompting
+    
+    User IDs are consumed in chunks. For every chunk the users' assignedLicenses are
+    read through $batch first, users who already hold every SKU are skipped, and the
+    others get only the SKUs they miss, again through $batch. Several chunks run at
+    once and a duplicate ID is handled once.
     
     Args:
-        user_id (str): ID of the user to assign licenses to
+        user_ids (str or iterable): User IDs, or a file of IDs ("-" for stdin), see iter_user_ids
         license_skus (list): List of license SKU IDs to assign
         tenant_id (str): Microsoft Entra ID tenant ID
         client_id (str): Application ID for authentication
         client_secret (str): Application secret for authentication
+        chunk_size (int, optional): User IDs handled together
+        concurrency (int, optional): Chunks in flight at the same time
+        sku_catalog (SkuCatalog, optional): Seat counts to check before assigning
         
     Returns:
-        dict: Result of the license assignment operation
+        dict: "success" and "already_licensed" lists of {"user_id"}, and "failed" with
+            {"user_id", "reason"}
     """
-    # Initialize credentials
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
+    results = {"success": [], "failed": [], "already_licensed": []}
+    required_skus = set(sku_catalog.resolve(sku) for sku in license_skus) if sku_catalog is not None else set(license_skus)
+    seen = set()
     
-    result = {"success": False, "assigned_licenses": []}
+    def unique_ids():
+        for user_id in iter_user_ids(user_ids):
+            if user_id.lower() not in seen:
+                seen.add(user_id.lower())
+                yield user_id
     
-    try:
-        # Get access token from credentials for direct API call
-        token = credentials.get_token("https://graph.microsoft.com/.default").token
-        
-        # Prepare license payload
-        license_payload = {
-            "addLicenses": [
-                {"skuId": sku_id} for sku_id in license_skus
+    async def process_chunk(chunk):
+        responses = await graph_batch(
+            [
+                {"id": index, "method": "GET", "url": f"/users/{user_id}?$select=id,assignedLicenses"}
+                for index, user_id in enumerate(chunk)
             ],
-            "removeLicenses": []
-        }
+            tenant_id, client_id, client_secret
+        )
         
-        # Assign licenses using direct HTTP request
-        url = f"https://graph.microsoft.com/v1.0/users/{user_id}/assignLicense"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        # Users missing the same SKUs are assigned together
+        by_missing_skus = {}
+        for index, user_id in enumerate(chunk):
+            sub_response = responses[str(index)]
+            if sub_response.get("status") != 200:
+                results["failed"].append({"user_id": user_id, "reason": batch_failure_reason(sub_response)})
+                continue
+            held_skus = {license["skuId"] for license in sub_response["body"].get("assignedLicenses", [])}
+            missing_skus = required_skus - held_skus
+            if missing_skus:
+                by_missing_skus.setdefault(tuple(sorted(missing_skus)), []).append(user_id)
+            else:
+                results["already_licensed"].append({"user_id": user_id})
         
-        response = requests.post(url, headers=headers, json=license_payload)
+        for missing_skus, missing_user_ids in by_missing_skus.items():
+            assigned = await batch_assign_licenses(
+                missing_user_ids, list(missing_skus), tenant_id, client_id, client_secret, sku_catalog=sku_catalog
+            )
+            results["success"].extend({"user_id": user_id} for user_id in assigned["success"])
+            results["failed"].extend(assigned["failed"])
         
-        if response.status_code in [200, 201]:
-            result["success"] = True
-            result["assigned_licenses"] = license_skus
-            print(f"Successfully assigned licenses to user {user_id}")
-        else:
-            result["success"] = False
-            result["reason"] = f"HTTP {response.status_code}: {response.text}"
-            print(f"Failed to assign licenses to user: HTTP {response.status_code}")
-                
-    except Exception as e:
-        result["success"] = False
-        result["reason"] = str(e)
-        print(f"Error assigning licenses to user: {str(e)}")
+        print(f"Licenses: {len(seen)} users read, {len(results['success'])} assigned, "
+              f"{len(results['already_licensed'])} already licensed, {len(results['failed'])} failed")
     
-    return result
+    await run_bounded(_chunks(unique_ids(), chunk_size), process_chunk, concurrency)
+    return results
+
+def build_welcome_email(to_email, first_name, last_name, new_username, temp_password, sender_email):
+    """
+    Build the welcome email for a new user with login instructions
+    
+    Args:
+        to_email (str): Recipient's original email address
+        first_name (str): Recipient's first name
+        last_name (str): Recipient's last name
+        new_username (str): New username in aiskillsfest.net domain
+        temp_password (str): Temporary password for first login
+        sender_email (str): Sender's email address
+        
+    Returns:
+        tuple: (msg, recipients) with the MIME message and its envelope recipients
+    """
+    # Set up email content
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = to_email
+    msg['Cc'] = "admins@aiskillsfest.net"
+    msg['Subject'] = "Welcome to AI Skills Fest Organization"
+    
+    # Create email body with HTML formatting
+    body = f"""
+    <html>
+    <body>
+        <p>Hello {first_name} {last_name or 'Student'},</p>
+        
+        <p>Welcome to the AI Skills Fest organization! We're excited to have you join us.</p>
+        
+        <p>Your account has been created in our Microsoft Entra ID system. Below are your login credentials:</p>
+        
+        <ul>
+            <li><strong>Username:</strong> {new_username}</li>
+            <li><strong>Temporary Password:</strong> {temp_password}</li>
+        </ul>
+        
+        <p><strong>Login Instructions:</strong></p>
+        <ol>
+            <li>Go to <a href="https://login.microsoftonline.com">https://login.microsoftonline.com</a></li>
+            <li>Enter your username: {new_username}</li>
+            <li>Enter your temporary password: {temp_password}</li>
+            <li>You will be prompted to change your password upon first login</li>
+            <li>Choose a strong, unique password that you haven't used elsewhere</li>
+        </ol>
+        
+        <p>If you have any questions or need assistance, please contact our <a href="mailto:admins@aiskillsfest.net?subject=Inquiry&body=Hello,%20I%20have%20a%20question%20about..." >support team.</a></p>            
+        <p>Best regards,<br>
+        <a href="https://aiskillsfest.com">AI Skills Fest Team</a></p>
+    </body>
+    </html>
+    """
+    
+    # Attach HTML content
+    msg.attach(MIMEText(body, 'html'))
+    
+    cc_emails = ["admins@aiskillsfest.net"]
+    recipients = [to_email] + cc_emails
+    
+    return msg, recipients
 
-def send_welcome_email(to_email, first_name, last_name, new_username, temp_password, smtp_server, smtp_port, sender_email, sender_password):
+def send_welcome_email(to_email, first_name, last_name, new_username, temp_password, smtp_server, smtp_port, sender_email, sender_password, smtp_pool=None):
     """
     Send a welcome email to new users with login instructions
     
+    Messages go over pooled SMTP connections, so consecutive emails reuse the same
+    authenticated session instead of connecting and logging in every time.
+    
     Args:
         to_email (str): Recipient's original email address
         first_name (str): Recipient's first name
@@ -609,60 +2392,19 @@ def send_welcome_email(to_email, first_name, last_name, new_username, temp_passw
         smtp_port (int): SMTP server port
         sender_email (str): Sender's email address
         sender_password (str): Sender's email password
+        smtp_pool (SMTPConnectionPool, optional): Pool to send through, defaults to the
+            shared pool for this server and account
         
     Returns:
         bool: True if email sent successfully, False otherwise
     """
     try:
-        # Set up email content
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = to_email
-        msg['Cc'] = "admins@aiskillsfest.net"
-        msg['Subject'] = "Welcome to AI Skills Fest Organization"
-        
-        # Create email body with HTML formatting
-        body = f"""
-        <html>
-        <body>
-            <p>Hello {first_name} {last_name or 'Student'},</p>
-            
-            <p>Welcome to the AI Skills Fest organization! We're excited to have you join us.</p>
-            
-            <p>Your account has been created in our Microsoft Entra ID system. Below are your login credentials:</p>
-            
-            <ul>
-                <li><strong>Username:</strong> {new_username}</li>
-                <li><strong>Temporary Password:</strong> {temp_password}</li>
-            </ul>
-            
-            <p><strong>Login Instructions:</strong></p>
-            <ol>
-                <li>Go to <a href="https://login.microsoftonline.com">https://login.microsoftonline.com</a></li>
-                <li>Enter your username: {new_username}</li>
-                <li>Enter your temporary password: {temp_password}</li>
-                <li>You will be prompted to change your password upon first login</li>
-                <li>Choose a strong, unique password that you haven't used elsewhere</li>
-            </ol>
-            
-            <p>If you have any questions or need assistance, please contact our <a href="mailto:admins@aiskillsfest.net?subject=Inquiry&body=Hello,%20I%20have%20a%20question%20about..." >support team.</a></p>            
-            <p>Best regards,<br>
-            <a href="https://aiskillsfest.com">AI Skills Fest Team</a></p>
-        </body>
-        </html>
-        """
+        msg, recipients = build_welcome_email(to_email, first_name, last_name, new_username, temp_password, sender_email)
         
-        # Attach HTML content
-        msg.attach(MIMEText(body, 'html'))
-        
-        # Set up SMTP server and send email
-        cc_emails = ["admins@aiskillsfest.net"]
-        recipients = [to_email] + cc_emails
-        
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()  # Secure the connection
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipients, msg.as_string())
+        # Send over a pooled SMTP connection
+        if smtp_pool is None:
+            smtp_pool = get_smtp_pool(smtp_server, smtp_port, sender_email, sender_password)
+        smtp_pool.send(msg, recipients)
         
         return True
     
@@ -670,6 +2412,25 @@ def send_welcome_email(to_email, first_name, last_name, new_username, temp_passw
         print(f"Failed to send email to {to_email}: {str(e)}")
         return False
 
+def write_run_summary(summary_path, summary):
+    """
+    Write the outcome of a pipeline run as JSON, for orchestrator.py
+    
+    The number of Graph requests the run sent is added from the trace.
+    
+    Args:
+        summary_path (str): File to write, nothing is written when empty
+        summary (dict): Counts of the run, such as users processed and failed
+    """
+    if not summary_path:
+        return
+    summary = dict(summary, graph_requests=sum(
+        histogram["count"] for histogram in tracer.histograms() if histogram["operation"].startswith("graph ")
+    ))
+    os.makedirs(os.path.dirname(summary_path) or ".", exist_ok=True)
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
 async def test_with_dummy_record(tenant_id, client_id, client_secret, group_id, smtp_server, smtp_port, sender_email, sender_password):
     """
     Test the user creation and email functionality with a single dummy record
@@ -696,14 +2457,6 @@ async def test_with_dummy_record(tenant_id, client_id, client_secret, group_id,
         "Last Name": "User"
     }
     
-    # Initialize Microsoft Graph client
-    credentials = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-    graph_client = GraphServiceClient(credentials=credentials)
-    
     # Extract the handle from the email address
     email = dummy_user["Email Address"]
     first_name = dummy_user["First Name"]
@@ -738,31 +2491,15 @@ async def test_with_dummy_record(tenant_id, client_id, client_secret, group_id,
         print(f"Generated temporary password: {temp_password}")
         
         # Prepare user data
-        # Create proper model objects instead of dictionaries
-        password_profile = PasswordProfile(
-            force_change_password_next_sign_in=True,
-            password=temp_password
-        )
-        
-        user = User(
-            account_enabled=True,
-            display_name=f"{first_name} {last_name or 'Student'}".strip(),
-            mail_nickname=handle,
-            user_principal_name=new_user_principal_name,
-            password_profile=password_profile,
-            given_name=first_name,
-            surname=last_name or "Student",
-            mail=email
-        )
+        user = build_user_payload(email, first_name, last_name, handle, temp_password)
         
         try:
-            # Create user using GraphServiceClient
+            # Create user using direct HTTP request
             print(f"Creating user: {new_user_principal_name}...")
-            # With GraphServiceClient, we use the users endpoint
-            response = await graph_client.users.post(body=user)
+            response = await graph_request("POST", "/users", tenant_id, client_id, client_secret, json_body=user)
             
-            if response:
-                user_id = response.id
+            if response.status == 201:
+                user_id = response.json().get("id")
                 result["user_creation"] = "success"
                 result["user_id"] = user_id
                 result["username"] = new_user_principal_name
@@ -788,8 +2525,8 @@ async def test_with_dummy_record(tenant_id, client_id, client_secret, group_id,
                     print(f"Email {'sent successfully' if email_sent else 'failed to send'}")
             else:
                 result["user_creation"] = "failed"
-                result["reason"] = "Failed to create user"
-                print("Failed to create user: No response received")
+                result["reason"] = f"Failed to create user: HTTP {response.status}: {response.text}"
+                print(f"Failed to create user: HTTP {response.status}")
                 return result  # Exit early if user creation failed
         except Exception as e:
             result["user_creation"] = "failed"
@@ -801,31 +2538,29 @@ async def test_with_dummy_record(tenant_id, client_id, client_secret, group_id,
     if group_id and "user_id" in result:
         print(f"Adding user to group: {group_id}...")
         
-        # Get access token from credentials for direct API call
-        token = credentials.get_token("https://graph.microsoft.com/.default").token
-        
         # Create the request body to add a user to a group
         request_body = {
-            "@odata.id": f"https://graph.microsoft.com/v1.0/directoryObjects/{user_id}"
+            "@odata.id": f"{GRAPH_BASE_URL}/directoryObjects/{user_id}"
         }
         
         # Add member to group using direct HTTP request
-        url = f"https://graph.microsoft.com/v1.0/groups/{group_id}/members/$ref"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(url, headers=headers, json=request_body)
+        response = await graph_request(
+            "POST",
+            f"/groups/{group_id}/members/$ref",
+            tenant_id,
+            client_id,
+            client_secret,
+            json_body=request_body
+        )
         
         # 204 No Content is success for this operation
-        if response.status_code == 204:
+        if response.status == 204:
             result["group_add"] = "success"
             print("User added to group successfully")
         else:
             result["group_add"] = "failed"
-            result["group_add_reason"] = f"HTTP {response.status_code}: {response.text}"
-            print(f"Failed to add user to group: HTTP {response.status_code}")
+            result["group_add_reason"] = f"HTTP {response.status}: {response.text}"
+            print(f"Failed to add user to group: HTTP {response.status}")
     
     return result
 
@@ -890,6 +2625,33 @@ if __name__ == "__main__":
     sender_email = os.getenv("SMTP_EMAIL")
     sender_password = os.getenv("SMTP_PASSWORD")
    
+    # Number of CSV rows onboarded at the same time
+    onboarding_concurrency = int(os.getenv("ONBOARDING_CONCURRENCY", 10))
+    
+    # Answer existence checks from one tenant snapshot instead of one query per row
+    use_tenant_snapshot = os.getenv("ONBOARDING_TENANT_SNAPSHOT", "true").lower() == "true"
+    
+    # Bring the snapshot up to date with a delta query instead of reading every user again
+    use_delta_sync = os.getenv("GRAPH_DELTA_SYNC", "false").lower() == "true"
+    
+    # Welcome emails go through an outbox drained by SMTP_WORKERS at up to SMTP_MAX_PER_SECOND
+    smtp_workers = int(os.getenv("SMTP_WORKERS", 4))
+    smtp_max_per_second = float(os.getenv("SMTP_MAX_PER_SECOND", 5))
+    
+    # "user" assigns licenses per user, "group" licenses the learners group once instead
+    license_mode = os.getenv("LICENSE_MODE", "user").lower()
+    if license_mode not in LICENSE_MODES:
+        raise Exception(f"LICENSE_MODE must be one of {', '.join(LICENSE_MODES)}, not {license_mode}")
+    
+    # Check license seats from /subscribedSkus before assigning, so a sold out SKU stops the calls
+    check_license_capacity = os.getenv("LICENSE_CAPACITY_CHECK", "true").lower() == "true"
+    
+    # Stages completed per user are journaled here so an interrupted run can be resumed
+    journal_path = os.getenv("ONBOARDING_JOURNAL", ONBOARDING_JOURNAL_PATH)
+    
+    # Spans of every Graph, SMTP and CSV operation are written here at the end of the run
+    trace_path = os.getenv("TRACE_FILE", f"./data/traces/onboarding-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+   
     # Create an event loop for async operations
     loop = asyncio.get_event_loop()
     
@@ -916,33 +2678,15 @@ if __name__ == "__main__":
         user_id = test_result.get("user_id")
         print(f"\n=== STEP 2: VERIFYING USER IN GROUP ===")
         
-        # Get token for verification
-        credentials = ClientSecretCredential(
-            tenant_id=tenant_id,
-            client_id=client_id,
-            client_secret=client_secret
-        )
-        token = credentials.get_token("https://graph.microsoft.com/.default").token
-        
         # Check group membership
-        url = f"https://graph.microsoft.com/v1.0/groups/{group_id}/members"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        async def list_member_ids():
+            return {member["id"] async for member in iter_group_members(group_id, tenant_id, client_id, client_secret, select=("id",))}
+        member_ids = loop.run_until_complete(list_member_ids())
         
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            members = response.json().get("value", [])
-            member_ids = [member.get("id") for member in members]
-            
-            if user_id in member_ids:
-                print(f"✓ Verification successful: User {user_id} is a member of the group")
-            else:
-                print(f"✗ Verification failed: User {user_id} is NOT a member of the group")
+        if user_id in member_ids:
+            print(f"✓ Verification successful: User {user_id} is a member of the group")
         else:
-            print(f"Failed to verify group membership: HTTP {response.status_code}")
+            print(f"✗ Verification failed: User {user_id} is NOT a member of the group")
     
         # STEP 3: Clean up by deleting the test user
         print(f"\n=== STEP 3: CLEANING UP TEST USER ===")
@@ -960,17 +2704,12 @@ if __name__ == "__main__":
         
         # Final verification that user was deleted
         print("\n=== VERIFYING USER DELETION ===")
-        url = f"https://graph.microsoft.com/v1.0/users/{user_id}"
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
+        response = loop.run_until_complete(graph_request("GET", f"/users/{user_id}", tenant_id, client_id, client_secret))
         
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 404:
+        if response.status == 404:
             print(f"✓ Verification successful: User {user_id} has been deleted")
         else:
-            print(f"✗ Verification failed: User {user_id} still exists (HTTP {response.status_code})")
+            print(f"✗ Verification failed: User {user_id} still exists (HTTP {response.status})")
     else:
         print("\nSkipping verification and cleanup as user creation or group addition failed")
     
@@ -981,6 +2720,34 @@ if __name__ == "__main__":
     print("\n=== PROCESSING CSV FILE ===")
     csv_file_path = "./data/registered.csv"
     print(f"Reading users from {csv_file_path}...")
+    # The journal only resumes runs over the same tenant and registrations CSV
+    journal = OnboardingJournal(journal_path, scope=f"{tenant_id} {os.path.abspath(csv_file_path)}")
+    user_index = None
+    if use_tenant_snapshot:
+        if use_delta_sync:
+            print("Syncing tenant user snapshot...")
+            user_index = loop.run_until_complete(TenantUserIndex.sync(tenant_id, client_id, client_secret))
+        else:
+            print("Loading tenant user snapshot...")
+            user_index = loop.run_until_complete(TenantUserIndex.load(tenant_id, client_id, client_secret))
+    if license_mode == "group":
+        group_license_result = loop.run_until_complete(ensure_group_licenses(
+            group_id, ONBOARDING_LICENSE_SKUS, tenant_id, client_id, client_secret
+        ))
+        if not group_license_result["success"]:
+            print("Could not license the learners group, assigning licenses per user instead")
+            license_mode = "user"
+    sku_catalog = None
+    if check_license_capacity:
+        sku_catalog = loop.run_until_complete(SkuCatalog.load(tenant_id, client_id, client_secret))
+        sku_catalog.report(ONBOARDING_LICENSE_SKUS)
+    outbox = None
+    if all([smtp_server, smtp_port, sender_email, sender_password]):
+        outbox = EmailOutbox(
+            get_smtp_pool(smtp_server, smtp_port, sender_email, sender_password),
+            workers=smtp_workers,
+            max_per_second=smtp_max_per_second
+        )
     created_users = loop.run_until_complete(create_entra_users_from_csv(
         csv_file_path, 
         tenant_id, 
@@ -989,29 +2756,41 @@ if __name__ == "__main__":
         smtp_server,
         smtp_port,
         sender_email,
-        sender_password
+        sender_password,
+        concurrency=onboarding_concurrency,
+        user_index=user_index,
+        outbox=outbox,
+        journal=journal,
+        sku_catalog=sku_catalog,
+        license_mode=license_mode
     ))
+    if outbox is not None:
+        loop.run_until_complete(outbox.drain())
     
     # Get IDs of successfully created users
     successful_user_ids = [user["user_id"] for user in created_users if user["status"] == "created"]
+    upn_by_user_id = {user["user_id"]: user["new_user_id"] for user in created_users if user["status"] == "created"}
     
-    # Add users to a group
-    group_results = loop.run_until_complete(add_users_to_group(
-        successful_user_ids, 
-        group_id, 
-        tenant_id, 
-        client_id, 
-        client_secret
-    ))
+    # Users still missing from one of the groups according to the journal
+    group_ids = [group_id, sp_group_id]
+    pending_user_ids = [
+        user_id for user_id in successful_user_ids
+        if not all(journal.has(upn_by_user_id[user_id], f"grouped:{target_group_id}") for target_group_id in group_ids)
+    ]
     
-    # Add users to a SharePoint group
-    sharepoint_group_results = loop.run_until_complete(add_users_to_group(
-        successful_user_ids, 
-        sp_group_id, 
-        tenant_id, 
-        client_id, 
+    # Add users to the learners and SharePoint Team Site groups together
+    all_group_results = loop.run_until_complete(add_users_to_groups(
+        pending_user_ids,
+        group_ids,
+        tenant_id,
+        client_id,
         client_secret
     ))
+    for target_group_id, results in all_group_results.items():
+        for user_id in results["success"] + results["already_member"]:
+            journal.record(upn_by_user_id[user_id], f"grouped:{target_group_id}")
+    group_results = all_group_results[group_id]
+    sharepoint_group_results = all_group_results[sp_group_id]
     
     # Print results
     print(f"Created {len(successful_user_ids)} users")
@@ -1020,4 +2799,35 @@ if __name__ == "__main__":
     print(f"Added {len(sharepoint_group_results['success'])} users to SharePoint Team Site group")    
     print(f"Failed to add {len(group_results['failed'])} users to group")
     print(f"Failed to add {len(sharepoint_group_results['failed'])} users to SharePoint Team Site group")
+    
+    # Outcome of the run for orchestrator.py, which runs several events at once
+    write_run_summary(os.getenv("RUN_SUMMARY_FILE"), {
+        "pipeline": "onboard",
+        "completed": True,
+        "users": len(created_users),
+        "created": len(successful_user_ids),
+        "failed": sum(1 for user in created_users if user["status"] == "error"),
+        "group_adds": len(group_results["success"]) + len(sharepoint_group_results["success"]),
+        "group_add_failures": len(group_results["failed"]) + len(sharepoint_group_results["failed"]),
+        "emails_sent": outbox.sent if outbox is not None else 0
+    })
+    
+    # Close the pooled Graph and SMTP connections
+    loop.run_until_complete(close_http_session())
+    close_smtp_pools()
+    
+    # Nothing is left to resume once every user was created, licensed, grouped and emailed,
+    # without SMTP settings no welcome email is sent and none is waited for
+    run_clean = (
+        all(user["status"] != "error" for user in created_users)
+        and all(user.get("licenses_assigned") or user.get("licensed_via_group") for user in created_users if user["status"] == "created")
+        and (outbox is None or all(user.get("email_sent") for user in created_users if user["status"] == "created"))
+        and not any(results["failed"] for results in all_group_results.values())
+    )
+    if run_clean:
+        journal.discard()
+    else:
+        journal.close()
+        print(f"Run did not finish cleanly, rerun to resume from {journal_path}")
+    finish_trace(trace_path)
     print("=== PROCESSING COMPLETED ===")
@@ -1,83 +1,79 @@
+## Assign the event licenses to a list of existing users, without prompting.
+##
+## Usage: python assign_licenses.py user_ids.txt    (one user ID per line)
+##        python assign_licenses.py - < user_ids.txt
+
+import argparse
 import asyncio
-from Util_modified import assign_licenses_to_users
-from license_skuids import LICENSE_SKUIDS
 import os
-from dotenv import load_dotenv
+from Util import (
+    assign_licenses_to_users, close_http_session, SkuCatalog, ONBOARDING_LICENSE_SKUS,
+    LICENSE_ASSIGNMENT_CHUNK_SIZE, LICENSE_ASSIGNMENT_CONCURRENCY
+)
+
+
+def print_license_results(license_results):
+    """
+    Print the counts and every failure of an assign_licenses_to_users run
+    """
+    print("\n=== DETAILED RESULTS ===")
+    print(f"Assigned licenses to {len(license_results['success'])} users")
+    print(f"Skipped {len(license_results['already_licensed'])} users who already hold the licenses")
+
+    if license_results["failed"]:
+        print(f"\nFailed to assign licenses to {len(license_results['failed'])} users:")
+        for failure in license_results["failed"]:
+            print(f"- User ID: {failure['user_id']}")
+            print(f"  Reason: {failure['reason']}")
 
-# Load environment variables from .env file
-load_dotenv()
+    print("\n=== LICENSE ASSIGNMENT COMPLETE ===")
 
 
-async def main():
-    # Azure settings
+async def main(args):
     # Get Azure settings from environment variables
     tenant_id = os.getenv("AZURE_TENANT_ID")
     client_id = os.getenv("AZURE_CLIENT_ID")
     client_secret = os.getenv("AZURE_CLIENT_SECRET")
-    
-    # You can either:
-    # 1. Provide a list of specific user IDs 
-    # 2. Import them from a CSV file
-    # 3. Read them from a text file
-    
-    # Example with specific user IDs:
-    user_ids = [
-        # Add your user IDs here, for example:
-        # "00000000-0000-0000-0000-000000000000",
-        # "11111111-1111-1111-1111-111111111111",
-    ]
-    
-    # If the list is empty, ask the user if they want to provide a file
-    if not user_ids:
-        file_path = input("Enter the path to a file with user IDs (one per line) or press Enter to cancel: ")
-        if file_path:
-            try:
-                with open(file_path, 'r') as file:
-                    user_ids = [line.strip() for line in file if line.strip()]
-            except Exception as e:
-                print(f"Error reading file: {str(e)}")
-                return
-    
-    if not user_ids:
-        print("No user IDs provided. Exiting.")
-        return
-    
-    # Licenses to assign
-    licenses_to_assign = [
-        LICENSE_SKUIDS["MICROSOFT_COPILOT_STUDIO_VIRAL_TRIAL"],
-        LICENSE_SKUIDS["MICROSOFT_POWER_APPS_DEV"]
-    ]
-    
+
     print(f"\n=== STARTING LICENSE ASSIGNMENT ===")
-    print(f"Assigning the following licenses to {len(user_ids)} users:")
+    print(f"Assigning the following licenses to the users in {args.user_ids}:")
     print(f"- Microsoft Copilot Studio Viral Trial")
     print(f"- Microsoft Power Apps for Developer")
-    
-    # Assign licenses to the users
-    license_results = await assign_licenses_to_users(
-        user_ids,
-        licenses_to_assign,
-        tenant_id,
-        client_id,
-        client_secret
-    )
-    
-    # Print detailed results
-    print("\n=== DETAILED RESULTS ===")
-    if license_results["success"]:
-        print("\nSuccessfully assigned licenses to:")
-        for success in license_results["success"]:
-            print(f"- User ID: {success['user_id']}")
-    
-    if license_results["failed"]:
-        print("\nFailed to assign licenses to:")
-        for failure in license_results["failed"]:
-            print(f"- User ID: {failure['user_id']}")
-            print(f"  Reason: {failure['reason']}")
-    
-    print("\n=== LICENSE ASSIGNMENT COMPLETE ===")
+
+    try:
+        # Stop at the free seats instead of sending assignments that cannot succeed
+        sku_catalog = None
+        if args.capacity_check:
+            sku_catalog = await SkuCatalog.load(tenant_id, client_id, client_secret)
+
+        license_results = await assign_licenses_to_users(
+            args.user_ids,
+            ONBOARDING_LICENSE_SKUS,
+            tenant_id,
+            client_id,
+            client_secret,
+            chunk_size=args.chunk_size,
+            concurrency=args.concurrency,
+            sku_catalog=sku_catalog
+        )
+        if sku_catalog is not None:
+            sku_catalog.report(ONBOARDING_LICENSE_SKUS)
+    finally:
+        await close_http_session()
+
+    print_license_results(license_results)
+    return 1 if license_results["failed"] else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Assign the event licenses to existing users")
+    parser.add_argument("user_ids", help="File with one user ID per line, - for standard input")
+    parser.add_argument("--chunk-size", type=int, default=LICENSE_ASSIGNMENT_CHUNK_SIZE, help="User IDs checked and assigned together")
+    parser.add_argument("--concurrency", type=int, default=LICENSE_ASSIGNMENT_CONCURRENCY, help="Chunks in flight at the same time")
+    parser.add_argument("--no-capacity-check", dest="capacity_check", action="store_false",
+                        help="Do not read the free seats from /subscribedSkus first")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    # Create an event loop for async operations
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    raise SystemExit(asyncio.run(main(parse_args())))
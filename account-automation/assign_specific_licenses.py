@@ -1,96 +1,65 @@
+## Assign chosen licenses to given users after they have been created, without prompting.
+##
+## Usage: python assign_specific_licenses.py --user <id> [--user <id> ...] [--sku NAME ...]
+##        python assign_specific_licenses.py --file user_ids.txt [--sku NAME ...]
+##
+## SKUs can be named by their license_skuids.py name, skuPartNumber or ID, the event's
+## Copilot Studio and Power Apps for Developer licenses are assigned by default.
+
+import argparse
 import asyncio
-from Util_modified import assign_licenses_to_users, check_user_exists
-from license_skuids import LICENSE_SKUIDS
 import os
-from dotenv import load_dotenv
+from Util import (
+    assign_licenses_to_users, close_http_session, SkuCatalog, ONBOARDING_LICENSE_SKUS,
+    LICENSE_ASSIGNMENT_CHUNK_SIZE, LICENSE_ASSIGNMENT_CONCURRENCY
+)
+from assign_licenses import print_license_results
 
-# Load environment variables from .env file
-load_dotenv()
 
-async def assign_specific_licenses():
+async def assign_specific_licenses(args):
     """
-    This script focuses only on assigning licenses to users after they have been created.
+    Assign the chosen licenses to the given users
     """
     # Azure settings
     tenant_id = os.getenv("AZURE_TENANT_ID")
     client_id = os.getenv("AZURE_CLIENT_ID")
     client_secret = os.getenv("AZURE_CLIENT_SECRET")
-    
-    # Set up which licenses to assign
-    licenses_to_assign = [
-        LICENSE_SKUIDS["MICROSOFT_COPILOT_STUDIO_VIRAL_TRIAL"],
-        LICENSE_SKUIDS["MICROSOFT_POWER_APPS_DEV"]
-    ]
-    
-    # Get the list of user IDs either from a file or manual entry
+
     print("=== LICENSE ASSIGNMENT MODULE ===")
-    print("This module assigns Microsoft Copilot Studio Viral Trial and Microsoft Power Apps for Developer licenses to users")
-    
-    input_method = input("Enter '1' to provide user IDs in a file or '2' to enter a specific user ID: ")
-    
-    user_ids = []
-    
-    if input_method == "1":
-        file_path = input("Enter the path to the file containing user IDs (one per line): ")
-        try:
-            with open(file_path, 'r') as file:
-                user_ids = [line.strip() for line in file if line.strip()]
-            print(f"Loaded {len(user_ids)} user IDs from file")
-        except Exception as e:
-            print(f"Error reading file: {str(e)}")
-            return
-    elif input_method == "2":
-        user_id = input("Enter the user ID to assign licenses to: ")
-        if user_id.strip():
-            user_ids.append(user_id.strip())
-        else:
-            print("No user ID provided. Exiting.")
-            return
-    else:
-        print("Invalid option. Exiting.")
-        return
-    
-    if not user_ids:
-        print("No user IDs provided. Exiting.")
-        return
-    
-    # Confirm before proceeding
-    print(f"\nReady to assign the following licenses to {len(user_ids)} users:")
-    print("1. Microsoft Copilot Studio Viral Trial")
-    print("2. Microsoft Power Apps for Developer")
-    
-    confirm = input("\nProceed with license assignment? (y/n): ")
-    
-    if confirm.lower() != 'y':
-        print("License assignment cancelled.")
-        return
-    
-    # Assign licenses
-    print(f"\n=== ASSIGNING LICENSES TO {len(user_ids)} USERS ===")
-    license_results = await assign_licenses_to_users(
-        user_ids,
-        licenses_to_assign,
-        tenant_id,
-        client_id,
-        client_secret
-    )
-    
-    # Print detailed results
-    print("\n=== DETAILED RESULTS ===")
-    if license_results["success"]:
-        print("\nSuccessfully assigned licenses to:")
-        for success in license_results["success"]:
-            print(f"- User ID: {success['user_id']}")
-    
-    if license_results["failed"]:
-        print("\nFailed to assign licenses to:")
-        for failure in license_results["failed"]:
-            print(f"- User ID: {failure['user_id']}")
-            print(f"  Reason: {failure['reason']}")
-    
-    print("\n=== LICENSE ASSIGNMENT COMPLETE ===")
+    try:
+        # The catalog turns SKU names into IDs and stops at the free seats
+        sku_catalog = await SkuCatalog.load(tenant_id, client_id, client_secret)
+        licenses_to_assign = [sku_catalog.resolve(sku) for sku in (args.sku or ONBOARDING_LICENSE_SKUS)]
+        print(f"Assigning {', '.join(sku_catalog.name(sku_id) for sku_id in licenses_to_assign)}")
+
+        license_results = await assign_licenses_to_users(
+            args.file or args.user,
+            licenses_to_assign,
+            tenant_id,
+            client_id,
+            client_secret,
+            chunk_size=args.chunk_size,
+            concurrency=args.concurrency,
+            sku_catalog=sku_catalog
+        )
+        sku_catalog.report(licenses_to_assign)
+    finally:
+        await close_http_session()
+
+    print_license_results(license_results)
+    return 1 if license_results["failed"] else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Assign chosen licenses to existing users")
+    users = parser.add_mutually_exclusive_group(required=True)
+    users.add_argument("--user", action="append", help="User ID, can be repeated")
+    users.add_argument("--file", help="File with one user ID per line, - for standard input")
+    parser.add_argument("--sku", action="append", help="License to assign by name, part number or ID, can be repeated")
+    parser.add_argument("--chunk-size", type=int, default=LICENSE_ASSIGNMENT_CHUNK_SIZE, help="User IDs checked and assigned together")
+    parser.add_argument("--concurrency", type=int, default=LICENSE_ASSIGNMENT_CONCURRENCY, help="Chunks in flight at the same time")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    # Create an event loop for async operations
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(assign_specific_licenses())
+    raise SystemExit(asyncio.run(assign_specific_licenses(parse_args())))
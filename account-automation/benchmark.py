@@ -0,0 +1,309 @@
+## Offline benchmark of onboarding and teardown against local stand-ins for Graph and SMTP.
+##
+## Usage: python benchmark.py [--cohorts 100,1000,10000] [--latency-ms 20] [--throttle-rate 0.01]
+##                            [--output results.json] [--baseline previous.json] [--trace trace.jsonl]
+
+import argparse
+import asyncio
+import contextlib
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+import aiohttp
+import Util
+import CleanUpEvent
+from mailer import SMTPConnectionPool, EmailOutbox
+from mock_services import MockGraph, SMTPSink
+from tracing import finish_trace, percentile
+
+# Cohort sizes run when none are given
+DEFAULT_COHORTS = (100, 1000, 10000)
+
+# Users/sec may drop this much below the baseline before it counts as a regression
+DEFAULT_REGRESSION_TOLERANCE = 0.10
+
+# Extra Mailchimp columns written to the synthetic exports, so the reader skips real-sized rows
+SYNTHETIC_EXTRA_COLUMNS = ["MEMBER_RATING", "OPTIN_TIME", "OPTIN_IP", "CONFIRM_TIME", "CONFIRM_IP",
+                           "LATITUDE", "LONGITUDE", "GMTOFF", "DSTOFF", "TIMEZONE", "CC", "REGION",
+                           "LAST_CHANGED", "LEID", "EUID", "NOTES", "TAGS"]
+
+BENCHMARK_TENANT_ID = "benchmark-tenant"
+BENCHMARK_CLIENT_SECRET = "benchmark-secret"
+BENCHMARK_SENDER = "events@aiskillsfest.net"
+
+
+class RequestTimer:
+    """
+    Time every HTTP request the shared Graph session sends, through an aiohttp TraceConfig
+    """
+
+    def __init__(self):
+        self.durations = []
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self._on_start)
+        self.trace_config.on_request_end.append(self._on_end)
+
+    async def _on_start(self, session, context, params):
+        context.started_at = time.perf_counter()
+
+    async def _on_end(self, session, context, params):
+        self.durations.append(time.perf_counter() - context.started_at)
+
+    def take(self):
+        """
+        Returns:
+            dict: p50, p95 and p99 in milliseconds of the requests timed since the last take
+        """
+        durations = sorted(self.durations)
+        self.durations = []
+        return {
+            "p50_ms": round(percentile(durations, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(durations, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(durations, 0.99) * 1000, 1)
+        }
+
+
+def write_synthetic_export(csv_file_path, size):
+    """
+    Write a Mailchimp-shaped registration export with `size` unique registrations
+    """
+    with open(csv_file_path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Email Address", "First Name", "Last Name"] + SYNTHETIC_EXTRA_COLUMNS)
+        for number in range(size):
+            extra = [f"{column.lower()}-{number}" for column in SYNTHETIC_EXTRA_COLUMNS]
+            writer.writerow([f"learner{number:06d}@example.com", "Learner", f"Number{number}"] + extra)
+
+
+async def run_stage(name, items, work, mock_graph, request_timer, quiet):
+    """
+    Run one benchmark stage and measure it
+
+    Args:
+        name (str): Stage name used in the report
+        items (int): Number of users the stage handles, for users/sec
+        work (coroutine function): The stage itself
+        mock_graph (MockGraph): Stand-in whose request counters are read
+        request_timer (RequestTimer): Timer of the Graph HTTP requests
+        quiet (bool): Hide the per-user lines the scripts print
+
+    Returns:
+        tuple: (stage report dict, result of work)
+    """
+    requests_before = mock_graph.requests.copy()
+    http_requests_before = mock_graph.http_requests
+    throttled_before = mock_graph.throttled
+    request_timer.take()
+
+    started_at = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        result = await work()
+    elapsed = time.perf_counter() - started_at
+
+    requests = mock_graph.requests - requests_before
+    report = {
+        "stage": name,
+        "users": items,
+        "seconds": round(elapsed, 3),
+        "users_per_sec": round(items / elapsed, 1) if elapsed > 0 else 0.0,
+        "graph_requests": mock_graph.http_requests - http_requests_before,
+        "batch_sub_requests": requests.get("$batch sub", 0),
+        "throttled": mock_graph.throttled - throttled_before,
+        "requests_by_operation": dict(requests),
+        **request_timer.take()
+    }
+    return report, result
+
+
+async def run_cohort(size, args, mock_graph, smtp_sink, smtp_address, request_timer):
+    """
+    Onboard, group and tear down one synthetic cohort of `size` users
+
+    Returns:
+        list: Stage reports of the cohort
+    """
+    mock_graph.reset()
+    learners_group_id = mock_graph.add_group()
+    sharepoint_group_id = mock_graph.add_group()
+
+    # A separate app registration per cohort, so each starts from a fresh adaptive limit
+    client_id = f"benchmark-client-{size}"
+    credentials = (BENCHMARK_TENANT_ID, client_id, BENCHMARK_CLIENT_SECRET)
+    Util.register_token_provider(*credentials, Util.StaticTokenProvider("benchmark-token"))
+
+    reports = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        csv_file_path = os.path.join(work_dir, "registered.csv")
+        write_synthetic_export(csv_file_path, size)
+
+        smtp_pool = SMTPConnectionPool(smtp_address[0], smtp_address[1], BENCHMARK_SENDER, use_tls=False)
+        messages_before = smtp_sink.messages
+
+        async def onboard():
+            if args.license_mode == "group":
+                await Util.ensure_group_licenses(learners_group_id, Util.ONBOARDING_LICENSE_SKUS, *credentials)
+            user_index = await Util.TenantUserIndex.load(*credentials)
+            outbox = EmailOutbox(smtp_pool, workers=args.smtp_workers, report_interval=0)
+            created = await Util.create_entra_users_from_csv(
+                csv_file_path, *credentials,
+                sender_email=BENCHMARK_SENDER,
+                concurrency=args.concurrency,
+                user_index=user_index,
+                outbox=outbox,
+                license_mode=args.license_mode
+            )
+            await outbox.drain()
+            return created
+
+        report, created_users = await run_stage("onboarding", size, onboard, mock_graph, request_timer, args.quiet)
+        report["emails_sent"] = smtp_sink.messages - messages_before
+        reports.append(report)
+        user_ids = [user["user_id"] for user in created_users if user["status"] == "created"]
+
+        async def add_to_groups():
+            return await Util.add_users_to_groups(user_ids, [learners_group_id], *credentials)
+
+        report, _ = await run_stage("group_add", len(user_ids), add_to_groups, mock_graph, request_timer, args.quiet)
+        reports.append(report)
+
+        # add_users_to_group sends one POST per user, cap it so large cohorts stay quick
+        per_user_ids = user_ids[:args.per_user_limit]
+
+        async def add_one_by_one():
+            return await Util.add_users_to_group(per_user_ids, sharepoint_group_id, *credentials)
+
+        report, _ = await run_stage("group_add_per_user", len(per_user_ids), add_one_by_one, mock_graph, request_timer, args.quiet)
+        reports.append(report)
+
+        async def teardown():
+            members = CleanUpEvent.get_group_members(*credentials, learners_group_id)
+            return await CleanUpEvent.remove_exgroup_members_from_tenant(*credentials, members, concurrency=args.concurrency)
+
+        report, _ = await run_stage("teardown", len(user_ids), teardown, mock_graph, request_timer, args.quiet)
+        # Users the teardown missed, paging the group while deleting its members leaves some behind
+        report["left_in_group"] = len(mock_graph.groups[learners_group_id])
+        report["left_in_tenant"] = len(mock_graph.users)
+        reports.append(report)
+
+        smtp_pool.close()
+
+    for report in reports:
+        report["cohort"] = size
+    return reports
+
+
+def print_reports(reports):
+    print(f"{'cohort':>7} {'stage':<20} {'users':>6} {'seconds':>8} {'users/s':>8} {'requests':>8} "
+          f"{'batched':>8} {'429s':>5} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7}")
+    for report in reports:
+        print(f"{report['cohort']:>7} {report['stage']:<20} {report['users']:>6} {report['seconds']:>8.2f} "
+              f"{report['users_per_sec']:>8.1f} {report['graph_requests']:>8} {report['batch_sub_requests']:>8} "
+              f"{report['throttled']:>5} {report['p50_ms']:>7} {report['p95_ms']:>7} {report['p99_ms']:>7}")
+
+
+def find_regressions(reports, baseline_reports, tolerance):
+    """
+    Compare users/sec per cohort and stage with an earlier run
+
+    Returns:
+        list: Messages for every stage slower than the baseline by more than `tolerance`
+    """
+    baseline = {(report["cohort"], report["stage"]): report for report in baseline_reports}
+    regressions = []
+    for report in reports:
+        previous = baseline.get((report["cohort"], report["stage"]))
+        if not previous or not previous["users_per_sec"]:
+            continue
+        change = report["users_per_sec"] / previous["users_per_sec"] - 1
+        if change < -tolerance:
+            regressions.append(
+                f"{report['stage']} ({report['cohort']} users): {report['users_per_sec']} users/s, "
+                f"{abs(change):.0%} below baseline {previous['users_per_sec']}"
+            )
+    return regressions
+
+
+async def main(args):
+    mock_graph = MockGraph(latency_ms=args.latency_ms, throttle_rate=args.throttle_rate,
+                           retry_after=args.retry_after, seed=args.seed)
+    Util.GRAPH_BASE_URL = await mock_graph.start()
+    smtp_sink = SMTPSink(latency_ms=args.smtp_latency_ms)
+    smtp_address = smtp_sink.start()
+
+    request_timer = RequestTimer()
+    Util.HTTP_TRACE_CONFIGS.append(request_timer.trace_config)
+
+    reports = []
+    try:
+        for size in args.cohorts:
+            print(f"Running cohort of {size} users...")
+            reports.extend(await run_cohort(size, args, mock_graph, smtp_sink, smtp_address, request_timer))
+    finally:
+        await Util.close_http_session()
+        await mock_graph.stop()
+        smtp_sink.stop()
+    return reports
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark onboarding and teardown against a local Graph and SMTP stand-in")
+    parser.add_argument("--cohorts", default=",".join(str(size) for size in DEFAULT_COHORTS),
+                        help="Comma separated cohort sizes")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("ONBOARDING_CONCURRENCY", 10)),
+                        help="Rows onboarded and members deleted at the same time")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of every Graph request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of Graph requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds of an injected 429")
+    parser.add_argument("--license-mode", choices=Util.LICENSE_MODES, default="user",
+                        help="Assign licenses per user or through the learners group")
+    parser.add_argument("--smtp-latency-ms", type=float, default=5, help="Time the SMTP sink takes per message")
+    parser.add_argument("--smtp-workers", type=int, default=4, help="Outbox workers sending the welcome emails")
+    parser.add_argument("--per-user-limit", type=int, default=1000,
+                        help="Most users added through the one-request-per-user add_users_to_group")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the 429 injection")
+    parser.add_argument("--output", help="Write the stage reports to this JSON file")
+    parser.add_argument("--trace", help="Write the span trace of the whole run to this JSON lines file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_REGRESSION_TOLERANCE,
+                        help="Allowed users/sec drop against the baseline, 0.1 is 10%%")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="Show the scripts' per-user output")
+    args = parser.parse_args(argv)
+    args.cohorts = [int(size) for size in args.cohorts.split(",") if size.strip()]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    reports = asyncio.run(main(args))
+
+    print("\n=== BENCHMARK RESULTS ===")
+    print_reports(reports)
+
+    if args.trace:
+        finish_trace(args.trace)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(reports, output_file, indent=2)
+        print(f"Results saved to {args.output}")
+
+    leftovers = [report for report in reports if report.get("left_in_tenant")]
+    if leftovers:
+        print("\n=== INCOMPLETE TEARDOWN ===")
+        for report in leftovers:
+            print(f"{report['cohort']} users: {report['left_in_tenant']} users left in the tenant, "
+                  f"{report['left_in_group']} in the learners group")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            regressions = find_regressions(reports, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("\n=== REGRESSIONS ===")
+            for regression in regressions:
+                print(regression)
+            sys.exit(1)
+        print("No regressions against the baseline")
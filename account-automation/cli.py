@@ -0,0 +1,242 @@
+## Single command-line entry point for the account automation scripts.
+##
+## Usage: python cli.py <command> [args]
+##
+## Modules are only imported once a command needs them: read-only commands load the
+## HTTP helpers but never the Azure SDK, and `python cli.py startup` times the cold
+## start of every command against its budget.
+
+import argparse
+import importlib
+import os
+import runpy
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules each command needs, imported when it runs (and timed by `cli.py startup`)
+COMMAND_MODULES = {
+    "skus": ("Util",),
+    "user": ("Util",),
+    "members": ("Util",),
+    "onboard": ("Util", "azure.identity"),
+    "teardown": ("CleanUpEvent", "azure.identity"),
+    "reconcile": ("reconcile", "azure.identity"),
+    "orchestrate": ("orchestrator",),
+    "benchmark": ("benchmark",),
+}
+
+# Commands that only read the tenant, they fetch tokens over plain HTTP without the Azure SDK
+READ_ONLY_COMMANDS = {"skus", "user", "members"}
+
+# Cold start budget of each command in milliseconds: interpreter start, argument parsing
+# and the imports the command needs, measured in a fresh process
+STARTUP_BUDGETS_MS = {
+    "skus": 600,
+    "user": 600,
+    "members": 600,
+    "onboard": 1000,
+    "teardown": 1000,
+    "reconcile": 1000,
+    "orchestrate": 300,
+    "benchmark": 800,
+}
+
+# Arguments the timed commands are started with
+STARTUP_PROBE_ARGS = {
+    "user": ["probe@example.com"],
+}
+
+# Set in the processes `cli.py startup` times: load the command's modules, then stop
+STARTUP_PROBE_ENV = "CLI_STARTUP_PROBE"
+
+# Runs per command, the fastest one counts
+STARTUP_PROBE_RUNS = 3
+
+# Scripts the pass-through commands run as __main__
+COMMAND_SCRIPTS = {
+    "onboard": "Util.py",
+    "teardown": "CleanUpEvent.py",
+    "reconcile": "reconcile.py",
+    "orchestrate": "orchestrator.py",
+    "benchmark": "benchmark.py",
+}
+
+
+def load_modules(command):
+    return [importlib.import_module(name) for name in COMMAND_MODULES[command]]
+
+
+def _credentials():
+    return os.getenv("AZURE_TENANT_ID"), os.getenv("AZURE_CLIENT_ID"), os.getenv("AZURE_CLIENT_SECRET")
+
+
+def run_read_only(work):
+    """
+    Run a read-only coroutine function against Graph with HTTP tokens
+
+    Args:
+        work (callable): Takes the Util module and the credentials, returns a coroutine
+    """
+    import asyncio
+    util = importlib.import_module("Util")
+    util.GRAPH_TOKEN_CLIENT = "http"
+
+    async def main():
+        try:
+            await work(util, _credentials())
+        finally:
+            await util.close_http_session()
+
+    asyncio.run(main())
+
+
+def run_skus(args):
+    async def work(util, credentials):
+        catalog = await util.SkuCatalog.load(*credentials)
+        catalog.report()
+
+    run_read_only(work)
+
+
+def run_user(args):
+    async def work(util, credentials):
+        from license_skuids import LICENSE_SKUIDS
+        names = {sku_id: name for name, sku_id in LICENSE_SKUIDS.items()}
+        response = await util.graph_request(
+            "GET", "/users", *credentials,
+            params={
+                "$filter": f"mail eq {util.odata_string(args.email)} or userPrincipalName eq {util.odata_string(args.email)}",
+                "$select": "id,displayName,userPrincipalName,mail,assignedLicenses"
+            }
+        )
+        if response.status != 200:
+            raise Exception(f"Failed to look up user: HTTP {response.status}: {response.text}")
+        users = response.json().get("value", [])
+        if not users:
+            print(f"No user with mail or user principal name {args.email}")
+        for user in users:
+            licenses = [names.get(license["skuId"], license["skuId"]) for license in user.get("assignedLicenses", [])]
+            print(f"{user.get('displayName')} ({user.get('userPrincipalName')}, mail {user.get('mail') or '-'}, id {user['id']})")
+            print(f"  Licenses: {', '.join(licenses) or 'none'}")
+
+    run_read_only(work)
+
+
+def run_members(args):
+    group_id = args.group_id or os.getenv("AISKILLSFEST_LEARNERS_GROUP_ID")
+
+    async def work(util, credentials):
+        count = 0
+        select = ("id",) if args.count else util.GROUP_MEMBER_FIELDS
+        async for member in util.iter_group_members(group_id, *credentials, select=select):
+            count += 1
+            if not args.count:
+                print(f"{member['id']} {member.get('displayName') or ''} {member.get('mail') or ''}")
+        print(f"{count} members in group {group_id}")
+
+    run_read_only(work)
+
+
+def run_script(args):
+    """
+    Run one of the scripts as if it was started directly, with the remaining arguments
+    """
+    script_path = os.path.join(SCRIPT_DIR, COMMAND_SCRIPTS[args.command])
+    sys.argv = [script_path] + args.script_args
+    runpy.run_path(script_path, run_name="__main__")
+
+
+def measure_startup(command, runs=STARTUP_PROBE_RUNS):
+    """
+    Time the cold start of a command in fresh processes
+
+    Returns:
+        float: Fastest of the runs in milliseconds
+    """
+    env = dict(os.environ, **{STARTUP_PROBE_ENV: "1"})
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), command, *STARTUP_PROBE_ARGS.get(command, [])],
+            env=env, cwd=SCRIPT_DIR, check=True
+        )
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def run_startup(args):
+    commands = args.commands or list(COMMAND_MODULES)
+    unknown = [command for command in commands if command not in COMMAND_MODULES]
+    if unknown:
+        raise Exception(f"Unknown commands: {', '.join(unknown)}")
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    print(f"Interpreter start: {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    over_budget = []
+    print(f"{'command':<12} {'cold start':>10} {'budget':>8}")
+    for command in commands:
+        milliseconds = measure_startup(command, args.runs)
+        budget = STARTUP_BUDGETS_MS[command]
+        status = "" if milliseconds <= budget else "OVER BUDGET"
+        if status:
+            over_budget.append(command)
+        print(f"{command:<12} {milliseconds:>7.0f} ms {budget:>5} ms {status}")
+    return 1 if over_budget else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AI Skills Fest account automation")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    skus_parser = commands.add_parser("skus", help="List the tenant's license SKUs and free seats")
+    skus_parser.set_defaults(handler=run_skus)
+
+    user_parser = commands.add_parser("user", help="Look up one user by mail or user principal name")
+    user_parser.add_argument("email")
+    user_parser.set_defaults(handler=run_user)
+
+    members_parser = commands.add_parser("members", help="List the members of a group")
+    members_parser.add_argument("group_id", nargs="?", help="Group to list, the learners group by default")
+    members_parser.add_argument("--count", action="store_true", help="Only count the members")
+    members_parser.set_defaults(handler=run_members)
+
+    script_help = {
+        "onboard": "Onboard the registrations (Util.py)",
+        "teardown": "Tear down the event (CleanUpEvent.py)",
+        "reconcile": "Plan or apply a reconciliation (reconcile.py)",
+        "orchestrate": "Run several events at once (orchestrator.py)",
+        "benchmark": "Benchmark against local stand-ins (benchmark.py)",
+    }
+    for command, help_text in script_help.items():
+        commands.add_parser(command, help=help_text, add_help=False)
+
+    startup_parser = commands.add_parser("startup", help="Check the cold start of every command against its budget")
+    startup_parser.add_argument("commands", nargs="*", metavar="command", help="Commands to time, all by default")
+    startup_parser.add_argument("--runs", type=int, default=STARTUP_PROBE_RUNS, help="Runs per command, the fastest counts")
+    startup_parser.set_defaults(handler=run_startup)
+
+    # Everything after a script command, options included, belongs to the script
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMAND_SCRIPTS:
+        return argparse.Namespace(command=argv[0], script_args=argv[1:], handler=run_script)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if os.getenv(STARTUP_PROBE_ENV) and args.command in COMMAND_MODULES:
+        load_modules(args.command)
+        if args.command in READ_ONLY_COMMANDS and "azure.identity" in sys.modules:
+            print(f"{args.command} imported azure.identity, read-only commands must not need it")
+            return 1
+        return 0
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
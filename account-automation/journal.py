@@ -0,0 +1,161 @@
+## Append-only checkpoint journal for resumable onboarding runs.
+
+import json
+import os
+import threading
+import time
+
+# Stages a CSV row goes through during onboarding, group stages are "grouped:<group ID>"
+JOURNAL_STAGES = ("created", "licensed", "grouped", "emailed")
+
+# Journal used when ONBOARDING_JOURNAL is not set
+ONBOARDING_JOURNAL_PATH = "./data/onboarding_journal.jsonl"
+
+# Stage of the header record that ties a journal to the run it belongs to
+JOURNAL_HEADER_STAGE = "run"
+
+# Stages whose record cannot be rebuilt from the tenant and must survive a crash
+DURABLE_STAGES = {"created"}
+
+
+class OnboardingJournal:
+    """
+    Append-only JSON lines journal of the onboarding stages completed per user
+
+    Every completed stage is appended as one line keyed by the user principal name,
+    together with what a later stage needs (user ID, temporary password, email). When
+    the journal is opened again it is replayed into memory, so a rerun can skip the
+    stages that already completed. Onboarding still confirms that a journaled user is
+    in the tenant under the same ID before resuming it, from the tenant snapshot or
+    with one $batch lookup per chunk of rows.
+
+    "created" records hold the temporary password and are fsynced before the run goes
+    on; the other stages can be redone safely and are only flushed.
+
+    The first record of a journal names its scope, such as the tenant and registrations
+    CSV of the run. A journal left by another scope is moved aside instead of replayed,
+    and discard() removes the journal once a run finished cleanly or the event was torn
+    down, so a later run never resumes users that no longer exist.
+    """
+
+    def __init__(self, journal_path, scope=None):
+        """
+        Args:
+            journal_path (str): Path of the journal file, created if missing
+            scope (str, optional): What the journal belongs to, a journal written for
+                another scope is not replayed
+        """
+        self.journal_path = journal_path
+        self.scope = scope
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+        # The journal holds temporary passwords, keep it readable by the owner only
+        is_new = not os.path.isfile(journal_path)
+        fd = os.open(journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._file = os.fdopen(fd, "a", encoding="utf-8")
+        if is_new:
+            self._file.write(json.dumps({"stage": JOURNAL_HEADER_STAGE, "scope": scope, "ts": time.time()}) + "\n")
+            self._file.flush()
+
+    def _load(self):
+        if not os.path.isfile(self.journal_path):
+            return
+
+        records = []
+        with open(self.journal_path, "r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A run killed mid-write leaves a partial last line
+                    continue
+
+        header = records[0] if records and records[0].get("stage") == JOURNAL_HEADER_STAGE else {}
+        if header.get("scope") != self.scope:
+            stale_path = self._rotate()
+            print(f"Journal {self.journal_path} belongs to another run ({header.get('scope')}), moved it to {stale_path}")
+            return
+
+        replayed = records[1:] if header else records
+        for record in replayed:
+            self._apply(record)
+        print(f"Replayed {len(replayed)} journal records for {len(self.entries)} users from {self.journal_path}")
+
+    def _rotate(self):
+        root, extension = os.path.splitext(self.journal_path)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(self.journal_path)))
+        stale_path = f"{root}-{stamp}{extension}"
+        os.replace(self.journal_path, stale_path)
+        return stale_path
+
+    def _apply(self, record):
+        # A user created again starts over, stages of the account it replaces do not count
+        if record["stage"] == "created":
+            self.entries.pop(record["key"], None)
+        entry = self.entries.setdefault(record["key"], {"stages": set()})
+        entry["stages"].add(record["stage"])
+        for field, value in record.items():
+            if field not in ("key", "stage", "ts") and value is not None:
+                entry[field] = value
+
+    def record(self, key, stage, **fields):
+        """
+        Append a completed stage for a user
+
+        Args:
+            key (str): User principal name of the row
+            stage (str): One of JOURNAL_STAGES, or "grouped:<group ID>"
+            **fields: Values later stages need, such as user_id or temp_password
+        """
+        record = {"key": key, "stage": stage, "ts": time.time(), **fields}
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            if stage in DURABLE_STAGES:
+                os.fsync(self._file.fileno())
+            self._apply(record)
+
+    def get(self, key):
+        """
+        Returns:
+            dict: Replayed entry with "stages" and recorded fields, or None
+        """
+        return self.entries.get(key)
+
+    def has(self, key, stage):
+        entry = self.entries.get(key)
+        return entry is not None and stage in entry["stages"]
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def discard(self):
+        """
+        Close the journal and delete it, nothing of the run is left to resume
+        """
+        self.close()
+        discard_journal(self.journal_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def discard_journal(journal_path):
+    """
+    Delete the onboarding journal at journal_path, if there is one
+
+    Returns:
+        bool: True if a journal was deleted
+    """
+    if not journal_path or not os.path.isfile(journal_path):
+        return False
+    os.remove(journal_path)
+    print(f"Removed onboarding journal {journal_path}")
+    return True
@@ -0,0 +1,378 @@
+## Shared SMTP sending for the welcome and thank-you emails.
+
+import asyncio
+import base64
+import html
+import smtplib
+import string
+import queue
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import parseaddr
+from tracing import trace_span
+
+# Default number of open SMTP connections per pool
+SMTP_POOL_SIZE = 4
+
+# Open a fresh connection after this many messages, many servers cap it per session
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+
+# Seconds between two outbox progress lines
+OUTBOX_REPORT_INTERVAL_SECONDS = 10
+
+# Stand-ins written into a template's MIME skeleton where the recipient and body go
+MERGE_TO_PLACEHOLDER = "@@MERGE-TO@@"
+MERGE_BODY_PLACEHOLDER = "@@MERGE-BODY@@"
+
+# Errors raised when the server dropped or refused a connection we had open
+SMTP_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+# Reply code of a server that is closing the connection, even when it answers a single message
+SMTP_SERVICE_CLOSING_CODE = 421
+
+
+class SMTPConnectionPool:
+    """
+    Pool of authenticated SMTP connections reused across messages
+
+    Opening a connection costs a TCP handshake, STARTTLS and a login, so connections are
+    kept open and handed from one message to the next. A connection is closed and
+    replaced after max_messages_per_connection messages, and a message is sent again on
+    a new connection when the server dropped the old one. A message the server refuses
+    (a bad recipient, a rejected body) only fails that message: smtplib resets the
+    session and the connection goes back to the pool.
+
+    The pool is thread-safe: send() blocks and is meant to be called from worker
+    threads (for example through loop.run_in_executor).
+    """
+
+    def __init__(self, smtp_server, smtp_port, sender_email, sender_password=None, size=SMTP_POOL_SIZE,
+                 max_messages_per_connection=SMTP_MAX_MESSAGES_PER_CONNECTION, use_tls=True, timeout=30):
+        """
+        Args:
+            smtp_server (str): SMTP server address
+            smtp_port (int): SMTP server port
+            sender_email (str): Sender's email address, also used as the login
+            sender_password (str, optional): Sender's password, no login is done without it
+            size (int): Maximum number of connections open at the same time
+            max_messages_per_connection (int): Messages sent before a connection is replaced
+            use_tls (bool): Upgrade connections with STARTTLS, disable for a local debugging server
+            timeout (int): Socket timeout in seconds
+        """
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.max_messages_per_connection = max_messages_per_connection
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    def _connect(self):
+        # Traced separately from sends: handshake, STARTTLS and login are the expensive part
+        with trace_span("smtp connect", server=self.smtp_server):
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+            try:
+                if self.use_tls:
+                    server.starttls()  # Secure the connection
+                if self.sender_password:
+                    server.login(self.sender_email, self.sender_password)
+            except Exception:
+                self._quit(server)
+                raise
+        self.connections_opened += 1
+        return {"server": server, "sent": 0}
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _checkin(self, connection):
+        if self._closed or connection["sent"] >= self.max_messages_per_connection:
+            self._quit(connection["server"])
+        else:
+            self._idle.put(connection)
+
+    def send(self, msg, recipients, from_addr=None):
+        """
+        Send one message over a pooled connection
+
+        Args:
+            msg (Message or str): Message to send
+            recipients (list): Envelope recipient addresses
+            from_addr (str, optional): Envelope sender, defaults to sender_email
+        """
+        if self._closed:
+            raise RuntimeError("SMTP connection pool is closed")
+
+        message = msg.as_string() if hasattr(msg, "as_string") else msg
+        with self._slots, trace_span("smtp send") as span:
+            connection = self._checkout()
+            try:
+                try:
+                    connection["server"].sendmail(from_addr or self.sender_email, recipients, message)
+                    span["retries"] = 0
+                except SMTP_CONNECTION_ERRORS:
+                    # The server dropped the connection, send again on a new one
+                    self._quit(connection["server"])
+                    connection = self._connect()
+                    connection["server"].sendmail(from_addr or self.sender_email, recipients, message)
+                    span["retries"] = 1
+            except smtplib.SMTPException as e:
+                if isinstance(e, SMTP_CONNECTION_ERRORS) or getattr(e, "smtp_code", None) == SMTP_SERVICE_CLOSING_CODE:
+                    self._quit(connection["server"])
+                else:
+                    # Refused for this message only, the connection is still good
+                    self._checkin(connection)
+                raise
+            except Exception:
+                self._quit(connection["server"])
+                raise
+
+            connection["sent"] += 1
+            self.messages_sent += 1
+            self._checkin(connection)
+
+    def close(self):
+        """
+        Close every idle connection, connections in use are closed when returned
+        """
+        self._closed = True
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(connection["server"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Pools shared by every sender in the process
+_smtp_pools = {}
+_smtp_pools_lock = threading.Lock()
+
+def get_smtp_pool(smtp_server, smtp_port, sender_email, sender_password=None, use_tls=True):
+    """
+    Get the process-wide SMTP connection pool for the given server and account
+    """
+    key = (smtp_server, int(smtp_port), sender_email, sender_password, use_tls)
+    with _smtp_pools_lock:
+        pool = _smtp_pools.get(key)
+        if pool is None or pool._closed:
+            pool = SMTPConnectionPool(smtp_server, int(smtp_port), sender_email, sender_password, use_tls=use_tls)
+            _smtp_pools[key] = pool
+        return pool
+
+def close_smtp_pools():
+    """
+    Close every shared SMTP connection pool
+    """
+    with _smtp_pools_lock:
+        for pool in _smtp_pools.values():
+            pool.close()
+        _smtp_pools.clear()
+
+
+class EmailOutbox:
+    """
+    Queue of outgoing emails drained by worker tasks at a limited rate
+
+    Callers enqueue a message and move on, so a slow SMTP server no longer holds up
+    the work that produced the email. Worker tasks send queued messages through an
+    SMTPConnectionPool, spaced to stay under max_per_second, and a reporter task
+    prints the queue depth and send rate while the outbox is running.
+    """
+
+    def __init__(self, smtp_pool, workers=SMTP_POOL_SIZE, max_per_second=None, report_interval=OUTBOX_REPORT_INTERVAL_SECONDS):
+        """
+        Args:
+            smtp_pool (SMTPConnectionPool): Pool the messages are sent through
+            workers (int): Number of messages sent at the same time
+            max_per_second (float, optional): Send rate limit, unlimited when None
+            report_interval (float): Seconds between progress lines, 0 to disable them
+        """
+        self.smtp_pool = smtp_pool
+        self.workers = workers
+        self.max_per_second = max_per_second
+        self.report_interval = report_interval
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.results = []
+        self._queue = None
+        self._tasks = []
+        self._next_send_at = 0.0
+        self._started_at = None
+
+    def _start(self):
+        self._queue = asyncio.Queue()
+        self._started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.report_interval:
+            self._tasks.append(asyncio.create_task(self._reporter()))
+
+    def enqueue(self, msg, recipients, label=None):
+        """
+        Queue a message for sending, must be called from the event loop
+
+        Args:
+            msg (Message or str): Message to send
+            recipients (list): Envelope recipient addresses
+            label (str, optional): Name used for the message in results and logs
+
+        Returns:
+            asyncio.Future: Resolves to True once sent or False if sending failed
+        """
+        if self._queue is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((msg, recipients, label or recipients[0], future))
+        self.queued += 1
+        return future
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def send_rate(self):
+        if self._started_at is None:
+            return 0.0
+        return self.sent / max(time.monotonic() - self._started_at, 1e-9)
+
+    async def _wait_for_rate_limit(self):
+        if not self.max_per_second:
+            return
+        # Reserve the next send slot, then sleep until it comes up
+        now = time.monotonic()
+        send_at = max(now, self._next_send_at)
+        self._next_send_at = send_at + 1.0 / self.max_per_second
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            msg, recipients, label, future = await self._queue.get()
+            try:
+                await self._wait_for_rate_limit()
+                # smtplib is blocking, send from a worker thread
+                await loop.run_in_executor(None, self.smtp_pool.send, msg, recipients)
+                self.sent += 1
+                self.results.append({"recipient": label, "sent": True})
+                if not future.done():
+                    future.set_result(True)
+            except Exception as e:
+                self.failed += 1
+                self.results.append({"recipient": label, "sent": False, "reason": str(e)})
+                print(f"Failed to send email to {label}: {str(e)}")
+                if not future.done():
+                    future.set_result(False)
+            finally:
+                self._queue.task_done()
+
+    def report(self):
+        print(f"Outbox: {self.depth} queued, {self.sent} sent, {self.failed} failed, {self.send_rate():.1f} emails/s")
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.report()
+
+    async def drain(self):
+        """
+        Wait until every queued message was handled, then stop the workers
+
+        Returns:
+            list: Per-message results with recipient, sent and failure reason
+        """
+        if self._queue is not None:
+            await self._queue.join()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._queue = None
+            self._tasks = []
+            self.report()
+        return self.results
+
+
+class MailMergeTemplate:
+    """
+    Email template compiled once and rendered per recipient
+
+    The MIME structure (headers, multipart boundary, HTML part headers) is built and
+    serialized a single time with stand-ins for the recipient and the body. Rendering
+    only fills the HTML body, base64 encodes it and joins the precompiled pieces, so
+    thousands of recipients cost no more MIME work than one.
+    """
+
+    def __init__(self, sender_email, subject, html_body, cc=()):
+        """
+        Args:
+            sender_email (str): From address
+            subject (str): Subject line
+            html_body (str): HTML body with string.Template fields such as $first_name,
+                braces of inline CSS or scripts are left as they are
+            cc (list, optional): Addresses copied on every email
+        """
+        self.html_body = html_body
+        self._body_template = string.Template(html_body)
+        self.cc = list(cc)
+
+        msg = MIMEMultipart()
+        msg['From'] = sender_email
+        msg['To'] = MERGE_TO_PLACEHOLDER
+        if self.cc:
+            msg['Cc'] = ", ".join(self.cc)
+        msg['Subject'] = subject
+        part = MIMEText("", "html", "utf-8")
+        part.set_payload(MERGE_BODY_PLACEHOLDER)
+        msg.attach(part)
+
+        head, rest = msg.as_string().split(MERGE_TO_PLACEHOLDER, 1)
+        middle, tail = rest.split(MERGE_BODY_PLACEHOLDER, 1)
+        self._pieces = (head, middle, tail)
+
+    def render(self, to_email, **fields):
+        """
+        Render the email for one recipient
+
+        to_email goes into the precompiled To: header as it is, so anything but a single
+        plain address is refused with an Exception.
+
+        Args:
+            to_email (str): Recipient address
+            **fields: Values for the body's $ fields, HTML escaped
+
+        Returns:
+            tuple: (message, recipients) with the message as a string, ready for
+                SMTPConnectionPool.send or EmailOutbox.enqueue
+        """
+        # A line break in the address would start a header of its own
+        if "\r" in to_email or "\n" in to_email or parseaddr(to_email) != ("", to_email) or "@" not in to_email:
+            raise Exception(f"Invalid recipient address: {to_email!r}")
+
+        body = self._body_template.substitute({name: html.escape(str(value)) for name, value in fields.items()})
+        encoded_body = base64.encodebytes(body.encode("utf-8")).decode("ascii")
+        head, middle, tail = self._pieces
+        return f"{head}{to_email}{middle}{encoded_body}{tail}", [to_email] + self.cc
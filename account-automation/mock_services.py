@@ -0,0 +1,444 @@
+## Local stand-ins for Microsoft Graph and an SMTP server, used by benchmark.py.
+
+import asyncio
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, unquote, urlencode
+from aiohttp import web
+
+# Page size used when a listing does not ask for one
+MOCK_DEFAULT_PAGE_SIZE = 100
+
+# Pieces of a Graph $filter the stand-in understands: "<field> eq '<value>'" and
+# "<field> in ('<value>', ...)" joined by "or"
+FILTER_EQ_PATTERN = re.compile(r"(\w+) eq '((?:[^']|'')*)'")
+FILTER_VALUE_PATTERN = re.compile(r"'((?:[^']|'')*)'")
+FILTER_IN_PATTERN = re.compile(r"(\w+) in \(([^)]*)\)")
+
+# Group members added per PATCH with members@odata.bind, same limit as Graph
+MOCK_MEMBERS_BIND_LIMIT = 20
+
+
+class MockGraph:
+    """
+    In-memory stand-in for the parts of Microsoft Graph v1.0 the scripts call
+
+    Supports users (list, filter, get, create, delete, assignLicense), subscribed SKUs
+    with seat limits, group-based licensing, group members (list, add, remove, PATCH
+    members@odata.bind) and JSON $batch. Every HTTP request
+    waits latency_ms first, and a share of the requests (throttle_rate) answers 429 with
+    a Retry-After header so throttling and retries can be exercised.
+
+    Request counts per operation are kept in `requests`, with "$batch sub" entries for
+    the requests carried inside $batch envelopes, and `http_requests` counts the Graph
+    HTTP requests themselves, a $batch envelope once.
+    """
+
+    def __init__(self, latency_ms=0, throttle_rate=0.0, retry_after=1, seed=None):
+        """
+        Args:
+            latency_ms (float): Delay added to every HTTP request
+            throttle_rate (float): Share of requests and sub-requests answered with 429
+            retry_after (int): Retry-After seconds sent with a 429
+            seed (int, optional): Seed for the throttling decisions
+        """
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.base_url = None
+        self.requests = Counter()
+        self.http_requests = 0
+        self.throttled = 0
+        self.reset()
+
+        self.routes = [
+            ("GET", re.compile(r"^/users$"), self.list_users),
+            ("POST", re.compile(r"^/users$"), self.create_user),
+            ("GET", re.compile(r"^/users/([^/]+)$"), self.get_user),
+            ("DELETE", re.compile(r"^/users/([^/]+)$"), self.delete_user),
+            ("POST", re.compile(r"^/users/([^/]+)/assignLicense$"), self.assign_license),
+            ("GET", re.compile(r"^/subscribedSkus$"), self.list_skus),
+            ("GET", re.compile(r"^/groups/([^/]+)$"), self.get_group),
+            ("PATCH", re.compile(r"^/groups/([^/]+)$"), self.bind_members),
+            ("POST", re.compile(r"^/groups/([^/]+)/assignLicense$"), self.assign_group_license),
+            ("GET", re.compile(r"^/groups/([^/]+)/members$"), self.list_members),
+            ("POST", re.compile(r"^/groups/([^/]+)/members/\$ref$"), self.add_member),
+            ("DELETE", re.compile(r"^/groups/([^/]+)/members/([^/]+)/\$ref$"), self.remove_member),
+        ]
+
+    def reset(self):
+        """
+        Drop every user and group membership
+        """
+        self.users = {}
+        self.upn_index = {}
+        self.groups = {}
+        self.licenses = {}
+        self.group_licenses = {}
+        self.skus = {}
+
+    def add_sku(self, sku_id, part_number, seats):
+        """
+        Subscribe the tenant to a SKU with `seats` enabled units
+        """
+        self.skus[sku_id] = {"skuPartNumber": part_number, "seats": seats}
+
+    def add_group(self, group_id=None):
+        group_id = group_id or str(uuid.uuid4())
+        self.groups.setdefault(group_id, [])
+        return group_id
+
+    def add_user(self, user_principal_name, mail=None, display_name=None):
+        user_id = str(uuid.uuid4())
+        self.users[user_id] = {
+            "id": user_id,
+            "userPrincipalName": user_principal_name,
+            "mail": mail,
+            "displayName": display_name or user_principal_name
+        }
+        self.upn_index[user_principal_name.lower()] = user_id
+        return user_id
+
+    # HTTP plumbing
+
+    def _throttle(self):
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            self.throttled += 1
+            return True
+        return False
+
+    def _throttled_response(self):
+        body = {"error": {"code": "TooManyRequests", "message": "Too many requests"}}
+        return 429, body, {"Retry-After": str(self.retry_after)}
+
+    def dispatch(self, method, path, query, body):
+        """
+        Run one Graph operation
+
+        Args:
+            method (str): HTTP method
+            path (str): Path relative to /v1.0
+            query (dict): Query parameters, one value each
+            body (dict or None): JSON body
+
+        Returns:
+            tuple: (status, JSON body or None, headers)
+        """
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                self.requests[f"{method} {pattern.pattern.strip('^$')}"] += 1
+                status, response_body = handler(*[unquote(group) for group in match.groups()], query=query, body=body)
+                return status, response_body, {}
+        self.requests[f"{method} (unknown)"] += 1
+        return 404, {"error": {"code": "ResourceNotFound", "message": f"No route for {method} {path}"}}, {}
+
+    async def handle(self, request):
+        self.http_requests += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if self._throttle():
+            status, body, headers = self._throttled_response()
+            return web.json_response(body, status=status, headers=headers)
+
+        path = request.path[len("/v1.0"):] if request.path.startswith("/v1.0") else request.path
+        body = await request.json() if request.can_read_body else None
+        query = {key: value for key, value in request.query.items()}
+
+        if request.method == "POST" and path == "/$batch":
+            self.requests["POST /$batch"] += 1
+            return web.json_response(self.batch(body))
+
+        status, response_body, headers = self.dispatch(request.method, path, query, body)
+        if response_body is None:
+            return web.Response(status=status, headers=headers)
+        return web.json_response(response_body, status=status, headers=headers)
+
+    def batch(self, body):
+        responses = []
+        for sub_request in body.get("requests", []):
+            self.requests["$batch sub"] += 1
+            if self._throttle():
+                status, response_body, headers = self._throttled_response()
+            else:
+                parts = urlsplit(sub_request["url"])
+                query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+                status, response_body, headers = self.dispatch(sub_request["method"], parts.path, query, sub_request.get("body"))
+            responses.append({"id": sub_request["id"], "status": status, "headers": headers, "body": response_body})
+        return {"responses": responses}
+
+    def _page(self, items, path, query):
+        # The skip token is an offset, like a live listing it shifts when items are removed between pages
+        top = int(query.get("$top", MOCK_DEFAULT_PAGE_SIZE))
+        offset = int(query.get("$skiptoken", 0))
+        page = {"value": items[offset:offset + top]}
+        if offset + top < len(items):
+            next_query = dict(query, **{"$skiptoken": str(offset + top)})
+            page["@odata.nextLink"] = f"{self.base_url}{path}?{urlencode(next_query)}"
+        return page
+
+    # Users
+
+    def _find_user(self, user_key):
+        if user_key in self.users:
+            return self.users[user_key]
+        user_id = self.upn_index.get(user_key.lower())
+        return self.users.get(user_id) if user_id else None
+
+    def list_users(self, query, body):
+        users = [
+            dict(user, assignedLicenses=[{"skuId": sku_id} for sku_id in sorted(self._user_skus(user["id"]))])
+            for user in self.users.values()
+        ]
+        if "$filter" in query:
+            conditions = FILTER_EQ_PATTERN.findall(query["$filter"])
+            for field, values in FILTER_IN_PATTERN.findall(query["$filter"]):
+                conditions.extend((field, value) for value in FILTER_VALUE_PATTERN.findall(values))
+            # Quotes inside OData string literals are doubled
+            conditions = [(field, value.replace("''", "'")) for field, value in conditions]
+            users = [
+                user for user in users
+                if any((user.get(field) or "").lower() == value.lower() for field, value in conditions)
+            ]
+        return 200, self._page(users, "/users", query)
+
+    def get_user(self, user_key, query, body):
+        user = self._find_user(user_key)
+        if user is None:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "User not found"}}
+        return 200, dict(user, assignedLicenses=[{"skuId": sku_id} for sku_id in sorted(self._user_skus(user["id"]))])
+
+    def create_user(self, query, body):
+        upn = body.get("userPrincipalName", "")
+        if upn.lower() in self.upn_index:
+            return 400, {"error": {"code": "Request_BadRequest", "message": "userPrincipalName already exists"}}
+        user_id = self.add_user(upn, body.get("mail"), body.get("displayName"))
+        return 201, self.users[user_id]
+
+    def delete_user(self, user_key, query, body):
+        user = self._find_user(user_key)
+        if user is None:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "User not found"}}
+        del self.users[user["id"]]
+        self.upn_index.pop(user["userPrincipalName"].lower(), None)
+        self.licenses.pop(user["id"], None)
+        for members in self.groups.values():
+            if user["id"] in members:
+                members.remove(user["id"])
+        return 204, None
+
+    def assign_license(self, user_key, query, body):
+        user = self._find_user(user_key)
+        if user is None:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "User not found"}}
+        assigned = self.licenses.setdefault(user["id"], set())
+        for license in body.get("addLicenses", []):
+            sku = self.skus.get(license["skuId"])
+            if self.skus and license["skuId"] not in assigned and (sku is None or self._consumed(license["skuId"]) >= sku["seats"]):
+                message = f"License assignment failed because service plans {license['skuId']} does not have any available licenses"
+                return 400, {"error": {"code": "Request_BadRequest", "message": message}}
+        assigned.update(license["skuId"] for license in body.get("addLicenses", []))
+        assigned.difference_update(body.get("removeLicenses", []))
+        return 200, user
+
+    def _user_skus(self, user_id):
+        # Direct assignments plus the licenses inherited from licensed groups
+        skus = set(self.licenses.get(user_id, ()))
+        for group_id, group_skus in self.group_licenses.items():
+            if user_id in self.groups.get(group_id, ()):
+                skus.update(group_skus)
+        return skus
+
+    def _consumed(self, sku_id):
+        return sum(1 for user_id in self.users if sku_id in self._user_skus(user_id))
+
+    def list_skus(self, query, body):
+        return 200, {"value": [
+            {
+                "skuId": sku_id,
+                "skuPartNumber": sku["skuPartNumber"],
+                "capabilityStatus": "Enabled",
+                "consumedUnits": self._consumed(sku_id),
+                "prepaidUnits": {"enabled": sku["seats"], "suspended": 0, "warning": 0}
+            }
+            for sku_id, sku in self.skus.items()
+        ]}
+
+    # Groups
+
+    def get_group(self, group_id, query, body):
+        if group_id not in self.groups:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "Group not found"}}
+        assigned = [{"skuId": sku_id, "disabledPlans": []} for sku_id in sorted(self.group_licenses.get(group_id, ()))]
+        return 200, {"id": group_id, "assignedLicenses": assigned}
+
+    def assign_group_license(self, group_id, query, body):
+        if group_id not in self.groups:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "Group not found"}}
+        assigned = self.group_licenses.setdefault(group_id, set())
+        assigned.update(license["skuId"] for license in body.get("addLicenses", []))
+        assigned.difference_update(body.get("removeLicenses", []))
+        return 202, {"id": group_id}
+
+    def _member(self, member_id):
+        user = self.users.get(member_id)
+        if user is None:
+            return {"@odata.type": "#microsoft.graph.directoryObject", "id": member_id}
+        return {"@odata.type": "#microsoft.graph.user", **user}
+
+    def list_members(self, group_id, query, body):
+        if group_id not in self.groups:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "Group not found"}}
+        members = [self._member(member_id) for member_id in self.groups[group_id]]
+        return 200, self._page(members, f"/groups/{group_id}/members", query)
+
+    def _add(self, group_id, member_id):
+        if group_id not in self.groups or member_id not in self.users:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "Object not found"}}
+        if member_id in self.groups[group_id]:
+            return 400, {"error": {"code": "Request_BadRequest", "message": "One or more added object references already exist"}}
+        self.groups[group_id].append(member_id)
+        return 204, None
+
+    def add_member(self, group_id, query, body):
+        return self._add(group_id, body["@odata.id"].rstrip("/").rsplit("/", 1)[-1])
+
+    def bind_members(self, group_id, query, body):
+        member_ids = [reference.rstrip("/").rsplit("/", 1)[-1] for reference in body.get("members@odata.bind", [])]
+        if len(member_ids) > MOCK_MEMBERS_BIND_LIMIT:
+            return 400, {"error": {"code": "Request_BadRequest", "message": "Too many members in one request"}}
+        members = self.groups.get(group_id)
+        if members is None or any(member_id not in self.users or member_id in members for member_id in member_ids):
+            # Graph applies the whole PATCH or nothing
+            return 400, {"error": {"code": "Request_BadRequest", "message": "Invalid or existing member reference"}}
+        members.extend(member_ids)
+        return 204, None
+
+    def remove_member(self, group_id, member_id, query, body):
+        members = self.groups.get(group_id)
+        if members is None or member_id not in members:
+            return 404, {"error": {"code": "Request_ResourceNotFound", "message": "Member not found"}}
+        members.remove(member_id)
+        return 204, None
+
+    async def issue_token(self, request):
+        # Client credentials token endpoint, serve the stand-in's root as LOGIN_BASE_URL
+        form = await request.post()
+        self.requests["POST token"] += 1
+        if form.get("grant_type") != "client_credentials":
+            return web.json_response({"error": "unsupported_grant_type"}, status=400)
+        return web.json_response({"token_type": "Bearer", "expires_in": 3599, "access_token": f"mock-{form.get('client_id')}"})
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Serve the stand-in on the running event loop
+
+        Returns:
+            str: Base URL to use as GRAPH_BASE_URL
+        """
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/{tenant}/oauth2/v2.0/token", self.issue_token)
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{bound_port}/v1.0"
+        return self.base_url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sink = self.server.sink
+        self.reply("220 localhost SMTP sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 localhost")
+            elif command.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                if sink.latency_ms:
+                    time.sleep(sink.latency_ms / 1000)
+                sink.record(size)
+                self.reply("250 OK: queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class SMTPSink:
+    """
+    Local SMTP server that accepts every message and only counts it
+
+    Speaks plain SMTP without STARTTLS or AUTH, so pools sending to it need use_tls=False
+    and no password.
+    """
+
+    def __init__(self, latency_ms=0):
+        """
+        Args:
+            latency_ms (float): Delay before each message is accepted
+        """
+        self.latency_ms = latency_ms
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def record(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self, host="127.0.0.1", port=0):
+        """
+        Serve in a background thread
+
+        Returns:
+            tuple: (host, port) the sink listens on
+        """
+        sink = self
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+            def verify_request(self, request, client_address):
+                with sink._lock:
+                    sink.connections += 1
+                return True
+
+        self._server = Server((host, port), _SMTPSinkHandler)
+        self._server.sink = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,214 @@
+## Run the onboarding or teardown pipeline of several events at once, one worker process per event.
+##
+## Usage: python orchestrator.py onboard|teardown events.json [--parallel N] [--output summary.json]
+##
+## events.json lists the events, each with its own .env (tenant credentials, group IDs,
+## SMTP settings and limits such as ONBOARDING_CONCURRENCY or SMTP_MAX_PER_SECOND) and a
+## working directory whose ./data folder holds the event's CSVs, journal and traces:
+##
+## {"events": [{"name": "miami", "env_file": "events/miami/.env", "workdir": "events/miami"}]}
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from dotenv import dotenv_values
+
+# Script each pipeline runs
+PIPELINE_SCRIPTS = {
+    "onboard": "Util.py",
+    "teardown": "CleanUpEvent.py"
+}
+
+# Settings every event's .env has to define, so no event runs against another tenant
+REQUIRED_EVENT_SETTINGS = ("AZURE_TENANT_ID", "AZURE_CLIENT_ID", "AZURE_CLIENT_SECRET", "AISKILLSFEST_LEARNERS_GROUP_ID")
+
+# Settings of the orchestrator's own environment that are not passed on to the workers,
+# a worker only sees what its event's .env defines
+EVENT_SETTING_PREFIXES = (
+    "AZURE_", "AISKILLSFEST_", "SMTP_", "GRAPH_", "ONBOARDING_", "TEARDOWN_", "LICENSE_",
+    "TRACE_", "PARTICIPANT_", "RUN_SUMMARY_", "ENV_FILE"
+)
+
+# Lines of a failed worker's log shown in the summary
+FAILED_LOG_TAIL_LINES = 5
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_manifest(manifest_path):
+    """
+    Read and check an events manifest
+
+    Relative paths in the manifest are taken from the manifest's folder. The working
+    directory of an event defaults to the folder of its .env file.
+
+    Args:
+        manifest_path (str): JSON file with an "events" list
+
+    Returns:
+        list: Events with "name", absolute "env_file" and "workdir", and "env" overrides
+    """
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    events = []
+    names = set()
+    for entry in manifest.get("events", []):
+        name = entry.get("name")
+        if not name or name in names:
+            raise Exception(f"Every event needs a unique name, got {name!r}")
+        names.add(name)
+
+        env_file = os.path.join(base_dir, entry["env_file"])
+        workdir = os.path.join(base_dir, entry["workdir"]) if entry.get("workdir") else os.path.dirname(env_file)
+        if not os.path.isfile(env_file):
+            raise Exception(f"Event {name}: env file {env_file} not found")
+        if not os.path.isdir(workdir):
+            raise Exception(f"Event {name}: working directory {workdir} not found")
+
+        settings = dict(dotenv_values(env_file), **entry.get("env", {}))
+        missing = [setting for setting in REQUIRED_EVENT_SETTINGS if not settings.get(setting)]
+        if missing:
+            raise Exception(f"Event {name}: {env_file} does not set {', '.join(missing)}")
+
+        events.append({"name": name, "env_file": env_file, "workdir": workdir, "env": entry.get("env", {})})
+
+    if not events:
+        raise Exception(f"No events in {manifest_path}")
+    return events
+
+
+def build_worker_env(event, summary_path):
+    """
+    Environment of an event's worker process
+
+    The orchestrator's own event settings are dropped, the worker loads the event's
+    .env through ENV_FILE instead of the shared one next to the scripts.
+    """
+    env = {
+        key: value for key, value in os.environ.items()
+        if not key.startswith(EVENT_SETTING_PREFIXES)
+    }
+    env.update(event["env"])
+    env["ENV_FILE"] = event["env_file"]
+    env["RUN_SUMMARY_FILE"] = summary_path
+    env["PYTHONUNBUFFERED"] = "1"
+    return env
+
+
+async def run_event(event, pipeline, slots):
+    """
+    Run one event's pipeline in its own process and collect its summary
+
+    Args:
+        event (dict): Event from load_manifest
+        pipeline (str): "onboard" or "teardown"
+        slots (asyncio.Semaphore): Limits how many events run at the same time
+
+    Returns:
+        dict: The worker's run summary with the event name, status, exit code,
+            seconds and log file
+    """
+    async with slots:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        log_dir = os.path.join(event["workdir"], "data", "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, f"{pipeline}-{stamp}.log")
+        summary_path = os.path.join(log_dir, f"{pipeline}-{stamp}.summary.json")
+
+        print(f"[{event['name']}] {pipeline} started, log in {log_path}")
+        started = time.monotonic()
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(SCRIPT_DIR, PIPELINE_SCRIPTS[pipeline]),
+                cwd=event["workdir"],
+                env=build_worker_env(event, summary_path),
+                stdout=log_file,
+                stderr=asyncio.subprocess.STDOUT
+            )
+            returncode = await process.wait()
+        seconds = time.monotonic() - started
+
+        summary = {}
+        if os.path.isfile(summary_path):
+            with open(summary_path, "r", encoding="utf-8") as summary_file:
+                summary = json.load(summary_file)
+
+        result = dict(summary, event=event["name"], exit_code=returncode, seconds=round(seconds, 2), log=log_path)
+        result["status"] = "ok" if returncode == 0 and summary.get("completed") else "failed"
+        if result["status"] == "failed":
+            with open(log_path, "r", encoding="utf-8", errors="replace") as log_file:
+                result["log_tail"] = log_file.read().splitlines()[-FAILED_LOG_TAIL_LINES:]
+        print(f"[{event['name']}] {pipeline} {result['status']} in {seconds:.1f}s")
+        return result
+
+
+def combine_summaries(pipeline, results, seconds):
+    """
+    Add up the event summaries into one
+
+    Returns:
+        dict: Totals of every numeric summary field, events by status, the wall time
+            and the combined users per second
+    """
+    totals = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key not in ("exit_code", "seconds"):
+                totals[key] = totals.get(key, 0) + value
+    return {
+        "pipeline": pipeline,
+        "events": len(results),
+        "succeeded": sum(1 for result in results if result["status"] == "ok"),
+        "failed": [result["event"] for result in results if result["status"] != "ok"],
+        "seconds": round(seconds, 2),
+        "users_per_sec": round(totals.get("users", 0) / seconds, 1) if seconds else 0.0,
+        "totals": totals,
+        "results": results
+    }
+
+
+def print_summary(combined):
+    print(f"\n=== {combined['pipeline'].upper()} SUMMARY ===")
+    print(f"{'event':<20} {'status':<7} {'users':>6} {'seconds':>8} {'users/s':>8} {'requests':>8}")
+    for result in combined["results"]:
+        users = result.get("users", 0)
+        print(f"{result['event']:<20} {result['status']:<7} {users:>6} {result['seconds']:>8.1f} "
+              f"{users / result['seconds'] if result['seconds'] else 0:>8.1f} {result.get('graph_requests', 0):>8}")
+        for line in result.get("log_tail", []):
+            print(f"    {line}")
+    print(f"{combined['succeeded']}/{combined['events']} events completed in {combined['seconds']:.1f}s, "
+          f"{combined['totals'].get('users', 0)} users at {combined['users_per_sec']} users/s")
+    for key, value in sorted(combined["totals"].items()):
+        print(f"- {key}: {value}")
+
+
+async def main(args):
+    events = load_manifest(args.manifest)
+    slots = asyncio.Semaphore(args.parallel or len(events))
+    started = time.monotonic()
+    results = await asyncio.gather(*(run_event(event, args.pipeline, slots) for event in events))
+    combined = combine_summaries(args.pipeline, results, time.monotonic() - started)
+    print_summary(combined)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(combined, output_file, indent=2)
+        print(f"Summary saved to {args.output}")
+    return 0 if not combined["failed"] else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the pipelines of several events in parallel")
+    parser.add_argument("pipeline", choices=sorted(PIPELINE_SCRIPTS))
+    parser.add_argument("manifest", help="JSON file listing the events")
+    parser.add_argument("--parallel", type=int, default=0, help="Events run at the same time, all of them by default")
+    parser.add_argument("--output", help="Write the combined summary to this JSON file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,242 @@
+## Indexed local store of the event's participants, kept in SQLite next to the CSV exports.
+
+import csv
+import os
+import sqlite3
+import threading
+import time
+from tracing import trace_span
+
+# Database used when no path is given, WAL mode adds -wal and -shm files next to it
+PARTICIPANT_DB_PATH = "./data/participants.db"
+
+# CSV the store is imported from and exported to, read by the other teardown steps
+PARTICIPANTS_CSV_PATH = "./data/participants.csv"
+
+# Other names the participants CSV was written under, still imported so an older
+# export is not lost (on a case-insensitive filesystem they are the same file)
+LEGACY_PARTICIPANTS_CSV_PATHS = ("./data/Participants.csv",)
+
+# Columns of the participants CSV
+PARTICIPANT_CSV_FIELDS = ("First Name", "Email")
+
+# Participants written per transaction
+PARTICIPANT_UPSERT_BATCH_SIZE = 500
+
+# Seconds a writer waits for another process holding the database lock
+SQLITE_BUSY_TIMEOUT_SECONDS = 30
+
+
+class ParticipantStore:
+    """
+    Participants of an event, indexed by email
+
+    Emails are the primary key and compare case-insensitively, so checking whether a
+    participant is known is a single index lookup instead of a rescan of the CSV.
+    Writes are batched into transactions, and several processes or threads can write
+    at once: the database runs in WAL mode and writers wait for each other's lock.
+    The CSV stays the exchange format, import_csv and export_csv move rows in and out.
+    """
+
+    def __init__(self, db_path=PARTICIPANT_DB_PATH):
+        """
+        Args:
+            db_path (str): SQLite database file, created if it does not exist
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        # Transactions are opened explicitly with BEGIN IMMEDIATE
+        self._connection = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+                                           isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS participants (
+                email TEXT PRIMARY KEY COLLATE NOCASE,
+                first_name TEXT NOT NULL DEFAULT '',
+                source TEXT,
+                added_at REAL NOT NULL
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS csv_imports (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+
+    def __contains__(self, email):
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM participants WHERE email = ?", (email.strip(),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM participants").fetchone()[0]
+
+    def add_many(self, participants, source=None):
+        """
+        Add participants, PARTICIPANT_UPSERT_BATCH_SIZE per transaction
+
+        A known email is not added again, but a first name is filled in if the stored
+        one is empty.
+
+        Args:
+            participants (iterable): Dicts with "email" and "first_name"
+            source (str, optional): Where the participants came from, such as a file name
+
+        Returns:
+            list: The participants that were not in the store yet
+        """
+        added = []
+        batch = []
+        for participant in participants:
+            batch.append(participant)
+            if len(batch) >= PARTICIPANT_UPSERT_BATCH_SIZE:
+                added.extend(self._upsert(batch, source))
+                batch = []
+        if batch:
+            added.extend(self._upsert(batch, source))
+        return added
+
+    def add(self, email, first_name="", source=None):
+        """
+        Add one participant
+
+        Returns:
+            bool: True if the email was not in the store yet
+        """
+        return bool(self.add_many([{"email": email, "first_name": first_name}], source))
+
+    def _upsert(self, batch, source):
+        added = []
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            # Take the write lock up front so the existence checks stay valid until commit
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for participant in batch:
+                    email = (participant.get("email") or "").strip()
+                    if not email:
+                        continue
+                    first_name = participant.get("first_name") or ""
+                    row = cursor.execute("SELECT first_name FROM participants WHERE email = ?", (email,)).fetchone()
+                    if row is None:
+                        cursor.execute(
+                            "INSERT INTO participants (email, first_name, source, added_at) VALUES (?, ?, ?, ?)",
+                            (email, first_name, source, now)
+                        )
+                        added.append(participant)
+                    elif first_name and not row[0]:
+                        cursor.execute("UPDATE participants SET first_name = ? WHERE email = ?", (first_name, email))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        return added
+
+    def iter_participants(self):
+        """
+        Yield every participant in the order they were added, as dicts with "email"
+        and "first_name"
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT email, first_name FROM participants ORDER BY rowid").fetchall()
+        for email, first_name in rows:
+            yield {"email": email, "first_name": first_name}
+
+    def _csv_signature(self, csv_path):
+        stat = os.stat(csv_path)
+        return stat.st_mtime, stat.st_size
+
+    def _remember_csv(self, csv_path):
+        mtime, size = self._csv_signature(csv_path)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO csv_imports (path, mtime, size) VALUES (?, ?, ?)",
+                (os.path.abspath(csv_path), mtime, size)
+            )
+
+    def import_csv(self, csv_path, force=False):
+        """
+        Add the participants of a CSV with "First Name" and "Email" columns
+
+        A CSV that has not changed since it was last imported or exported is skipped,
+        so calling this at the start of every step does not rescan the file.
+
+        Args:
+            csv_path (str): CSV to import, nothing happens if it does not exist
+            force (bool, optional): Import even if the file looks unchanged
+
+        Returns:
+            list: The participants that were not in the store yet
+        """
+        if not os.path.isfile(csv_path):
+            return []
+        if not force:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT mtime, size FROM csv_imports WHERE path = ?", (os.path.abspath(csv_path),)
+                ).fetchone()
+            if row is not None and tuple(row) == self._csv_signature(csv_path):
+                return []
+
+        with open(csv_path, 'r', newline='') as csv_file, trace_span("csv read", path=csv_path):
+            rows = (
+                {"email": row.get("Email") or "", "first_name": row.get("First Name") or ""}
+                for row in csv.DictReader(csv_file)
+            )
+            added = self.add_many(rows, source=os.path.basename(csv_path))
+        self._remember_csv(csv_path)
+        print(f"Imported {len(added)} new participants from {csv_path}")
+        return added
+
+    def import_participant_csvs(self, csv_path=PARTICIPANTS_CSV_PATH):
+        """
+        Import the participants CSV, and for the default path the legacy exports too
+
+        Returns:
+            list: The participants that were not in the store yet
+        """
+        added = self.import_csv(csv_path)
+        if os.path.abspath(csv_path) != os.path.abspath(PARTICIPANTS_CSV_PATH):
+            return added
+        for legacy_path in LEGACY_PARTICIPANTS_CSV_PATHS:
+            if os.path.isfile(legacy_path) and not (os.path.isfile(csv_path) and os.path.samefile(legacy_path, csv_path)):
+                added.extend(self.import_csv(legacy_path))
+        return added
+
+    def export_csv(self, csv_path=PARTICIPANTS_CSV_PATH):
+        """
+        Write every participant to a CSV with "First Name" and "Email" columns
+
+        The file is replaced in one step, readers never see a half-written CSV.
+
+        Args:
+            csv_path (str): CSV to write
+
+        Returns:
+            str: The path written
+        """
+        temp_path = f"{csv_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', newline='') as csv_file, trace_span("csv write", path=csv_path):
+            writer = csv.DictWriter(csv_file, fieldnames=PARTICIPANT_CSV_FIELDS)
+            writer.writeheader()
+            for participant in self.iter_participants():
+                writer.writerow({"First Name": participant["first_name"], "Email": participant["email"]})
+        os.replace(temp_path, csv_path)
+        self._remember_csv(csv_path)
+        return csv_path
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
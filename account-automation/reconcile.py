@@ -0,0 +1,451 @@
+## Plan/apply reconciliation of the event's tenant users against the CSV exports.
+##
+## Usage: python reconcile.py plan onboard|teardown [--out plan.json]
+##        python reconcile.py apply plan.json
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from dotenv import load_dotenv
+from Util import (
+    iter_registrations, iter_graph_pages, iter_group_members, close_http_session,
+    build_user_payload, generate_temporary_password, build_welcome_email,
+    batch_create_users, batch_assign_licenses, batch_delete_users, batch_remove_users_from_group,
+    add_users_to_groups, get_group_licenses, ensure_group_licenses, SkuCatalog,
+    ONBOARDING_LICENSE_SKUS, USERS_PAGE_SIZE
+)
+from mailer import EmailOutbox, get_smtp_pool, close_smtp_pools
+from participant_store import PARTICIPANTS_CSV_PATH, LEGACY_PARTICIPANTS_CSV_PATHS
+from journal import OnboardingJournal, discard_journal, ONBOARDING_JOURNAL_PATH
+
+# Where plans are written when no path is given
+PLAN_DIR = "./data/plans"
+
+# User fields the bulk tenant read needs to diff users, licenses and memberships
+RECONCILE_USER_FIELDS = ("id", "userPrincipalName", "mail", "assignedLicenses")
+
+# Domain of the accounts created for the event
+EVENT_DOMAIN = "aiskillsfest.net"
+
+USER_ODATA_TYPE = "#microsoft.graph.user"
+
+
+async def read_tenant_state(tenant_id, client_id, client_secret, group_ids):
+    """
+    Read the tenant's users and the members of the given groups in bulk
+
+    Args:
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        group_ids (list): Groups whose membership is part of the state
+
+    Returns:
+        dict: "users" keyed by lowercased userPrincipalName, "by_mail" mapping lowercased
+            mail to user principal names and "members" mapping group ID to {member ID: @odata.type}
+    """
+    users = {}
+    by_mail = {}
+    params = {"$select": ",".join(RECONCILE_USER_FIELDS), "$top": USERS_PAGE_SIZE}
+    async for user in iter_graph_pages("/users", tenant_id, client_id, client_secret, params=params):
+        user_principal_name = (user.get("userPrincipalName") or "").lower()
+        users[user_principal_name] = {
+            "user_id": user["id"],
+            "user_principal_name": user_principal_name,
+            "mail": (user.get("mail") or "").lower(),
+            "sku_ids": {license["skuId"] for license in user.get("assignedLicenses") or []}
+        }
+        if user.get("mail"):
+            by_mail.setdefault(user["mail"].lower(), []).append(user_principal_name)
+
+    async def read_members(group_id):
+        return {
+            member["id"]: member.get("@odata.type")
+            async for member in iter_group_members(group_id, tenant_id, client_id, client_secret, select=("id",))
+        }
+
+    member_sets = await asyncio.gather(*(read_members(group_id) for group_id in group_ids))
+    print(f"Read {len(users)} tenant users and the members of {len(group_ids)} groups")
+    return {"users": users, "by_mail": by_mail, "members": dict(zip(group_ids, member_sets))}
+
+
+def _new_plan(mode, tenant_id):
+    return {
+        "mode": mode,
+        "tenant_id": tenant_id,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "creates": [],
+        "license_adds": [],
+        "group_licenses": {},
+        "group_adds": {},
+        "deletes": [],
+        "group_removes": {},
+        "license_seats": {}
+    }
+
+
+async def plan_onboarding(registrations_csv, tenant_id, client_id, client_secret, group_ids, license_skus=ONBOARDING_LICENSE_SKUS,
+                          license_group_id=None):
+    """
+    Diff the registration export against the tenant into an onboarding plan
+
+    Every registration should have an event account holding license_skus and belonging
+    to every group in group_ids. Users that are not in the export are left alone.
+
+    Args:
+        registrations_csv (str): Mailchimp registration export
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        group_ids (list): Groups every event user belongs to
+        license_skus (list, optional): SKU IDs every event user holds
+        license_group_id (str, optional): License the users through this group's group-based
+            licensing (one of group_ids) instead of assigning licenses to every user
+
+    Returns:
+        dict: Plan with creates, license_adds, group_licenses and group_adds, users referenced
+            by user_principal_name and, when they exist already, user_id
+    """
+    state = await read_tenant_state(tenant_id, client_id, client_secret, group_ids)
+    plan = _new_plan("onboard", tenant_id)
+    # Same scope as the onboarding journal of Util.py, so either can resume the other's creates
+    plan["journal_scope"] = f"{tenant_id} {os.path.abspath(registrations_csv)}"
+    plan["group_adds"] = {group_id: [] for group_id in group_ids}
+    required_skus = set(license_skus)
+    seat_needs = []
+
+    if license_group_id:
+        missing_group_skus = required_skus - await get_group_licenses(license_group_id, tenant_id, client_id, client_secret)
+        if missing_group_skus:
+            plan["group_licenses"][license_group_id] = sorted(missing_group_skus)
+
+    for registration in iter_registrations(registrations_csv):
+        user_principal_name = f"{registration.handle}@{EVENT_DOMAIN}"
+        actual = state["users"].get(user_principal_name)
+        reference = {"user_principal_name": user_principal_name, "user_id": actual["user_id"] if actual else None}
+
+        if actual is None:
+            plan["creates"].append({
+                "user_principal_name": user_principal_name,
+                "email": registration.email,
+                "first_name": registration.first_name,
+                "last_name": registration.last_name,
+                "handle": registration.handle
+            })
+            missing_skus = required_skus
+        else:
+            missing_skus = required_skus - actual["sku_ids"]
+
+        if missing_skus:
+            seat_needs.append(missing_skus)
+            if not license_group_id:
+                plan["license_adds"].append(dict(reference, sku_ids=sorted(missing_skus)))
+        for group_id in group_ids:
+            if actual is None or actual["user_id"] not in state["members"][group_id]:
+                plan["group_adds"][group_id].append(reference)
+
+    # Record the free seats so the plan shows a shortage before anything is applied
+    if seat_needs:
+        catalog = await SkuCatalog.load(tenant_id, client_id, client_secret)
+        for sku_id in required_skus:
+            plan["license_seats"][sku_id] = {
+                "name": catalog.name(sku_id),
+                "needed": sum(1 for missing_skus in seat_needs if sku_id in missing_skus),
+                "remaining": catalog.remaining(sku_id)
+            }
+
+    return plan
+
+
+async def plan_teardown(participant_csvs, tenant_id, client_id, client_secret, group_id):
+    """
+    Diff the end-of-event state into a teardown plan
+
+    Every user member of the learners group and every user matching a participant email
+    (by mail, or by a user principal name equal to the email or to its
+    handle@aiskillsfest.net account) is deleted; members of the group that are not users
+    are removed from it.
+
+    Args:
+        participant_csvs (list): CSV files with an "Email" column
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        group_id (str): ID of the learners group
+
+    Returns:
+        dict: Plan with deletes and group_removes
+    """
+    state = await read_tenant_state(tenant_id, client_id, client_secret, [group_id])
+    plan = _new_plan("teardown", tenant_id)
+    users_by_id = {user["user_id"]: user for user in state["users"].values()}
+
+    deletes = {}
+    non_user_members = []
+    for member_id, odata_type in state["members"][group_id].items():
+        if odata_type == USER_ODATA_TYPE and member_id in users_by_id:
+            deletes[member_id] = users_by_id[member_id]
+        elif odata_type != USER_ODATA_TYPE:
+            non_user_members.append(member_id)
+
+    for csv_file_path in participant_csvs:
+        if not os.path.isfile(csv_file_path):
+            print(f"Skipping missing participant file {csv_file_path}")
+            continue
+        with open(csv_file_path, "r", newline="", encoding="utf-8-sig") as csv_file:
+            for row in csv.DictReader(csv_file):
+                email = (row.get("Email") or "").strip().lower()
+                if not email:
+                    continue
+                matches = list(state["by_mail"].get(email, []))
+                # The account onboarding created for the email, whatever its mail says
+                for user_principal_name in (email, f"{email.split('@')[0]}@{EVENT_DOMAIN}"):
+                    if user_principal_name in state["users"]:
+                        matches.append(user_principal_name)
+                for user_principal_name in matches:
+                    user = state["users"][user_principal_name]
+                    deletes[user["user_id"]] = user
+
+    plan["deletes"] = [
+        {"user_id": user["user_id"], "user_principal_name": user["user_principal_name"], "email": user["mail"]}
+        for user in deletes.values()
+    ]
+    plan["group_removes"] = {group_id: non_user_members}
+    return plan
+
+
+def summarize_plan(plan):
+    """
+    Print how many changes of each kind a plan holds
+    """
+    print(f"=== {plan['mode'].upper()} PLAN ({plan['created_at']}) ===")
+    print(f"Create users: {len(plan['creates'])}")
+    print(f"Assign licenses: {len(plan['license_adds'])}")
+    for group_id, sku_ids in plan.get("group_licenses", {}).items():
+        print(f"License group {group_id}: {len(sku_ids)} SKUs")
+    for seats in plan.get("license_seats", {}).values():
+        shortage = f", SHORT BY {seats['needed'] - seats['remaining']}" if seats["needed"] > seats["remaining"] else ""
+        print(f"  {seats['name']}: {seats['needed']} seats needed, {seats['remaining']} remaining{shortage}")
+    for group_id, references in plan["group_adds"].items():
+        print(f"Add to group {group_id}: {len(references)}")
+    print(f"Delete users: {len(plan['deletes'])}")
+    for group_id, member_ids in plan["group_removes"].items():
+        print(f"Remove from group {group_id}: {len(member_ids)}")
+
+
+def save_plan(plan, plan_path=None):
+    """
+    Write a plan as JSON for review
+
+    Returns:
+        str: Path of the plan file
+    """
+    plan_path = plan_path or os.path.join(PLAN_DIR, f"{plan['mode']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(plan_path) or ".", exist_ok=True)
+    with open(plan_path, "w", encoding="utf-8") as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    return plan_path
+
+
+async def apply_plan(plan, tenant_id, client_id, client_secret, outbox=None, sender_email=None, journal=None):
+    """
+    Carry out a plan with the bulk Graph helpers
+
+    Creates run first so their new IDs can be used for the license and group changes of
+    the same plan. Temporary passwords are only generated here and never written to the
+    plan file; they go to the onboarding journal instead, so a crash before the welcome
+    emails went out does not lose them.
+
+    Args:
+        plan (dict): Plan from plan_onboarding or plan_teardown
+        tenant_id (str): Microsoft Entra ID tenant ID
+        client_id (str): Application ID for authentication
+        client_secret (str): Application secret for authentication
+        outbox (EmailOutbox, optional): Queue a welcome email here for every created user
+        sender_email (str, optional): Sender of the welcome emails
+        journal (OnboardingJournal, optional): Records every created user with its
+            temporary password, and the welcome emails that were sent
+
+    Returns:
+        dict: Per change kind, results with "success" and "failed" lists
+    """
+    results = {}
+    user_ids = {}
+
+    if plan["creates"]:
+        payloads = []
+        passwords = {}
+        for create in plan["creates"]:
+            passwords[create["user_principal_name"]] = generate_temporary_password()
+            payloads.append(build_user_payload(
+                create["email"], create["first_name"], create["last_name"], create["handle"],
+                passwords[create["user_principal_name"]]
+            ))
+        results["creates"] = await batch_create_users(payloads, tenant_id, client_id, client_secret)
+        creates = {create["user_principal_name"]: create for create in plan["creates"]}
+        for created in results["creates"]["success"]:
+            user_ids[created["user_principal_name"]] = created["user_id"]
+            if journal is not None:
+                journal.record(
+                    created["user_principal_name"], "created", user_id=created["user_id"],
+                    temp_password=passwords[created["user_principal_name"]],
+                    email=creates[created["user_principal_name"]]["email"]
+                )
+        print(f"Created {len(results['creates']['success'])} users, {len(results['creates']['failed'])} failed")
+
+        if outbox is not None:
+            for created in results["creates"]["success"]:
+                create = creates[created["user_principal_name"]]
+                msg, recipients = build_welcome_email(
+                    create["email"], create["first_name"], create["last_name"],
+                    create["user_principal_name"], passwords[create["user_principal_name"]], sender_email
+                )
+                email_sent = outbox.enqueue(msg, recipients, label=create["email"])
+                if journal is not None:
+                    email_sent.add_done_callback(
+                        lambda sent, user_principal_name=create["user_principal_name"]:
+                            journal.record(user_principal_name, "emailed") if sent.result() else None
+                    )
+
+    def resolve(reference):
+        return reference.get("user_id") or user_ids.get(reference["user_principal_name"])
+
+    if plan["license_adds"]:
+        # Seats are checked again at apply time, users beyond them are not sent to Graph
+        catalog = await SkuCatalog.load(tenant_id, client_id, client_secret)
+
+        # Users missing the same SKUs are assigned together
+        by_skus = {}
+        for license_add in plan["license_adds"]:
+            user_id = resolve(license_add)
+            if user_id:
+                by_skus.setdefault(tuple(license_add["sku_ids"]), []).append(user_id)
+        results["license_adds"] = {"success": [], "failed": []}
+        for sku_ids, sku_user_ids in by_skus.items():
+            assigned = await batch_assign_licenses(sku_user_ids, list(sku_ids), tenant_id, client_id, client_secret, sku_catalog=catalog)
+            results["license_adds"]["success"].extend(assigned["success"])
+            results["license_adds"]["failed"].extend(assigned["failed"])
+        print(f"Assigned licenses to {len(results['license_adds']['success'])} users, {len(results['license_adds']['failed'])} failed")
+        catalog.report({sku_id for sku_ids in by_skus for sku_id in sku_ids})
+
+    # A licensed group hands its licenses to the users added below
+    results["group_licenses"] = {}
+    for group_id, sku_ids in plan.get("group_licenses", {}).items():
+        results["group_licenses"][group_id] = await ensure_group_licenses(group_id, sku_ids, tenant_id, client_id, client_secret)
+
+    group_adds = {
+        group_id: [user_id for user_id in map(resolve, references) if user_id]
+        for group_id, references in plan["group_adds"].items()
+    }
+    group_adds = {group_id: ids for group_id, ids in group_adds.items() if ids}
+    if group_adds:
+        added = await asyncio.gather(*(
+            add_users_to_groups(ids, [group_id], tenant_id, client_id, client_secret)
+            for group_id, ids in group_adds.items()
+        ))
+        results["group_adds"] = {group_id: result[group_id] for group_id, result in zip(group_adds, added)}
+        for group_id, result in results["group_adds"].items():
+            print(f"Added {len(result['success'])} users to group {group_id}, {len(result['failed'])} failed")
+
+    if plan["deletes"]:
+        delete_ids = [delete["user_id"] for delete in plan["deletes"]]
+        results["deletes"] = await batch_delete_users(delete_ids, tenant_id, client_id, client_secret)
+        print(f"Deleted {len(results['deletes']['success'])} users, {len(results['deletes']['failed'])} failed")
+
+    results["group_removes"] = {}
+    for group_id, member_ids in plan["group_removes"].items():
+        if member_ids:
+            removed = await batch_remove_users_from_group(member_ids, group_id, tenant_id, client_id, client_secret)
+            results["group_removes"][group_id] = removed
+            print(f"Removed {len(removed['success'])} members from group {group_id}, {len(removed['failed'])} failed")
+
+    return results
+
+
+async def main(args):
+    tenant_id = os.getenv("AZURE_TENANT_ID")
+    client_id = os.getenv("AZURE_CLIENT_ID")
+    client_secret = os.getenv("AZURE_CLIENT_SECRET")
+    group_id = os.getenv("AISKILLSFEST_LEARNERS_GROUP_ID")
+    sp_group_id = os.getenv("AISKILLSFEST_SHAREPOINT_GROUP_ID")
+
+    try:
+        if args.command == "plan":
+            if args.mode == "onboard":
+                group_ids = [group for group in (group_id, sp_group_id) if group]
+                # LICENSE_MODE=group licenses the learners group instead of every user
+                license_group_id = group_id if os.getenv("LICENSE_MODE", "user").lower() == "group" else None
+                plan = await plan_onboarding(
+                    args.registrations, tenant_id, client_id, client_secret, group_ids,
+                    license_group_id=license_group_id
+                )
+            else:
+                plan = await plan_teardown(args.participants, tenant_id, client_id, client_secret, group_id)
+            summarize_plan(plan)
+            print(f"Plan saved to {save_plan(plan, args.out)}")
+            return
+
+        with open(args.plan, "r", encoding="utf-8") as plan_file:
+            plan = json.load(plan_file)
+        if plan["tenant_id"] != tenant_id:
+            raise Exception(f"Plan was made for tenant {plan['tenant_id']}, not {tenant_id}")
+        summarize_plan(plan)
+
+        outbox = None
+        sender_email = os.getenv("SMTP_EMAIL")
+        smtp_settings = [os.getenv("SMTP_SERVER"), os.getenv("SMTP_PORT", 587), sender_email, os.getenv("SMTP_PASSWORD")]
+        if plan["creates"] and all(smtp_settings):
+            outbox = EmailOutbox(
+                get_smtp_pool(*smtp_settings),
+                workers=int(os.getenv("SMTP_WORKERS", 4)),
+                max_per_second=float(os.getenv("SMTP_MAX_PER_SECOND", 5))
+            )
+        # Temporary passwords of the created users are kept until their emails went out
+        journal = None
+        if plan["creates"]:
+            journal = OnboardingJournal(
+                os.getenv("ONBOARDING_JOURNAL", ONBOARDING_JOURNAL_PATH),
+                scope=plan.get("journal_scope", f"{tenant_id} {args.plan}")
+            )
+        results = await apply_plan(plan, tenant_id, client_id, client_secret, outbox=outbox, sender_email=sender_email, journal=journal)
+        if outbox is not None:
+            await outbox.drain()
+        if journal is not None:
+            created = results["creates"]["success"]
+            if outbox is not None and all(journal.has(user["user_principal_name"], "emailed") for user in created):
+                journal.discard()
+            else:
+                journal.close()
+                print(f"Temporary passwords of users without a welcome email are in {journal.journal_path}")
+
+        # After a complete teardown no onboarding journal may resume the deleted accounts
+        if plan["mode"] == "teardown" and not results.get("deletes", {}).get("failed"):
+            discard_journal(os.getenv("ONBOARDING_JOURNAL", ONBOARDING_JOURNAL_PATH))
+    finally:
+        await close_http_session()
+        close_smtp_pools()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Plan and apply tenant changes for the event in bulk")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="Diff the CSVs against the tenant and save a plan")
+    plan_parser.add_argument("mode", choices=["onboard", "teardown"])
+    plan_parser.add_argument("--registrations", default="./data/registered.csv", help="Registration export (onboard)")
+    plan_parser.add_argument("--participants", nargs="+", default=[PARTICIPANTS_CSV_PATH, *LEGACY_PARTICIPANTS_CSV_PATHS, "./data/subscriberShorts.csv"],
+                             help="Participant CSVs with an Email column (teardown)")
+    plan_parser.add_argument("--out", help="Where to save the plan")
+
+    apply_parser = commands.add_parser("apply", help="Apply a saved plan")
+    apply_parser.add_argument("plan", help="Plan file written by the plan command")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    # Load environment variables from .env file, or from ENV_FILE when run for one event
+    load_dotenv(os.getenv("ENV_FILE"))
+    asyncio.run(main(parse_args()))
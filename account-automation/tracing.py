@@ -0,0 +1,205 @@
+## Span tracing of Graph, SMTP, token and CSV operations, with per-stage histograms.
+
+import contextlib
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+
+# Upper bounds in milliseconds of the histogram buckets, the last bucket is open ended
+TRACE_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Path segments replaced by {id} so calls on different users share one operation name
+ID_SEGMENT_PATTERN = re.compile(r"^([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[^/]*@[^/]*)$")
+
+# Pipeline stage the running code belongs to, set with trace_stage
+_current_stage = contextvars.ContextVar("trace_stage", default=None)
+
+
+def graph_operation_name(method, url):
+    """
+    Name a Graph call by method and path with IDs replaced, e.g. "POST /users/{id}/assignLicense"
+    """
+    path = url.split("?", 1)[0]
+    if "/v1.0" in path:
+        path = path.split("/v1.0", 1)[1]
+    segments = ["{id}" if ID_SEGMENT_PATTERN.match(segment) else segment for segment in path.split("/")]
+    return f"graph {method} {'/'.join(segments)}"
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of already sorted values
+
+    Args:
+        sorted_values (list): Values in ascending order
+        fraction (float): Percentile as a fraction, 0.95 for the p95
+
+    Returns:
+        float: The value at that rank, 0.0 when there are no values
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class Tracer:
+    """
+    Collect timed spans of the operations a run performs
+
+    A span records the operation name, the pipeline stage it ran in, its duration and
+    whatever the caller adds (status code, retries, error). Spans are kept in memory
+    and written as JSON lines at the end of the run, followed by one histogram line per
+    stage and operation. Spans may be recorded from worker threads.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, operation, **attributes):
+        """
+        Time the block as one span
+
+        Args:
+            operation (str): Operation name, such as "graph POST /users" or "smtp send"
+            **attributes: Extra span fields
+
+        Yields:
+            dict: The span, callers set fields such as "status" or "retries" on it
+        """
+        span = {"operation": operation, "stage": _current_stage.get(), "start": time.time(), **attributes}
+        started = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.setdefault("error", str(e))
+            raise
+        finally:
+            span["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            with self._lock:
+                self.spans.append(span)
+
+    def record(self, operation, duration_ms, **attributes):
+        """
+        Add a span whose duration was measured by the caller
+
+        Args:
+            operation (str): Operation name
+            duration_ms (float): Duration in milliseconds
+            **attributes: Extra span fields
+        """
+        span = {"operation": operation, "stage": _current_stage.get(), "start": time.time() - duration_ms / 1000,
+                **attributes, "duration_ms": round(duration_ms, 3)}
+        with self._lock:
+            self.spans.append(span)
+
+    def histograms(self):
+        """
+        Returns:
+            list: Per stage and operation, the span count, errors, total, p50/p95/p99 and
+                bucket counts in milliseconds
+        """
+        with self._lock:
+            spans = list(self.spans)
+
+        grouped = {}
+        for span in spans:
+            grouped.setdefault((span["stage"], span["operation"]), []).append(span)
+
+        histograms = []
+        for (stage, operation), group in sorted(grouped.items(), key=lambda item: (item[0][0] or "", item[0][1])):
+            durations = sorted(span["duration_ms"] for span in group)
+            buckets = {f"le_{bound}": 0 for bound in TRACE_BUCKETS_MS}
+            buckets["gt_max"] = 0
+            for duration in durations:
+                for bound in TRACE_BUCKETS_MS:
+                    if duration <= bound:
+                        buckets[f"le_{bound}"] += 1
+                        break
+                else:
+                    buckets["gt_max"] += 1
+            histograms.append({
+                "stage": stage,
+                "operation": operation,
+                "count": len(durations),
+                "errors": sum(1 for span in group if span.get("error") or (span.get("status") or 0) >= 400),
+                "retries": sum(span.get("retries", 0) for span in group),
+                "total_ms": round(sum(durations), 3),
+                "p50_ms": percentile(durations, 0.50),
+                "p95_ms": percentile(durations, 0.95),
+                "p99_ms": percentile(durations, 0.99),
+                "buckets": buckets
+            })
+        return histograms
+
+    def report(self):
+        print("=== OPERATION LATENCY ===")
+        for histogram in self.histograms():
+            print(f"{histogram['stage'] or '-'} / {histogram['operation']}: {histogram['count']} ops, "
+                  f"{histogram['errors']} errors, {histogram['retries']} retries, "
+                  f"p50 {histogram['p50_ms']:.0f} ms, p95 {histogram['p95_ms']:.0f} ms, "
+                  f"p99 {histogram['p99_ms']:.0f} ms, total {histogram['total_ms'] / 1000:.1f}s")
+
+    def write(self, trace_path):
+        """
+        Write every span and the histograms to a JSON lines file
+
+        Args:
+            trace_path (str): File to write, replaced if it exists
+
+        Returns:
+            str: The path written
+        """
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+        with self._lock:
+            spans = list(self.spans)
+        with open(trace_path, "w", encoding="utf-8") as trace_file:
+            for span in spans:
+                trace_file.write(json.dumps(dict(span, type="span")) + "\n")
+            for histogram in self.histograms():
+                trace_file.write(json.dumps(dict(histogram, type="histogram")) + "\n")
+        return trace_path
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+# Tracer shared by every module in the process
+tracer = Tracer()
+
+
+def trace_span(operation, **attributes):
+    """
+    Time a block as a span of the shared tracer, see Tracer.span
+    """
+    return tracer.span(operation, **attributes)
+
+
+@contextlib.contextmanager
+def trace_stage(stage):
+    """
+    Attribute the spans recorded inside the block (in this task or thread) to a stage
+    """
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+def finish_trace(trace_path):
+    """
+    Print the latency histograms and write the trace file at the end of a run
+
+    Args:
+        trace_path (str): JSON lines file to write, nothing is written when empty
+    """
+    tracer.report()
+    if trace_path:
+        print(f"Trace written to {tracer.write(trace_path)}")